@@ -0,0 +1,434 @@
+import asyncio
+import dataclasses
+import datetime
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bacpypes3.apdu import (
+    AbortPDU,
+    ErrorRejectAbortNack,
+    ReadRangeACK,
+    ReadRangeRequest,
+    RejectPDU,
+)
+from bacpypes3.basetypes import (
+    DateTime,
+    LogRecord,
+    Range,
+    RangeBySequenceNumber,
+    RangeByTime,
+)
+from bacpypes3.constructeddata import ListOf
+from bacpypes3.pdu import Address
+from bacpypes3.primitivedata import ObjectIdentifier
+
+from app.historian import PointKey, TrendLogKey
+from app.registry import DeviceRecord, OFFLINE
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# objects whose buffer is read back, trend-log-multiple records hold several
+# values each and aren't mapped to points
+TREND_LOG_TYPES = {"trend-log"}
+
+# devices backfilled at the same time, and ReadRange requests outstanding
+# to one device
+BACKFILL_DEVICE_CONCURRENCY = 4
+DEVICE_CONCURRENCY = 2
+
+# encoded size estimates used to ask for as many records as fit in one
+# unsegmented response from the device
+LOG_RECORD_BYTES = 24
+READ_RANGE_OVERHEAD_BYTES = 24
+MAX_PAGE_RECORDS = 256
+
+# how often the trend logs are checked for records the historian is missing
+BACKFILL_INTERVAL = 900.0
+
+# time to read from when a device can only be read by time and nothing has
+# been read from the log yet
+BACKFILL_EPOCH = datetime.datetime(2000, 1, 1)
+
+# the record types that carry a trendable value
+VALUE_DATUMS = ("realValue", "booleanValue", "enumValue", "unsignedValue", "signedValue")
+
+# outcomes of backfilling one device
+BACKFILLED = "backfilled"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+@dataclasses.dataclass
+class TrendLog:
+    """Read position and counters of one trend log."""
+
+    device_instance: int
+    object_identifier: str
+    point: Optional[PointKey]  # the logged property, None if it isn't set
+    sequence: Optional[int] = None  # of the last record read
+    timestamp: Optional[float] = None  # of the last record read
+    by_time: bool = False  # set when the device doesn't number its records
+    records: int = 0
+    inserted: int = 0
+    lost: int = 0  # dropped from the buffer before they were read
+    error: Optional[str] = None
+
+    @property
+    def key(self) -> TrendLogKey:
+        return (self.device_instance, self.object_identifier)
+
+    def to_json(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+
+@dataclasses.dataclass
+class DeviceLogs:
+    """The trend logs found in one device."""
+
+    database_revision: Optional[int] = None
+    logs: Optional[List[TrendLog]] = None
+    listed_at: float = 0.0
+
+
+def page_size(record: DeviceRecord) -> int:
+    """Records per ReadRange request that fit the device's max APDU."""
+    return max(
+        1, min(MAX_PAGE_RECORDS, (record.max_apdu - READ_RANGE_OVERHEAD_BYTES) // LOG_RECORD_BYTES)
+    )
+
+
+def log_sample(log_record: LogRecord) -> Optional[Tuple[float, float]]:
+    """(timestamp, value) of a log record, None for status and error records."""
+    if log_record.timestamp.is_special:
+        return None
+    datum = log_record.logDatum
+    for name in VALUE_DATUMS:
+        value = getattr(datum, name, None)
+        if value is not None:
+            return log_record.timestamp.datetime.timestamp(), float(value)
+    return None
+
+
+class TrendLogBackfill:
+    """
+    Fills the gaps in the historian from the trend logs the controllers keep
+    themselves. The trend logs of each device are found from its object
+    list, their buffers are read with ReadRange by sequence number (by time
+    for devices that don't number their records) in pages sized to the
+    device's max APDU, starting after the last record read, and the samples
+    go into the historian together with the new position so a restart
+    carries on where it stopped.
+    """
+
+    def __init__(
+        self,
+        app,
+        interval: float = BACKFILL_INTERVAL,
+        device_concurrency: int = DEVICE_CONCURRENCY,
+        backfill_concurrency: int = BACKFILL_DEVICE_CONCURRENCY,
+    ):
+        self.app = app
+        self.interval = interval
+        self.device_concurrency = device_concurrency
+        self.backfill_concurrency = backfill_concurrency
+
+        self.devices: Dict[int, DeviceLogs] = {}
+
+        # (sequence, timestamp) of every log read before, from the historian
+        self.positions: Dict[TrendLogKey, Tuple[Optional[int], Optional[float]]] = {}
+
+        self.requests = 0
+        self.inserted = 0
+        self.last_run: Optional[Dict[str, Any]] = None
+        self._run: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        self.positions = await self.app.historian.trend_log_positions()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backfill()
+            except Exception as e:
+                _log.error(f"Error backfilling trend logs: {e}")
+
+    async def backfill(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Read the new records of every trend log of every device that isn't
+        offline, a call while a run is going waits for that one. `force`
+        lists the objects of every device again.
+        """
+        if self._run is None or self._run.done():
+            self._run = asyncio.create_task(self._backfill_all(force))
+        return await asyncio.shield(self._run)
+
+    async def _backfill_all(self, force: bool) -> Dict[str, Any]:
+        started = time.time()
+        requests = self.requests
+        inserted = self.inserted
+        records = [
+            record
+            for record in self.app.registry.devices.values()
+            if record.status != OFFLINE
+        ]
+        limit = asyncio.Semaphore(self.backfill_concurrency)
+
+        async def backfill_device(record):
+            async with limit:
+                return await self.backfill_device(record, force)
+
+        outcomes = await asyncio.gather(*(backfill_device(record) for record in records))
+        logs = [log for state in self.devices.values() for log in state.logs or []]
+
+        self.last_run = {
+            "started": started,
+            "duration": round(time.time() - started, 3),
+            "devices": len(records),
+            BACKFILLED: outcomes.count(BACKFILLED),
+            UNCHANGED: outcomes.count(UNCHANGED),
+            FAILED: outcomes.count(FAILED),
+            "logs": len(logs),
+            "inserted": self.inserted - inserted,
+            "requests": self.requests - requests,
+        }
+        _log.info(
+            "Trend log backfill of %d devices: %d samples added, %d requests",
+            len(records),
+            self.last_run["inserted"],
+            self.last_run["requests"],
+        )
+        return self.last_run
+
+    async def backfill_device(self, record: DeviceRecord, force: bool = False) -> str:
+        device_instance = record.device_instance
+        state = self.devices.setdefault(device_instance, DeviceLogs())
+        address = Address(record.address)
+
+        try:
+            revision = await self._read(
+                address, f"device,{device_instance}", "database-revision"
+            )
+            if revision is not None:
+                revision = int(revision)
+
+            # trend logs only come and go with the database revision
+            if (
+                state.logs is None
+                or force
+                or revision != state.database_revision
+                or (revision is None and time.time() - state.listed_at > self.interval)
+            ):
+                state.logs = await self._trend_logs(address, device_instance, state.logs)
+                state.database_revision = revision
+                state.listed_at = time.time()
+        except ErrorRejectAbortNack as err:
+            _log.warning(f"Listing the trend logs of device {device_instance} failed: {err}")
+            return FAILED
+        except Exception as e:
+            _log.error(f"Error listing the trend logs of device {device_instance}: {e}")
+            return FAILED
+
+        device_limit = asyncio.Semaphore(self.device_concurrency)
+
+        async def backfill_log(log):
+            async with device_limit:
+                return await self.backfill_log(record, log)
+
+        inserted = await asyncio.gather(*(backfill_log(log) for log in state.logs))
+        if any(log.error for log in state.logs):
+            return FAILED
+        return BACKFILLED if any(inserted) else UNCHANGED
+
+    async def backfill_log(self, record: DeviceRecord, log: TrendLog) -> int:
+        """Read the records added since the last run, returns the samples added."""
+        if log.point is None:
+            return 0
+        address = Address(record.address)
+        inserted = 0
+        try:
+            if not log.by_time:
+                inserted = await self._by_sequence(record, address, log)
+            if log.by_time:
+                inserted += await self._by_time(record, address, log)
+        except ErrorRejectAbortNack as err:
+            log.error = f"error/reject/abort: {err}"
+            _log.warning(f"Backfill of {log.key} failed: {err}")
+        except Exception as e:
+            log.error = str(e)
+            _log.error(f"Error backfilling {log.key}: {e}")
+        else:
+            log.error = None
+        return inserted
+
+    async def _by_sequence(self, record: DeviceRecord, address: Address, log: TrendLog) -> int:
+        total = await self._read(address, log.object_identifier, "total-record-count")
+        count = await self._read(address, log.object_identifier, "record-count")
+        if total is None or count is None:
+            log.by_time = True
+            return 0
+        total, count = int(total), int(count)
+
+        # records are numbered from 1, the buffer holds the newest `count`
+        oldest = total - count + 1
+        if log.sequence is None or log.sequence > total:
+            # never read, or the log was cleared and numbers from 1 again
+            start = oldest
+        else:
+            start = log.sequence + 1
+            if start < oldest:
+                log.lost += oldest - start
+                _log.warning(
+                    "%d records of %r rolled out of the buffer before they were read",
+                    oldest - start,
+                    log.key,
+                )
+                start = oldest
+
+        inserted = 0
+        while start <= total:
+            ack = await self._read_range(
+                address,
+                log,
+                Range(
+                    bySequenceNumber=RangeBySequenceNumber(
+                        referenceSequenceNumber=start, count=page_size(record)
+                    )
+                ),
+            )
+            if ack.firstSequenceNumber is None:
+                # numbers aren't kept, carry on by time
+                log.by_time = True
+                return inserted
+
+            log_records = ack.itemData.cast_out(ListOf(LogRecord)) if ack.itemCount else []
+            if not log_records:
+                break
+            last = ack.firstSequenceNumber + len(log_records) - 1
+            inserted += await self._store(log, log_records, last)
+            start = last + 1
+        return inserted
+
+    async def _by_time(self, record: DeviceRecord, address: Address, log: TrendLog) -> int:
+        inserted = 0
+        while True:
+            after = (
+                datetime.datetime.fromtimestamp(log.timestamp)
+                if log.timestamp is not None
+                else BACKFILL_EPOCH
+            )
+            ack = await self._read_range(
+                address,
+                log,
+                Range(byTime=RangeByTime(referenceTime=DateTime(after), count=page_size(record))),
+            )
+            log_records = ack.itemData.cast_out(ListOf(LogRecord)) if ack.itemCount else []
+            if not log_records:
+                return inserted
+
+            previous = log.timestamp
+            inserted += await self._store(log, log_records, None)
+            if not ack.resultFlags[2] or log.timestamp == previous:
+                # no more items, or a page of records all at one time
+                return inserted
+
+    async def _store(self, log: TrendLog, log_records: List[LogRecord], sequence: Optional[int]) -> int:
+        samples = [sample for sample in map(log_sample, log_records) if sample]
+        timestamp = max([log.timestamp or 0.0, *(sample[0] for sample in samples)]) or None
+
+        inserted = await self.app.historian.backfill(
+            log.key, log.point, samples, sequence, timestamp
+        )
+        if sequence is not None:
+            log.sequence = sequence
+        log.timestamp = timestamp
+        log.records += len(log_records)
+        log.inserted += inserted
+        self.inserted += inserted
+        return inserted
+
+    async def _read_range(self, address: Address, log: TrendLog, read_range: Range) -> ReadRangeACK:
+        self.requests += 1
+        request = ReadRangeRequest(
+            objectIdentifier=ObjectIdentifier(log.object_identifier),
+            propertyIdentifier="log-buffer",
+            range=read_range,
+            destination=address,
+        )
+        return await self.app.bacnet_app.request(request)
+
+    async def _read(
+        self, address: Address, object_identifier: str, property_identifier: str, array_index=None
+    ) -> Any:
+        """Read one property, None when the device has no such property."""
+        self.requests += 1
+        try:
+            return await self.app.bacnet_app.read_property(
+                address, ObjectIdentifier(object_identifier), property_identifier, array_index
+            )
+        except ErrorRejectAbortNack as err:
+            if isinstance(err, (RejectPDU, AbortPDU)):
+                raise
+            return None
+
+    async def _trend_logs(
+        self, address: Address, device_instance: int, known: Optional[List[TrendLog]]
+    ) -> List[TrendLog]:
+        device_identifier = f"device,{device_instance}"
+        try:
+            self.requests += 1
+            object_list = await self.app.bacnet_app.read_property(
+                address, ObjectIdentifier(device_identifier), "object-list"
+            )
+        except AbortPDU as err:
+            # too long for a device that can't segment, read it one entry
+            # at a time
+            _log.debug("    - object-list by index: %r", err)
+            length = await self._read(address, device_identifier, "object-list", 0)
+            object_list = [
+                await self._read(address, device_identifier, "object-list", index)
+                for index in range(1, int(length or 0) + 1)
+            ]
+
+        # logs found before keep their counters
+        known_logs = {log.object_identifier: log for log in known or []}
+        logs = []
+        for object_identifier in object_list:
+            if object_identifier is None or str(object_identifier[0]) not in TREND_LOG_TYPES:
+                continue
+            object_identifier = str(object_identifier)
+            reference = await self._read(address, object_identifier, "log-device-object-property")
+
+            point = None
+            if reference is not None and reference.objectIdentifier is not None:
+                point = (
+                    reference.deviceIdentifier[1]
+                    if reference.deviceIdentifier is not None
+                    else device_instance,
+                    str(reference.objectIdentifier),
+                    str(reference.propertyIdentifier),
+                )
+
+            log = known_logs.get(object_identifier)
+            if log is None:
+                sequence, timestamp = self.positions.get(
+                    (device_instance, object_identifier), (None, None)
+                )
+                log = TrendLog(device_instance, object_identifier, point, sequence, timestamp)
+            log.point = point
+            logs.append(log)
+
+        _log.debug("device %r has %d trend logs", device_instance, len(logs))
+        return logs
+
+    def report(self) -> Dict[str, Any]:
+        """The last run and the position of every trend log."""
+        return {
+            "run": self.last_run,
+            "logs": [
+                log.to_json()
+                for _, state in sorted(self.devices.items())
+                for log in state.logs or []
+            ],
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# how long edits are collected before they are written to disk
+WRITE_DELAY = 0.5
+
+
+def atomic_write_json(path: str, data: Any, **dump_kwargs) -> None:
+    """
+    Write JSON to a temporary file next to `path` and move it into place, so a
+    crash in the middle of a write leaves the previous file intact.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    # mkstemp creates the file private, keep the mode of the file it replaces
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file, **dump_kwargs)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ConfigStore:
+    """
+    Configuration collections (schedule, users, point lists, alarm rules) held
+    in memory for reads and persisted write-behind from a worker thread, so
+    edits never block the event loop that runs the BACnet stack.
+
+    Each collection is a dict keyed by name and lives in its own JSON file.
+    """
+
+    def __init__(
+        self,
+        paths: Dict[str, str],
+        defaults: Optional[Dict[str, dict]] = None,
+        write_delay: float = WRITE_DELAY,
+    ):
+        self.paths = paths
+        self.write_delay = write_delay
+        defaults = defaults or {}
+
+        self.data: Dict[str, dict] = {
+            collection: self._read(path, defaults.get(collection, {}))
+            for collection, path in paths.items()
+        }
+        self.versions: Dict[str, int] = {collection: 0 for collection in paths}
+
+        # called with the collection name after every change
+        self.listeners: List[Callable[[str], None]] = []
+
+        self._dirty = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def _read(self, path: str, default: dict) -> dict:
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+            _log.debug("Config loaded from %s", path)
+            return data
+        except FileNotFoundError:
+            _log.info("No config file at %s, using defaults", path)
+        except ValueError as e:
+            _log.error(f"Failed to parse config file {path}: {e}")
+        return dict(default)
+
+    def version(self, collection: str) -> int:
+        return self.versions[collection]
+
+    def get(self, collection: str) -> dict:
+        return self.data[collection]
+
+    def get_item(self, collection: str, key: str, default: Any = None) -> Any:
+        return self.data[collection].get(key, default)
+
+    def put(self, collection: str, data: dict) -> None:
+        """Replace a whole collection."""
+        self.data[collection] = data
+        self._changed(collection)
+
+    def put_item(self, collection: str, key: str, item: Any) -> None:
+        self.data[collection][key] = item
+        self._changed(collection)
+
+    def delete_item(self, collection: str, key: str) -> None:
+        del self.data[collection][key]
+        self._changed(collection)
+
+    def _changed(self, collection: str) -> None:
+        self.versions[collection] += 1
+        for listener in self.listeners:
+            listener(collection)
+
+        self._dirty.add(collection)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # collect a burst of edits into one write per collection
+        await asyncio.sleep(self.write_delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write every changed collection to disk off the event loop."""
+        async with self._flush_lock:
+            failed = set()
+            while self._dirty:
+                collection = self._dirty.pop()
+
+                # items are replaced rather than mutated in place, so a shallow
+                # copy is a consistent view for the writer thread
+                data = dict(self.data[collection])
+                try:
+                    await asyncio.to_thread(
+                        atomic_write_json, self.paths[collection], data, indent=4
+                    )
+                    _log.debug("Config %s saved", collection)
+                except Exception as e:
+                    _log.error(f"Failed to save config {collection}: {e}")
+                    failed.add(collection)
+
+            # still unsaved, written again with the next flush
+            self._dirty |= failed
@@ -0,0 +1,549 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import importlib.util
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.historian import PointKey, connect, export_chunks
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# how often the rules run over the historian
+FDD_INTERVAL = 300.0
+
+# history each run evaluates, more than the interval so a fault that goes on
+# across runs is seen whole and merged with what the run before saved
+FDD_WINDOW = 3600.0
+
+# trends are resampled to this step (seconds) so the points of every
+# equipment line up, a sample is carried forward until it is FDD_STALE old
+FDD_STEP = 60.0
+FDD_STALE = 900.0
+
+# most fault intervals a report returns
+FDD_REPORT_LIMIT = 1000
+
+# equipment the rules run on, as classified by process_graph_models.py
+VAV_BOX = "Variable_Air_Volume_Box"
+
+# role -> (Brick class, object name pattern), the classes process_graph_models.py
+# gives the points, the pattern tells apart points that share a class. It
+# matches the whole name normalized like the point tagger does (upper case,
+# separators a dash), so `zn_t`, `VAV10-ZN-T` and `SPACE-TEMP` are zone temps.
+POINT_ROLES = {
+    "zone_temp": (
+        "Temperature_Sensor",
+        re.compile(r"(.*-)?(ZN|ZONE|RM|ROOM|SPC|SPACE)-?(T|TMP|TEMP)"),
+    ),
+    "discharge_temp": (
+        "Temperature_Sensor",
+        re.compile(r"(.*-)?(DA|DISCH|DISCHARGE|SA|SUPPLY)-?(AIR-?)?(T|TMP|TEMP)"),
+    ),
+    "zone_setpoint": ("Temperature_Setpoint", None),
+    "heating_valve": ("Valve_Command", None),
+    "damper": ("Damper_Command", None),
+    "airflow": ("Air_Flow_Sensor", None),
+    "airflow_setpoint": ("Air_Flow_Setpoint", None),
+}
+
+NAME_SEPARATORS = re.compile(r"[\s._\-]+")
+
+# thresholds of the rules, after the VAV terminal unit alarms of ASHRAE
+# Guideline 36, damper and valve commands in percent open
+DAMPER_FULL_OPEN = 95.0
+LOW_AIRFLOW_RATIO = 0.7
+HIGH_AIRFLOW_RATIO = 1.3
+HEATING_VALVE_OPEN = 20.0
+
+# degrees above setpoint a heating zone may drift, and off setpoint any
+# zone may drift, before it is a fault
+ZONE_HEATING_DEADBAND = 2.0
+ZONE_TEMP_ALARM = 5.0
+
+# stored per fault interval, next to the trends in the historian database
+FAULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS faults (
+    id INTEGER PRIMARY KEY,
+    rule TEXT,
+    equipment TEXT,
+    start REAL,
+    end REAL,
+    active INTEGER
+);
+CREATE INDEX IF NOT EXISTS faults_rule_equipment ON faults (rule, equipment, end);
+CREATE INDEX IF NOT EXISTS faults_start ON faults (start);
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class FaultRule:
+    """
+    A condition over the resampled trends of the points in `roles`, each an
+    array with a row per equipment and a column per step. Runs of True that
+    last `min_duration` seconds are faults.
+    """
+
+    name: str
+    description: str
+    equipment_class: str
+    roles: Tuple[str, ...]
+    condition: Callable[[Dict[str, Any]], Any]
+    min_duration: float = 300.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "equipment_class": self.equipment_class,
+            "roles": list(self.roles),
+            "min_duration": self.min_duration,
+        }
+
+
+def damper_open_low_airflow(points):
+    return (points["damper"] >= DAMPER_FULL_OPEN) & (
+        points["airflow"] < LOW_AIRFLOW_RATIO * points["airflow_setpoint"]
+    )
+
+
+def high_airflow(points):
+    return (points["airflow_setpoint"] > 0) & (
+        points["airflow"] > HIGH_AIRFLOW_RATIO * points["airflow_setpoint"]
+    )
+
+
+def heating_above_setpoint(points):
+    return (points["heating_valve"] >= HEATING_VALVE_OPEN) & (
+        points["zone_temp"] > points["zone_setpoint"] + ZONE_HEATING_DEADBAND
+    )
+
+
+def zone_temp_off_setpoint(points):
+    import numpy as np
+
+    return np.abs(points["zone_temp"] - points["zone_setpoint"]) > ZONE_TEMP_ALARM
+
+
+RULES = {
+    rule.name: rule
+    for rule in (
+        FaultRule(
+            "damper-open-low-airflow",
+            "Damper fully open but airflow below 70% of setpoint",
+            VAV_BOX,
+            ("damper", "airflow", "airflow_setpoint"),
+            damper_open_low_airflow,
+        ),
+        FaultRule(
+            "high-airflow",
+            "Airflow above 130% of setpoint",
+            VAV_BOX,
+            ("airflow", "airflow_setpoint"),
+            high_airflow,
+            min_duration=600.0,
+        ),
+        FaultRule(
+            "heating-above-setpoint",
+            "Heating valve open with the zone above setpoint",
+            VAV_BOX,
+            ("heating_valve", "zone_temp", "zone_setpoint"),
+            heating_above_setpoint,
+            min_duration=600.0,
+        ),
+        FaultRule(
+            "zone-temp-off-setpoint",
+            "Zone temperature more than 5 degrees off setpoint",
+            VAV_BOX,
+            ("zone_temp", "zone_setpoint"),
+            zone_temp_off_setpoint,
+            min_duration=600.0,
+        ),
+    )
+}
+
+
+def role_points(points: List[Dict[str, Any]]) -> Dict[str, PointKey]:
+    """Historian key of each role among the site model points of one equipment."""
+    roles: Dict[str, PointKey] = {}
+    for point in points:
+        if point["device_instance"] is None or not point["object_identifier"]:
+            continue
+        name = NAME_SEPARATORS.sub("-", (point["name"] or "").upper()).strip("-")
+        for role, (brick_class, pattern) in POINT_ROLES.items():
+            if point["brick_class"] == brick_class and (
+                pattern is None or pattern.fullmatch(name)
+            ):
+                roles.setdefault(
+                    role, (point["device_instance"], point["object_identifier"], "present-value")
+                )
+    return roles
+
+
+def resample(times, values, grid, stale: float):
+    """
+    Value of a trend at every step of the grid, the last sample at or before
+    it, NaN before the first sample and once the last one is stale.
+    """
+    import numpy as np
+
+    if len(times) == 0:
+        return np.full(len(grid), np.nan)
+    index = np.searchsorted(times, grid, side="right") - 1
+    missing = index < 0
+    index[missing] = 0
+    resampled = values[index]
+    resampled[missing | (grid - times[index] > stale)] = np.nan
+    return resampled
+
+
+def fault_runs(fault, min_steps: int):
+    """(row, first step, step after the last) of every run of True in `fault`."""
+    import numpy as np
+
+    padded = np.zeros((fault.shape[0], fault.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = fault
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    keep = ends - starts >= min_steps
+    return rows[keep], starts[keep], ends[keep]
+
+
+def evaluate_rules(
+    path: str,
+    members: Dict[str, Dict[str, Dict[str, PointKey]]],
+    end: float,
+    window: float = FDD_WINDOW,
+    step: float = FDD_STEP,
+    stale: float = FDD_STALE,
+) -> Tuple[List[Tuple[str, str, float, float, bool]], Dict[str, int]]:
+    """
+    Fault intervals (rule, equipment, start, end, active) of every rule in
+    `members` (rule -> equipment -> role -> point) over the window ending at
+    `end`, and how many equipment each rule was evaluated for. Equipment
+    with a point the historian has nothing for is left out.
+    """
+    import numpy as np
+
+    # the grid is aligned to the step so the runs evaluate the same times
+    first = math.ceil((end - window) / step) * step
+    grid = np.arange(first, end, step)
+
+    keys = {
+        key
+        for equipment in members.values()
+        for roles in equipment.values()
+        for key in roles.values()
+    }
+    samples: Dict[PointKey, Tuple[List[float], List[float]]] = {}
+    for rows in export_chunks(path, sorted(keys), first - stale, end + step):
+        for timestamp, device_instance, object_identifier, property_identifier, value in rows:
+            times, values = samples.setdefault(
+                (device_instance, object_identifier, property_identifier), ([], [])
+            )
+            times.append(timestamp)
+            values.append(value)
+    series = {
+        key: resample(np.array(times), np.array(values), grid, stale)
+        for key, (times, values) in samples.items()
+    }
+
+    intervals = []
+    evaluated = {}
+    for rule_name, equipment in members.items():
+        rule = RULES[rule_name]
+        names = sorted(
+            name
+            for name, roles in equipment.items()
+            if all(roles[role] in series for role in rule.roles)
+        )
+        evaluated[rule_name] = len(names)
+        if not names:
+            continue
+
+        # one row per equipment, the rule sees all of them at once
+        points = {
+            role: np.vstack([series[equipment[name][role]] for name in names])
+            for role in rule.roles
+        }
+        with np.errstate(invalid="ignore"):
+            fault = np.asarray(rule.condition(points), dtype=bool)
+        for values in points.values():
+            fault &= ~np.isnan(values)
+
+        min_steps = max(1, math.ceil(rule.min_duration / step))
+        for row, start, stop in zip(*fault_runs(fault, min_steps)):
+            active = stop == len(grid)
+            intervals.append(
+                (
+                    rule_name,
+                    names[row],
+                    float(grid[start]),
+                    float(grid[stop - 1] if active else grid[stop]),
+                    bool(active),
+                )
+            )
+    return intervals, evaluated
+
+
+def save_faults(
+    path: str,
+    rules: List[str],
+    intervals: List[Tuple[str, str, float, float, bool]],
+    step: float = FDD_STEP,
+) -> None:
+    """
+    Merge the intervals of a run with the saved ones they overlap or touch,
+    faults of the rules that weren't found active again are over.
+    """
+    connection = connect(path)
+    try:
+        connection.executescript(FAULTS_SCHEMA)
+        with connection:
+            connection.executemany(
+                "UPDATE faults SET active = 0 WHERE active AND rule = ?",
+                [(rule,) for rule in rules],
+            )
+            for rule, equipment, start, end, active in intervals:
+                overlapping = connection.execute(
+                    "SELECT id, start, end FROM faults WHERE rule = ? AND equipment = ? "
+                    "AND end >= ? AND start <= ?",
+                    (rule, equipment, start - step, end + step),
+                ).fetchall()
+                for _, saved_start, saved_end in overlapping:
+                    start = min(start, saved_start)
+                    end = max(end, saved_end)
+                connection.executemany(
+                    "DELETE FROM faults WHERE id = ?", [(row[0],) for row in overlapping]
+                )
+                connection.execute(
+                    "INSERT INTO faults (rule, equipment, start, end, active) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (rule, equipment, start, end, int(active)),
+                )
+    finally:
+        connection.close()
+
+
+def exit_with_parent() -> None:
+    """
+    Initializer of the worker process, it exits when the server does, also
+    when the server is killed before it could shut the worker down.
+    """
+    parent = multiprocessing.parent_process()
+
+    def watch():
+        multiprocessing.connection.wait([parent.sentinel])
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def run_rules(
+    path: str,
+    members: Dict[str, Dict[str, Dict[str, PointKey]]],
+    end: float,
+    window: float = FDD_WINDOW,
+    step: float = FDD_STEP,
+) -> Dict[str, int]:
+    """One run in the worker process, returns its counters."""
+    intervals, evaluated = evaluate_rules(path, members, end, window, step)
+    # a rule without equipment this run, its points gone from the site
+    # model, has no active faults either
+    save_faults(path, list(RULES), intervals, step)
+    return {
+        "rules": len(members),
+        "evaluations": sum(evaluated.values()),
+        "faults": len(intervals),
+        "active": sum(1 for interval in intervals if interval[4]),
+    }
+
+
+def read_faults(
+    path: str,
+    rule: Optional[str] = None,
+    equipment: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    active: Optional[bool] = None,
+    limit: int = FDD_REPORT_LIMIT,
+) -> List[Dict[str, Any]]:
+    """Saved fault intervals matching every given filter, latest first."""
+    if not os.path.exists(path):
+        return []
+    connection = connect(path, read_only=True)
+    try:
+        # no run has saved anything yet
+        if not connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'faults'"
+        ).fetchone():
+            return []
+        sql = "SELECT rule, equipment, start, end, active FROM faults WHERE 1"
+        params: List[Any] = []
+        if rule:
+            sql += " AND rule = ?"
+            params.append(rule)
+        if equipment:
+            sql += " AND equipment = ?"
+            params.append(equipment)
+        if start is not None:
+            sql += " AND end >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND start < ?"
+            params.append(end)
+        if active is not None:
+            sql += " AND active = ?"
+            params.append(int(active))
+        sql += " ORDER BY start DESC LIMIT ?"
+        params.append(limit)
+        return [
+            {
+                "rule": row[0],
+                "equipment": row[1],
+                "start": row[2],
+                "end": row[3],
+                "duration": row[3] - row[2],
+                "active": bool(row[4]),
+            }
+            for row in connection.execute(sql, params)
+        ]
+    finally:
+        connection.close()
+
+
+class FaultDetection:
+    """
+    Runs the fault rules over the last window of the historian on a
+    schedule. The equipment of each rule's Brick class and the points that
+    fill its roles come from the site model, the trends are resampled to a
+    common step and each rule is evaluated with NumPy for all its equipment
+    at once, in a worker process so the event loop and the GIL stay free.
+    Fault intervals are saved in the historian database, merged with the
+    ones earlier runs found.
+    """
+
+    def __init__(
+        self,
+        app,
+        interval: float = FDD_INTERVAL,
+        window: float = FDD_WINDOW,
+        step: float = FDD_STEP,
+    ):
+        self.app = app
+        self.interval = interval
+        self.window = window
+        self.step = step
+        self.rules = RULES
+
+        self.last_run: Optional[Dict[str, Any]] = None
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._run: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        if importlib.util.find_spec("numpy") is None:
+            _log.warning("numpy is required for fault detection, the rules won't run")
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.evaluate()
+            except Exception as e:
+                _log.error(f"Error running the fault rules: {e}")
+
+    def members(self) -> Dict[str, Dict[str, Dict[str, PointKey]]]:
+        """rule -> equipment -> role -> point, for the equipment that has every role."""
+        site_model = self.app.site_model
+        by_class: Dict[str, Dict[str, Dict[str, PointKey]]] = {}
+        members = {}
+        for rule in self.rules.values():
+            if rule.equipment_class not in by_class:
+                by_class[rule.equipment_class] = {
+                    equipment["name"]: role_points(site_model.points(equipment=equipment["name"]))
+                    for equipment in site_model.equipment(brick_class=rule.equipment_class)
+                }
+            equipment = {
+                name: roles
+                for name, roles in by_class[rule.equipment_class].items()
+                if all(role in roles for role in rule.roles)
+            }
+            if equipment:
+                members[rule.name] = equipment
+        return members
+
+    async def evaluate(self) -> Dict[str, Any]:
+        """
+        Run every rule over the window ending now, a call while a run is
+        going waits for that one.
+        """
+        if self._run is None or self._run.done():
+            self._run = asyncio.create_task(self._evaluate())
+        return await asyncio.shield(self._run)
+
+    async def _evaluate(self) -> Dict[str, Any]:
+        started = time.time()
+        members = self.members()
+
+        # samples still buffered in memory belong in the window
+        await self.app.historian.flush()
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=exit_with_parent,
+            )
+        loop = asyncio.get_running_loop()
+        try:
+            counters = await loop.run_in_executor(
+                self._executor,
+                run_rules,
+                self.app.historian.path,
+                members,
+                started,
+                self.window,
+                self.step,
+            )
+        except concurrent.futures.process.BrokenProcessPool:
+            # started again on the next run
+            self._executor = None
+            raise
+
+        self.last_run = {
+            "started": started,
+            "duration": round(time.time() - started, 3),
+            **counters,
+        }
+        _log.info(
+            "Fault rules ran for %d equipment: %d faults, %d active",
+            self.last_run["evaluations"],
+            self.last_run["faults"],
+            self.last_run["active"],
+        )
+        return self.last_run
+
+    async def report(self, **filters) -> Dict[str, Any]:
+        """The rules, the last run and the saved fault intervals matching `filters`."""
+        return {
+            "rules": [rule.to_json() for rule in self.rules.values()],
+            "run": self.last_run,
+            "faults": await asyncio.to_thread(
+                read_faults, self.app.historian.path, **filters
+            ),
+        }
+
+    def close(self) -> None:
+        # waits for the worker to exit, it won't notice the server is gone
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
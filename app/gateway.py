@@ -0,0 +1,660 @@
+"""
+Split deployment, one gateway process owns the BACnet stack (only one
+process can bind UDP 47808), the background tasks and the point store, and
+N uvicorn worker processes serve the HTTP API.
+
+Workers read point values straight out of a shared memory table the gateway
+keeps current, everything else (reads from devices, writes, Who-Is, config
+edits) goes to the gateway as newline delimited JSON over a unix socket.
+
+A large campus can spread the field bus over several BACnet stacks, each
+one its own process bound to its own interface, port or BBMD (a shard, see
+app.shards) with its own gateway socket and point table. The workers route
+every device to the stack whose registry has it.
+
+$ python -m app.main --workers 4
+$ python -m app.main --workers 4 --address 10.0.1.5/24 --shard 10.0.2.5/24 \
+    --shard "10.0.3.5/24 --foreign 10.0.3.1 --ttl 60"
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.join(os.path.dirname(__file__), "..")
+GATEWAY_SOCKET_PATH = os.path.join(PROJECT_DIR, "freebas_gateway.sock")
+
+# slots in the shared point table, a point needs one slot per property
+POINT_TABLE_SLOTS = 65536
+
+# the table counts as full at this load, so lookups stay short
+POINT_TABLE_MAX_LOAD = 0.9
+
+# how often values that aren't points (local object version) are copied
+# into the shared table header
+HEADER_SYNC_INTERVAL = 0.1
+
+# environment variables the gateway hands to the uvicorn workers, the
+# point table and historian of each stack come with its hello event
+ENV_SOCKET = "FREEBAS_GATEWAY_SOCKET"
+ENV_SHARD_SOCKETS = "FREEBAS_SHARD_SOCKETS"
+ENV_SESSION_SECRET = "FREEBAS_SESSION_SECRET"
+
+# how long a shard process gets to bring up its BACnet stack and gateway
+SHARD_START_TIMEOUT = 30.0
+
+TABLE_MAGIC = b"FREEBAS1"
+
+# magic, capacity, full flag, local objects version, ETag epoch
+HEADER = struct.Struct("<8sIIQ8s")
+HEADER_SIZE = 64
+
+# sequence (odd while the gateway writes), version, timestamp, flags, key
+# length, value length, key, JSON value
+SLOT_KEY_SIZE = 64
+SLOT_VALUE_SIZE = 168
+SLOT = struct.Struct(f"<IQdBBH{SLOT_KEY_SIZE}s{SLOT_VALUE_SIZE}s")
+SLOT_SEQUENCE = struct.Struct("<I")
+
+SLOT_USED = 0x01
+SLOT_STALE = 0x02
+SLOT_OVERFLOW = 0x04  # the value didn't fit, ask the gateway for it
+
+# tries at a consistent copy of a slot the gateway is writing, a gateway
+# that died mid-write leaves the sequence odd for good
+SLOT_READ_RETRIES = 100
+
+# returned by lookup() when the point is known but has to be read over RPC
+REMOTE = object()
+
+# (device instance, object identifier, property identifier)
+PointKey = Tuple[int, str, str]
+
+
+def point_key(key: PointKey) -> bytes:
+    return "/".join(map(str, key)).encode()
+
+
+class SharedPointTable:
+    """
+    Open addressing hash table of point cache entries in shared memory,
+    written only by the gateway. Each slot is guarded by a sequence counter
+    so readers in other processes retry instead of seeing a half written
+    entry, no locks are shared between processes.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        self.memory = memory
+        self.owner = owner
+        self.buffer = memory.buf
+        magic, self.capacity, _, _, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError(f"not a point table: {memory.name}")
+
+        # gateway side, key -> slot index of every published point
+        self._slots: Dict[bytes, int] = {}
+
+    @classmethod
+    def create(cls, epoch: str, capacity: int = POINT_TABLE_SLOTS) -> "SharedPointTable":
+        memory = shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + capacity * SLOT.size
+        )
+        HEADER.pack_into(memory.buf, 0, TABLE_MAGIC, capacity, 0, 0, epoch.encode())
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedPointTable":
+        if sys.version_info >= (3, 13):
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            memory = shared_memory.SharedMemory(name=name)
+            # the resource tracker would unlink the block when a worker exits,
+            # it belongs to the gateway
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return cls(memory, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def epoch(self) -> str:
+        return HEADER.unpack_from(self.buffer, 0)[4].decode()
+
+    @property
+    def full(self) -> bool:
+        return bool(HEADER.unpack_from(self.buffer, 0)[2])
+
+    @property
+    def local_objects_version(self) -> int:
+        return HEADER.unpack_from(self.buffer, 0)[3]
+
+    def set_header(self, local_objects_version: int, full: Optional[bool] = None) -> None:
+        magic, capacity, old_full, _, epoch = HEADER.unpack_from(self.buffer, 0)
+        full = old_full if full is None else int(full)
+        HEADER.pack_into(
+            self.buffer, 0, magic, capacity, full, local_objects_version, epoch
+        )
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * SLOT.size
+
+    def publish(self, key: PointKey, entry: Dict[str, Any]) -> None:
+        """Write a point cache entry, PointCache calls this on every update."""
+        encoded_key = point_key(key)
+        if len(encoded_key) > SLOT_KEY_SIZE:
+            return
+
+        index = self._slots.get(encoded_key)
+        if index is None:
+            if len(self._slots) >= self.capacity * POINT_TABLE_MAX_LOAD:
+                if not self.full:
+                    _log.warning("Shared point table is full, workers fall back to RPC")
+                    self.set_header(self.local_objects_version, full=True)
+                return
+            index = zlib.crc32(encoded_key) % self.capacity
+            while SLOT.unpack_from(self.buffer, self._offset(index))[3] & SLOT_USED:
+                index = (index + 1) % self.capacity
+            self._slots[encoded_key] = index
+
+        value = json.dumps(entry["value"], separators=(",", ":")).encode()
+        flags = SLOT_USED | (SLOT_STALE if entry["stale"] else 0)
+        if len(value) > SLOT_VALUE_SIZE:
+            flags |= SLOT_OVERFLOW
+            value = b""
+
+        offset = self._offset(index)
+        sequence = SLOT_SEQUENCE.unpack_from(self.buffer, offset)[0]
+        writing = (sequence + 1) & 0xFFFFFFFF
+        SLOT_SEQUENCE.pack_into(self.buffer, offset, writing)
+        SLOT.pack_into(
+            self.buffer,
+            offset,
+            writing,
+            entry["version"],
+            entry["timestamp"],
+            flags,
+            len(encoded_key),
+            len(value),
+            encoded_key,
+            value,
+        )
+        SLOT_SEQUENCE.pack_into(self.buffer, offset, (writing + 1) & 0xFFFFFFFF)
+
+    def _read_slot(self, offset: int) -> Optional[tuple]:
+        """A consistent copy of a slot, None if it kept changing under the read."""
+        for _ in range(SLOT_READ_RETRIES):
+            before = SLOT_SEQUENCE.unpack_from(self.buffer, offset)[0]
+            if before & 1:
+                continue
+            slot = SLOT.unpack_from(self.buffer, offset)
+            if SLOT_SEQUENCE.unpack_from(self.buffer, offset)[0] == before:
+                return slot
+        return None
+
+    def lookup(self, key: PointKey):
+        """
+        The entry of a point, None when it isn't cached and REMOTE when only
+        the gateway can answer (value too big for a slot, table full).
+        """
+        encoded_key = point_key(key)
+        if len(encoded_key) > SLOT_KEY_SIZE:
+            return REMOTE
+
+        index = zlib.crc32(encoded_key) % self.capacity
+        for _ in range(self.capacity):
+            slot = self._read_slot(self._offset(index))
+            if slot is None:
+                return REMOTE
+            _, version, timestamp, flags, key_length, value_length, slot_key, value = slot
+            if not flags & SLOT_USED:
+                return REMOTE if self.full else None
+            if slot_key[:key_length] == encoded_key:
+                if flags & SLOT_OVERFLOW:
+                    return REMOTE
+                return {
+                    "value": json.loads(value[:value_length]),
+                    "timestamp": timestamp,
+                    "stale": bool(flags & SLOT_STALE),
+                    "version": version,
+                }
+            index = (index + 1) % self.capacity
+        return REMOTE
+
+    def close(self) -> None:
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def http_error(e: Exception) -> Dict[str, Any]:
+    if isinstance(e, HTTPException):
+        error = {"status_code": e.status_code, "detail": e.detail}
+        # Retry-After of a device that fails fast
+        if e.headers:
+            error["headers"] = dict(e.headers)
+        return error
+    return {"status_code": 500, "detail": f"gateway error: {e}"}
+
+
+class GatewayServer:
+    """
+    The gateway side of the unix socket. Requests are
+    `{"id", "method", "args"}`, answered with `{"id", "result"}` or
+    `{"id", "error"}`; streaming methods send `{"id", "item"}` lines before
+    the result and stop on a `cancel` request. Config changes are pushed to
+    every worker as events.
+    """
+
+    def __init__(
+        self,
+        app,
+        socket_path: str = GATEWAY_SOCKET_PATH,
+        point_slots: int = POINT_TABLE_SLOTS,
+    ):
+        self.app = app
+        self.socket_path = socket_path
+        self.point_slots = point_slots
+        self.point_table: Optional[SharedPointTable] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        self.connections: Dict[asyncio.StreamWriter, asyncio.Lock] = {}
+
+        config_store = app.config_store
+        self.methods = {
+            "read_property": app.read_property,
+            "write_property": app.write_property,
+            "who_is": app.who_is,
+            "devices": app.devices,
+            "device": app.device,
+            "config": app.config,
+            "cached_property": app.cached_property,
+            "poller_stats": app.poller_stats,
+            "poll_plan": app.poll_plan,
+            "device_health": app.device_health,
+            "read_stats": app.read_stats,
+            "scan_overrides": app.scan_overrides,
+            "override_report": app.override_report,
+            "backfill_trend_logs": app.backfill_trend_logs,
+            "trend_log_report": app.trend_log_report,
+            "run_fault_rules": app.run_fault_rules,
+            "fault_report": app.fault_report,
+            "historian_flush": self.historian_flush,
+            "config_put": config_store.put,
+            "config_put_item": config_store.put_item,
+            "config_delete_item": config_store.delete_item,
+        }
+        self.stream_methods = {"who_is_sweep": app.who_is_sweep}
+
+        config_store.listeners.append(self.config_changed)
+
+    async def start(self) -> None:
+        """Publish the point cache to a new shared table and start listening."""
+        self.point_table = SharedPointTable.create(self.app.etag_epoch, self.point_slots)
+        self.app.point_cache.mirror = self.point_table
+        self.app.point_cache.publish_all()
+        self.point_table.set_header(self.app.local_objects_version)
+        self._sync_task = asyncio.create_task(self.sync_header())
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        # only this user's processes may drive the BACnet stack
+        os.chmod(self.socket_path, 0o600)
+        _log.info("Gateway listening on %s", self.socket_path)
+
+    async def close(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.connections):
+            writer.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self._sync_task:
+            self._sync_task.cancel()
+        if self.point_table:
+            self.app.point_cache.mirror = None
+            self.point_table.close()
+            self.point_table = None
+
+    async def historian_flush(self) -> None:
+        if self.app.historian:
+            await self.app.historian.flush()
+
+    async def send(self, writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+        lock = self.connections.get(writer)
+        if lock is None:
+            return
+        async with lock:
+            writer.write(json.dumps(message, default=str).encode() + b"\n")
+            await writer.drain()
+
+    def config_event(self, collection: str) -> Dict[str, Any]:
+        config_store = self.app.config_store
+        return {
+            "event": "config",
+            "collection": collection,
+            "data": config_store.get(collection),
+            "version": config_store.version(collection),
+        }
+
+    def config_changed(self, collection: str) -> None:
+        event = self.config_event(collection)
+        for writer in list(self.connections):
+            asyncio.create_task(self.send(writer, event))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections[writer] = asyncio.Lock()
+        tasks: Dict[int, asyncio.Task] = {}
+        try:
+            # the configuration first, the worker starts serving on hello
+            for collection in self.app.config_store.data:
+                await self.send(writer, self.config_event(collection))
+            await self.send(writer, {
+                "event": "hello",
+                "epoch": self.app.etag_epoch,
+                "point_table": self.point_table.name,
+                "historian": self.app.historian.path if self.app.historian else None,
+            })
+
+            while line := await reader.readline():
+                request = json.loads(line)
+                if request["method"] == "cancel":
+                    task = tasks.get(request["args"][0])
+                    if task:
+                        task.cancel()
+                    continue
+
+                task = asyncio.create_task(self.dispatch(writer, request))
+                tasks[request["id"]] = task
+                task.add_done_callback(
+                    lambda _, request_id=request["id"]: tasks.pop(request_id, None)
+                )
+        except (ConnectionError, ValueError) as e:
+            _log.error(f"Gateway connection failed: {e}")
+        finally:
+            for task in list(tasks.values()):
+                task.cancel()
+            del self.connections[writer]
+            writer.close()
+
+    async def dispatch(self, writer: asyncio.StreamWriter, request: Dict[str, Any]):
+        request_id = request["id"]
+        method = request["method"]
+        args = request.get("args", [])
+        stream = self.stream_methods.get(method)
+        function = self.methods.get(method)
+        if stream is None and function is None:
+            await self.send(writer, {"id": request_id, "error": http_error(
+                HTTPException(status_code=400, detail=f"unknown method: {method}")
+            )})
+            return
+        try:
+            if stream is not None:
+                async for item in stream(*args):
+                    await self.send(writer, {"id": request_id, "item": item})
+                result = None
+            else:
+                result = function(*args)
+                if asyncio.iscoroutine(result):
+                    result = await result
+        except Exception as e:
+            await self.send(writer, {"id": request_id, "error": http_error(e)})
+            return
+        await self.send(writer, {"id": request_id, "result": result})
+
+    async def sync_header(self) -> None:
+        while True:
+            table = self.point_table
+            if table.local_objects_version != self.app.local_objects_version:
+                table.set_header(self.app.local_objects_version)
+            await asyncio.sleep(HEADER_SYNC_INTERVAL)
+
+
+class GatewayClient:
+    """
+    A worker's connection to the gateway, calls are multiplexed on one
+    socket by request id.
+    """
+
+    def __init__(self, socket_path: str, on_event=None):
+        self.socket_path = socket_path
+        self.on_event = on_event
+        # from the gateway's hello
+        self.epoch: Optional[str] = None
+        self.point_table: Optional[str] = None
+        self.historian: Optional[str] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Any] = {}
+        self._reader_task: Optional[asyncio.Task] = None
+        self._hello = None
+        self._closing = False
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+        self._hello = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.create_task(self._read())
+        await self._hello
+
+    async def wait_closed(self) -> None:
+        """Wait until the gateway closes the connection."""
+        if self._reader_task:
+            await asyncio.wait([self._reader_task])
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    async def _read(self) -> None:
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if "event" in message:
+                    if message["event"] == "hello":
+                        self.epoch = message["epoch"]
+                        self.point_table = message["point_table"]
+                        self.historian = message["historian"]
+                        self._hello.set_result(None)
+                    elif self.on_event:
+                        self.on_event(message)
+                    continue
+
+                waiter = self._pending.get(message["id"])
+                if waiter is None:
+                    continue
+                if isinstance(waiter, asyncio.Queue):
+                    waiter.put_nowait(message)
+                    if "item" not in message:
+                        del self._pending[message["id"]]
+                else:
+                    del self._pending[message["id"]]
+                    if not waiter.done():
+                        waiter.set_result(message)
+        finally:
+            if not self._closing:
+                _log.error("Gateway connection closed")
+            lost = {"error": {"status_code": 503, "detail": "gateway unavailable"}}
+            for waiter in self._pending.values():
+                if isinstance(waiter, asyncio.Queue):
+                    waiter.put_nowait(lost)
+                elif not waiter.done():
+                    waiter.set_result(lost)
+            self._pending.clear()
+
+    def _send(self, method: str, args: tuple, waiter=None) -> int:
+        if self.writer is None or self.writer.is_closing():
+            raise HTTPException(status_code=503, detail="gateway unavailable")
+        request_id = next(self._ids)
+        if waiter is not None:
+            self._pending[request_id] = waiter
+        self.writer.write(
+            json.dumps({"id": request_id, "method": method, "args": args}).encode() + b"\n"
+        )
+        return request_id
+
+    @staticmethod
+    def _result(message: Dict[str, Any]) -> Any:
+        if "error" in message:
+            raise HTTPException(**message["error"])
+        return message.get("result")
+
+    async def call(self, method: str, *args) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._send(method, args, future)
+        await self.writer.drain()
+        return self._result(await future)
+
+    async def stream(self, method: str, *args) -> AsyncIterator[Any]:
+        queue: asyncio.Queue = asyncio.Queue()
+        request_id = self._send(method, args, queue)
+        await self.writer.drain()
+        try:
+            while True:
+                message = await queue.get()
+                if "item" not in message:
+                    self._result(message)
+                    return
+                yield message["item"]
+        finally:
+            # the consumer went away early, e.g. the HTTP client disconnected
+            if self._pending.pop(request_id, None) is not None:
+                self._send("cancel", (request_id,))
+
+    def notify(self, method: str, *args) -> None:
+        """Call without waiting for the answer, errors are only logged."""
+
+        async def call():
+            try:
+                await self.call(method, *args)
+            except HTTPException as e:
+                _log.error(f"Gateway {method} failed: {e.detail}")
+
+        asyncio.create_task(call())
+
+
+def shard_socket_path(socket_path: str, index: int) -> str:
+    root, ext = os.path.splitext(socket_path)
+    return f"{root}-shard{index}{ext}"
+
+
+async def start_shard(command: List[str], socket_path: str) -> asyncio.subprocess.Process:
+    """Start a shard process and wait until its gateway socket is up."""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    process = await asyncio.create_subprocess_exec(*command)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHARD_START_TIMEOUT
+    while not os.path.exists(socket_path):
+        if process.returncode is not None or loop.time() > deadline:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise RuntimeError(f"shard {socket_path} did not start")
+        await asyncio.sleep(0.1)
+    return process
+
+
+async def stop_processes(processes: List[asyncio.subprocess.Process]) -> None:
+    for process in processes:
+        if process.returncode is None:
+            process.terminate()
+    for process in processes:
+        await process.wait()
+
+
+async def serve_split(
+    app,
+    workers: int,
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    log_level: str = "info",
+    socket_path: str = GATEWAY_SOCKET_PATH,
+    point_slots: int = POINT_TABLE_SLOTS,
+    shards: Optional[List[List[str]]] = None,
+) -> None:
+    """
+    Run `app` (a FreeBasApplication) as the gateway and serve the API from
+    `workers` uvicorn worker processes until they exit. Every item of
+    `shards` starts one more BACnet stack, `python -m app.shards` with
+    those arguments.
+    """
+    gateway = GatewayServer(app, socket_path, point_slots)
+    await gateway.start()
+
+    # shards follow this gateway's configuration, so they start after it
+    shard_processes = []
+    shard_sockets = []
+    try:
+        for index, shard_args in enumerate(shards or [], start=1):
+            shard_socket = shard_socket_path(socket_path, index)
+            command = [
+                sys.executable, "-m", "app.shards",
+                "--primary-socket", socket_path,
+                "--gateway-socket", shard_socket,
+                "--point-slots", str(point_slots),
+                *shard_args,
+            ]
+            shard_processes.append(await start_shard(command, shard_socket))
+            shard_sockets.append(shard_socket)
+    except RuntimeError:
+        await stop_processes(shard_processes)
+        await gateway.close()
+        await app.shutdown()
+        raise
+
+    env = dict(
+        os.environ,
+        **{
+            ENV_SOCKET: socket_path,
+            ENV_SHARD_SOCKETS: os.pathsep.join(shard_sockets),
+            ENV_SESSION_SECRET: app.session_secret,
+        },
+    )
+
+    command: List[str] = [
+        sys.executable, "-m", "uvicorn", "app.worker:create_worker_app", "--factory",
+        "--workers", str(workers),
+        "--host", host,
+        "--port", str(port),
+        "--log-level", log_level,
+    ]
+    if app.ssl_certfile and app.ssl_keyfile:
+        command += ["--ssl-certfile", app.ssl_certfile, "--ssl-keyfile", app.ssl_keyfile]
+
+    process = await asyncio.create_subprocess_exec(*command, env=env)
+
+    # stopping the gateway stops the workers first, then cleans up
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, process.terminate)
+    try:
+        await process.wait()
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        await stop_processes(shard_processes)
+        await gateway.close()
+        await app.shutdown()
@@ -0,0 +1,235 @@
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import math
+import time
+from typing import Any, Dict, Optional
+
+from bacpypes3.apdu import AbortPDU, ErrorRejectAbortNack
+from bacpypes3.pdu import Address
+from bacpypes3.primitivedata import ObjectIdentifier
+from fastapi import HTTPException
+
+from app.registry import OFFLINE
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# timeouts in a row that open the circuit of a device, each one of them
+# already waited out the APDU timeout and its retries
+OPEN_AFTER_TIMEOUTS = 2
+
+# first check of an open circuit, the wait doubles after every check the
+# device doesn't answer
+PROBE_INTERVAL = 10.0
+PROBE_MAX_INTERVAL = 600.0
+
+# how often the open circuits are looked at for checks that are due
+PROBE_TICK = 1.0
+
+# weight of the latest request in a device's timeout rate
+RATE_SMOOTHING = 0.2
+
+# circuit states
+CLOSED = "closed"
+OPEN = "open"
+
+
+def timed_out(err: Exception) -> bool:
+    """True for the abort bacpypes3 raises when a device never answered."""
+    return isinstance(err, AbortPDU) and str(err) == "no-response"
+
+
+@dataclasses.dataclass
+class DeviceHealth:
+    device_instance: int
+    state: str = CLOSED
+    answers: int = 0
+    timeouts: int = 0
+    timeouts_in_a_row: int = 0
+    timeout_rate: float = 0.0
+    failed_fast: int = 0  # requests refused while the circuit was open
+    last_answer: Optional[float] = None
+    last_timeout: Optional[float] = None
+    opened_at: Optional[float] = None
+    probe_interval: float = PROBE_INTERVAL
+    next_probe: float = 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "device_instance": self.device_instance,
+            "state": self.state,
+            "answers": self.answers,
+            "timeouts": self.timeouts,
+            "timeout_rate": round(self.timeout_rate, 3),
+            "failed_fast": self.failed_fast,
+            "last_answer": self.last_answer,
+            "last_timeout": self.last_timeout,
+            "opened_at": self.opened_at,
+            "next_probe": self.next_probe if self.state == OPEN else None,
+        }
+
+
+class HealthMonitor:
+    """
+    Answers and timeouts of every device the app reads or writes, and a
+    circuit breaker per device. After OPEN_AFTER_TIMEOUTS timeouts in a row
+    the circuit opens, reads and writes to the device fail at once with a
+    503 instead of waiting out the APDU timeout again, and the device is
+    checked in the background by reading its object identifier, less often
+    the longer it stays quiet. The circuit closes as soon as the device
+    answers that read, or an I-Am from it comes in.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.devices: Dict[int, DeviceHealth] = {}
+        self._probes: Dict[int, asyncio.Task] = {}
+
+    def _health(self, device_instance: int) -> DeviceHealth:
+        health = self.devices.get(device_instance)
+        if health is None:
+            health = self.devices[device_instance] = DeviceHealth(device_instance)
+        return health
+
+    def check(self, device_instance: int) -> None:
+        """Raise a 503 right away while the device's circuit is open."""
+        health = self.devices.get(device_instance)
+        if health is None or health.state == CLOSED:
+            return
+
+        # an I-Am since the circuit opened, the device is back
+        record = self.app.registry.get(device_instance)
+        if record is not None and record.last_seen > health.opened_at:
+            self._close(health)
+            return
+
+        health.failed_fast += 1
+        retry = max(0.0, health.next_probe - time.time())
+        raise HTTPException(
+            status_code=503,
+            detail=f"device offline: {device_instance}, next check in {retry:.0f}s",
+            headers={"Retry-After": str(math.ceil(retry))},
+        )
+
+    @contextlib.contextmanager
+    def track(self, device_instance: int):
+        """Check the circuit, then count how the request in the block went."""
+        self.check(device_instance)
+        try:
+            yield
+        except ErrorRejectAbortNack as err:
+            # an error or a reject is an answer all the same
+            if timed_out(err):
+                self.timed_out(device_instance)
+            else:
+                self.answered(device_instance)
+            raise
+        self.answered(device_instance)
+
+    def answered(self, device_instance: int) -> None:
+        health = self._health(device_instance)
+        health.answers += 1
+        health.timeouts_in_a_row = 0
+        health.timeout_rate *= 1 - RATE_SMOOTHING
+        health.last_answer = time.time()
+        if health.state == OPEN:
+            self._close(health)
+
+    def timed_out(self, device_instance: int) -> None:
+        health = self._health(device_instance)
+        health.timeouts += 1
+        health.timeouts_in_a_row += 1
+        health.timeout_rate = RATE_SMOOTHING + (1 - RATE_SMOOTHING) * health.timeout_rate
+        health.last_timeout = time.time()
+        if health.state == CLOSED and health.timeouts_in_a_row >= OPEN_AFTER_TIMEOUTS:
+            self._open(health)
+
+    def _open(self, health: DeviceHealth) -> None:
+        _log.info(
+            "Device %r timed out %d times in a row, failing fast",
+            health.device_instance,
+            health.timeouts_in_a_row,
+        )
+        health.state = OPEN
+        health.opened_at = time.time()
+        health.probe_interval = PROBE_INTERVAL
+        health.next_probe = health.opened_at + health.probe_interval
+        if self.app.registry.get(health.device_instance):
+            self.app.registry.upsert(health.device_instance, status=OFFLINE)
+
+    def _close(self, health: DeviceHealth) -> None:
+        _log.info("Device %r answers again", health.device_instance)
+        health.state = CLOSED
+        health.opened_at = None
+        health.timeouts_in_a_row = 0
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(PROBE_TICK)
+            now = time.time()
+            due = [
+                health
+                for health in self.devices.values()
+                if health.state == OPEN
+                and health.next_probe <= now
+                and health.device_instance not in self._probes
+            ]
+            for health in due:
+                task = asyncio.create_task(self.probe(health))
+                self._probes[health.device_instance] = task
+                task.add_done_callback(
+                    lambda _, device_instance=health.device_instance: self._probes.pop(
+                        device_instance, None
+                    )
+                )
+
+    async def probe(self, health: DeviceHealth) -> None:
+        """Read the object identifier of a device with an open circuit."""
+        device_instance = health.device_instance
+        record = self.app.registry.get(device_instance)
+        try:
+            if record is None:
+                answered = bool(
+                    await self.app.bacnet_app.who_is(device_instance, device_instance)
+                )
+            else:
+                await self.app.bacnet_app.read_property(
+                    Address(record.address),
+                    ObjectIdentifier(("device", device_instance)),
+                    "object-identifier",
+                )
+                answered = True
+        except ErrorRejectAbortNack as err:
+            answered = not timed_out(err)
+        except Exception as e:
+            _log.error(f"Error checking device {device_instance}: {e}")
+            answered = False
+
+        if health.state != OPEN:
+            # answered something else in the meantime
+            return
+        if answered:
+            self.app.registry.seen(device_instance)
+            self.answered(device_instance)
+            return
+        self.timed_out(device_instance)
+        health.probe_interval = min(health.probe_interval * 2, PROBE_MAX_INTERVAL)
+        health.next_probe = time.time() + health.probe_interval
+        _log.debug(
+            "Device %r still offline, next check in %.0fs",
+            device_instance,
+            health.probe_interval,
+        )
+
+    def report(self, state: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "open": sum(1 for health in self.devices.values() if health.state == OPEN),
+            "devices": [
+                self.devices[device_instance].to_json()
+                for device_instance in sorted(self.devices)
+                if state is None or self.devices[device_instance].state == state
+            ],
+        }
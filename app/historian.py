@@ -0,0 +1,1124 @@
+"""
+Trend historian, every numeric point value read from the field bus is kept
+in a local SQLite database and can be exported as CSV, Parquet or Arrow.
+
+New samples are written as plain rows, once a point has CHUNK_SAMPLES of
+them the oldest are compressed into one chunk (see app.tscodec), which
+takes a few bytes per sample instead of a row of two doubles.
+
+Samples read back from the trend logs in the devices (see app.backfill) go
+into the same tables, together with how far each log has been read.
+
+Hourly and daily rollups (count, sum, extremes and the time the value was
+not zero, the runtime of a fan or pump) are kept up to date in the same
+transaction as the samples. Samples newer than the last one rolled up for
+their point are added to their buckets, older ones (trend log backfill, a
+replaced sample) have the buckets around them computed again from the
+samples. Aggregate queries read the coarsest rollup that fits the
+resolution asked for and only fall back to the samples when none does.
+
+Exports walk the database in fixed size chunks so memory use doesn't depend
+on the time range, the web app streams them and the same code backs the CLI.
+
+$ python -m app.historian --start 2024-01-01 --end 2024-04-01 -o q1.csv
+$ python -m app.historian --point 201201/analog-input,2 --format parquet -o ahu.parquet
+$ python -m app.historian --point 201201/analog-input,2 --resolution 86400 -o daily.csv
+"""
+
+import argparse
+import asyncio
+import bisect
+import csv
+import datetime
+import functools
+import heapq
+import io
+import itertools
+import logging
+import math
+import os
+import sqlite3
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from app.tscodec import TIMESTAMP_SCALE, decode_chunk, encode_chunk
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# how often recorded samples are written to the database
+HISTORIAN_FLUSH_INTERVAL = 5.0
+
+# samples of one point compressed together, a day of one minute polls
+CHUNK_SAMPLES = 1440
+
+# rows per chunk when exporting, also the Parquet row group size
+EXPORT_CHUNK_SIZE = 10000
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# bucket length of the rollups in seconds, hours are counted in epoch time
+# and days from local midnight
+ROLLUP_RESOLUTIONS = {"hour": 3600, "day": 86400}
+
+# longest a sample is taken to hold its value for the runtime, a longer gap
+# to the next sample is missing data
+ROLLUP_MAX_GAP = 900.0
+
+ROLLUP_COLUMNS = (
+    "bucket",
+    "device_instance",
+    "object_identifier",
+    "property_identifier",
+    "count",
+    "mean",
+    "min",
+    "max",
+    "runtime_hours",
+)
+
+EXPORT_COLUMNS = (
+    "timestamp",
+    "device_instance",
+    "object_identifier",
+    "property_identifier",
+    "value",
+)
+
+PROJECT_DIR = os.path.join(os.path.dirname(__file__), "..")
+HISTORIAN_PATH = os.path.join(PROJECT_DIR, "historian.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    id INTEGER PRIMARY KEY,
+    device_instance INTEGER,
+    object_identifier TEXT,
+    property_identifier TEXT,
+    UNIQUE (device_instance, object_identifier, property_identifier)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    point_id INTEGER,
+    timestamp REAL,
+    value REAL,
+    PRIMARY KEY (point_id, timestamp)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chunks (
+    point_id INTEGER,
+    start REAL,
+    end REAL,
+    count INTEGER,
+    data BLOB
+);
+CREATE INDEX IF NOT EXISTS chunks_point_start ON chunks (point_id, start);
+CREATE TABLE IF NOT EXISTS rollups (
+    point_id INTEGER,
+    resolution TEXT,
+    bucket REAL,
+    count INTEGER,
+    sum REAL,
+    min REAL,
+    max REAL,
+    runtime REAL,
+    PRIMARY KEY (point_id, resolution, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_positions (
+    point_id INTEGER PRIMARY KEY,
+    timestamp REAL,
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS trend_logs (
+    device_instance INTEGER,
+    object_identifier TEXT,
+    sequence INTEGER,
+    timestamp REAL,
+    PRIMARY KEY (device_instance, object_identifier)
+) WITHOUT ROWID;
+"""
+
+# (device instance, object identifier, property identifier)
+PointKey = Tuple[int, str, str]
+
+# (device instance, object identifier) of a trend log
+TrendLogKey = Tuple[int, str]
+
+# binary and multi-state values as they come out of atomic_encode
+BINARY_VALUES = {"inactive": 0.0, "active": 1.0}
+
+
+def sample_value(value: Any) -> Optional[float]:
+    """The value as a number for the historian, None if it isn't trendable."""
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        return BINARY_VALUES.get(value)
+    return None
+
+
+def parse_point(spec: str) -> PointKey:
+    """
+    `device/object-identifier[/property]` as used in the export query,
+    the property defaults to present-value.
+    """
+    parts = spec.split("/")
+    if len(parts) not in (2, 3) or not parts[0].isdigit():
+        raise ValueError(f"point must be device/object[/property]: {spec}")
+    property_identifier = parts[2] if len(parts) == 3 else "present-value"
+    return int(parts[0]), parts[1], property_identifier
+
+
+@functools.lru_cache(maxsize=1024)
+def day_bounds(day: datetime.date) -> Tuple[float, float]:
+    """Start and end of a local day, 23 or 25 hours long on DST changes."""
+    start = datetime.datetime.combine(day, datetime.time())
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    return start.timestamp(), end.timestamp()
+
+
+def rollup_bucket(timestamp: float, resolution: str) -> Tuple[float, float]:
+    """Start and end of the rollup bucket a timestamp falls in."""
+    if resolution == "hour":
+        start = timestamp - timestamp % ROLLUP_RESOLUTIONS["hour"]
+        return start, start + ROLLUP_RESOLUTIONS["hour"]
+    return day_bounds(datetime.date.fromtimestamp(timestamp))
+
+
+def bucket_totals(
+    samples: Iterable[Tuple[float, float]],
+    start: float,
+    end: float,
+    newest: float = float("inf"),
+) -> list:
+    """
+    [count, sum, min, max, runtime] of the samples in [start, end), from
+    samples in time order that reach ROLLUP_MAX_GAP past both ends, so the
+    runtime of values held across the ends counts. A value is held until
+    the next sample, that of the point's newest sample once there is one.
+    """
+    count = 0
+    total = 0.0
+    low = high = None
+    runtime = 0.0
+    previous = None
+    for timestamp, value in samples:
+        if previous is not None and previous[1]:
+            held = min(timestamp, previous[0] + ROLLUP_MAX_GAP, end) - max(previous[0], start)
+            if held > 0:
+                runtime += held
+        if start <= timestamp < end:
+            count += 1
+            total += value
+            low = value if low is None else min(low, value)
+            high = value if high is None else max(high, value)
+        previous = (timestamp, value)
+
+    # the next sample is past the end, the value was held for the longest gap
+    if previous is not None and previous[1] and previous[0] < newest:
+        held = min(previous[0] + ROLLUP_MAX_GAP, end) - max(previous[0], start)
+        if held > 0:
+            runtime += held
+    return [count, total, low, high, runtime]
+
+
+def connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        # a streamed export resumes on whichever threadpool thread is free,
+        # the connection is only ever used by one iterator at a time
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # readers (exports) don't block the writer and the other way around
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Historian:
+    """
+    Buffers samples in memory on the event loop and writes them in batches
+    from a worker thread.
+    """
+
+    def __init__(
+        self,
+        path: str = HISTORIAN_PATH,
+        flush_interval: float = HISTORIAN_FLUSH_INTERVAL,
+        chunk_samples: int = CHUNK_SAMPLES,
+    ):
+        self.path = path
+        # every database an export reads, the split deployment with several
+        # BACnet stacks has one per stack
+        self.paths = [path]
+        self.flush_interval = flush_interval
+        self.chunk_samples = chunk_samples
+        self.pending: List[Tuple[PointKey, float, float]] = []
+        self._connection: Optional[sqlite3.Connection] = None
+        self._point_ids: Dict[PointKey, int] = {}
+
+        # point id -> samples not compressed yet, an upper bound since a
+        # sample can replace one with the same timestamp
+        self._raw_counts: Dict[int, int] = {}
+
+        # point id -> (timestamp, value) of the newest sample rolled up
+        self._rollup_positions: Dict[int, Tuple[float, float]] = {}
+        self._flush_lock = asyncio.Lock()
+
+    def record(
+        self,
+        device_instance: int,
+        object_identifier: str,
+        property_identifier: str,
+        value: Any,
+        timestamp: float,
+    ) -> None:
+        value = sample_value(value)
+        if value is None:
+            return
+        key = (device_instance, object_identifier, property_identifier)
+        self.pending.append((key, timestamp, value))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self.write, batch)
+                _log.debug("Historian wrote %d samples", len(batch))
+            except Exception as e:
+                _log.error(f"Failed to write {len(batch)} historian samples: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = connect(self.path)
+            self._raw_counts = dict(
+                self._connection.execute(
+                    "SELECT point_id, COUNT(*) FROM samples GROUP BY point_id"
+                ).fetchall()
+            )
+            self._rollup_positions = {
+                row[0]: (row[1], row[2])
+                for row in self._connection.execute("SELECT * FROM rollup_positions")
+            }
+            self._roll_up_existing(self._connection)
+        return self._connection
+
+    def _point_id(self, connection: sqlite3.Connection, key: PointKey) -> int:
+        point_id = self._point_ids.get(key)
+        if point_id is None:
+            connection.execute(
+                "INSERT OR IGNORE INTO points "
+                "(device_instance, object_identifier, property_identifier) "
+                "VALUES (?, ?, ?)",
+                key,
+            )
+            point_id = connection.execute(
+                "SELECT id FROM points WHERE device_instance = ? "
+                "AND object_identifier = ? AND property_identifier = ?",
+                key,
+            ).fetchone()[0]
+            self._point_ids[key] = point_id
+        return point_id
+
+    def _compress_full(self, connection: sqlite3.Connection, point_ids) -> None:
+        for point_id in point_ids:
+            while self._raw_counts.get(point_id, 0) >= self.chunk_samples:
+                if not self.compress(connection, point_id):
+                    break
+
+    def write(self, batch: List[Tuple[PointKey, float, float]]) -> None:
+        connection = self._connect()
+
+        with connection:
+            rows = []
+            for key, timestamp, value in batch:
+                point_id = self._point_id(connection, key)
+                rows.append((point_id, timestamp, value))
+                self._raw_counts[point_id] = self._raw_counts.get(point_id, 0) + 1
+
+            connection.executemany(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?)", rows
+            )
+            self._roll_up(connection, rows)
+            self._compress_full(connection, {row[0] for row in rows})
+
+    async def backfill(
+        self,
+        log: TrendLogKey,
+        point: PointKey,
+        samples: List[Tuple[float, float]],
+        sequence: Optional[int],
+        timestamp: Optional[float],
+    ) -> int:
+        """
+        Insert samples read back from a trend log and move the log's position
+        to (sequence, timestamp) in one transaction. Samples the historian
+        already has for the point at the same millisecond are left out,
+        returns how many were new.
+        """
+        async with self._flush_lock:
+            return await asyncio.to_thread(
+                self.write_backfill, log, point, samples, sequence, timestamp
+            )
+
+    def write_backfill(
+        self,
+        log: TrendLogKey,
+        point: PointKey,
+        samples: List[Tuple[float, float]],
+        sequence: Optional[int],
+        timestamp: Optional[float],
+    ) -> int:
+        connection = self._connect()
+
+        with connection:
+            point_id = self._point_id(connection, point)
+
+            # milliseconds, the resolution of the compressed chunks
+            rows = {round(time * TIMESTAMP_SCALE): value for time, value in samples}
+            if rows:
+                chunks = connection.execute(
+                    "SELECT data FROM chunks WHERE point_id = ? AND end >= ? AND start <= ?",
+                    (
+                        point_id,
+                        min(rows) / TIMESTAMP_SCALE,
+                        max(rows) / TIMESTAMP_SCALE,
+                    ),
+                )
+                for (data,) in chunks:
+                    for time in decode_chunk(data)[0]:
+                        rows.pop(time, None)
+
+            changes = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO samples VALUES (?, ?, ?)",
+                [(point_id, time / TIMESTAMP_SCALE, value) for time, value in rows.items()],
+            )
+            inserted = connection.total_changes - changes
+            connection.execute(
+                "INSERT OR REPLACE INTO trend_logs VALUES (?, ?, ?, ?)",
+                (*log, sequence, timestamp),
+            )
+
+            self._raw_counts[point_id] = self._raw_counts.get(point_id, 0) + inserted
+            self._roll_up(
+                connection,
+                [(point_id, time / TIMESTAMP_SCALE, value) for time, value in rows.items()],
+                late=True,
+            )
+            self._compress_full(connection, (point_id,))
+        return inserted
+
+    def _roll_up(
+        self,
+        connection: sqlite3.Connection,
+        rows: List[Tuple[int, float, float]],
+        late: bool = False,
+    ) -> None:
+        """
+        Add (point id, timestamp, value) samples to the rollups of their
+        buckets. Samples no newer than the last one rolled up for their
+        point, or all of them when `late`, instead have the buckets they
+        can change computed again from the samples.
+        """
+        deltas: Dict[Tuple[int, str, float], list] = {}
+        dirty: Set[Tuple[int, str, float]] = set()
+        touched = set()
+
+        def buckets(point_id: int, start: float, end: float):
+            """(resolution, bucket, bucket end) of the buckets overlapping [start, end)."""
+            for resolution in ROLLUP_RESOLUTIONS:
+                time = start
+                while time < end:
+                    bucket, bucket_end = rollup_bucket(time, resolution)
+                    yield resolution, bucket, bucket_end
+                    time = bucket_end
+
+        def totals(point_id: int, resolution: str, bucket: float) -> list:
+            key = (point_id, resolution, bucket)
+            entry = deltas.get(key)
+            if entry is None:
+                entry = deltas[key] = [0, 0.0, None, None, 0.0]
+            return entry
+
+        for point_id, timestamp, value in sorted(rows):
+            position = self._rollup_positions.get(point_id)
+            touched.add(point_id)
+            newest = position is None or timestamp > position[0]
+
+            if late or not newest:
+                # the sample, the value held up to it and its own
+                for resolution, bucket, _ in buckets(
+                    point_id, timestamp - ROLLUP_MAX_GAP, timestamp + ROLLUP_MAX_GAP
+                ):
+                    dirty.add((point_id, resolution, bucket))
+                if newest and position is not None:
+                    for resolution, bucket, _ in buckets(
+                        point_id, position[0], min(timestamp, position[0] + ROLLUP_MAX_GAP)
+                    ):
+                        dirty.add((point_id, resolution, bucket))
+                if newest:
+                    self._rollup_positions[point_id] = (timestamp, value)
+                continue
+
+            if position is not None and position[1]:
+                # the value before was held until this sample
+                held_end = min(timestamp, position[0] + ROLLUP_MAX_GAP)
+                for resolution, bucket, bucket_end in buckets(point_id, position[0], held_end):
+                    totals(point_id, resolution, bucket)[4] += (
+                        min(held_end, bucket_end) - max(position[0], bucket)
+                    )
+            for resolution in ROLLUP_RESOLUTIONS:
+                entry = totals(point_id, resolution, rollup_bucket(timestamp, resolution)[0])
+                entry[0] += 1
+                entry[1] += value
+                entry[2] = value if entry[2] is None else min(entry[2], value)
+                entry[3] = value if entry[3] is None else max(entry[3], value)
+            self._rollup_positions[point_id] = (timestamp, value)
+
+        connection.executemany(
+            "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (point_id, resolution, bucket) DO UPDATE SET "
+            "count = count + excluded.count, sum = sum + excluded.sum, "
+            "min = COALESCE(MIN(min, excluded.min), min, excluded.min), "
+            "max = COALESCE(MAX(max, excluded.max), max, excluded.max), "
+            "runtime = runtime + excluded.runtime",
+            [(*key, *entry) for key, entry in deltas.items()],
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO rollup_positions VALUES (?, ?, ?)",
+            [(point_id, *self._rollup_positions[point_id]) for point_id in touched],
+        )
+        for point_id, resolution, bucket in dirty:
+            self._recompute_rollup(connection, point_id, resolution, bucket)
+
+    def _recompute_rollup(
+        self, connection: sqlite3.Connection, point_id: int, resolution: str, bucket: float
+    ) -> None:
+        start, end = bucket, rollup_bucket(bucket, resolution)[1]
+        samples = heapq.merge(
+            compressed_samples(
+                connection, point_id, start - ROLLUP_MAX_GAP, end + ROLLUP_MAX_GAP
+            ),
+            raw_samples(
+                connection,
+                point_id,
+                start - ROLLUP_MAX_GAP,
+                end + ROLLUP_MAX_GAP,
+                EXPORT_CHUNK_SIZE,
+            ),
+        )
+        count, total, low, high, runtime = bucket_totals(
+            samples, start, end, self._rollup_positions[point_id][0]
+        )
+        if count or runtime:
+            connection.execute(
+                "INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (point_id, resolution, bucket, count, total, low, high, runtime),
+            )
+        else:
+            connection.execute(
+                "DELETE FROM rollups WHERE point_id = ? AND resolution = ? AND bucket = ?",
+                (point_id, resolution, bucket),
+            )
+
+    def _roll_up_existing(self, connection: sqlite3.Connection) -> None:
+        """Roll up the samples a database had before it had rollups, once."""
+        point_ids = [
+            row[0]
+            for row in connection.execute(
+                "SELECT id FROM points WHERE id NOT IN (SELECT point_id FROM rollup_positions)"
+            )
+        ]
+        rolled_up = 0
+        for point_id in point_ids:
+            samples = heapq.merge(
+                compressed_samples(connection, point_id, float("-inf"), float("inf")),
+                raw_samples(
+                    connection, point_id, float("-inf"), float("inf"), EXPORT_CHUNK_SIZE
+                ),
+            )
+            with connection:
+                while True:
+                    rows = [
+                        (point_id, timestamp, value)
+                        for timestamp, value in itertools.islice(samples, EXPORT_CHUNK_SIZE)
+                    ]
+                    if not rows:
+                        break
+                    self._roll_up(connection, rows)
+                    rolled_up += len(rows)
+        if rolled_up:
+            _log.info("Historian rolled up %d earlier samples", rolled_up)
+
+    async def trend_log_positions(self) -> Dict[TrendLogKey, Tuple[Optional[int], Optional[float]]]:
+        """(sequence, timestamp) of the last record read from each trend log."""
+
+        def read():
+            rows = self._connect().execute(
+                "SELECT device_instance, object_identifier, sequence, timestamp FROM trend_logs"
+            )
+            return {(row[0], row[1]): (row[2], row[3]) for row in rows}
+
+        async with self._flush_lock:
+            return await asyncio.to_thread(read)
+
+    def compress(self, connection: sqlite3.Connection, point_id: int) -> bool:
+        """
+        Move the oldest `chunk_samples` samples of a point into a compressed
+        chunk, False if it has fewer than that.
+        """
+        samples = connection.execute(
+            "SELECT timestamp, value FROM samples WHERE point_id = ? "
+            "ORDER BY timestamp LIMIT ?",
+            (point_id, self.chunk_samples),
+        ).fetchall()
+        if len(samples) < self.chunk_samples:
+            self._raw_counts[point_id] = len(samples)
+            return False
+
+        timestamps, values = zip(*samples)
+        data = encode_chunk(timestamps, values)
+        connection.execute(
+            "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+            (
+                point_id,
+                round(timestamps[0] * TIMESTAMP_SCALE) / TIMESTAMP_SCALE,
+                round(timestamps[-1] * TIMESTAMP_SCALE) / TIMESTAMP_SCALE,
+                len(samples),
+                data,
+            ),
+        )
+        connection.execute(
+            "DELETE FROM samples WHERE point_id = ? AND timestamp <= ?",
+            (point_id, timestamps[-1]),
+        )
+        self._raw_counts[point_id] -= len(samples)
+        _log.debug(
+            "Historian compressed %d samples of point %d into %d bytes",
+            len(samples),
+            point_id,
+            len(data),
+        )
+        return True
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def compressed_samples(
+    connection: sqlite3.Connection, point_id: int, start: float, end: float
+) -> Iterator[Tuple[float, float]]:
+    """
+    (timestamp, value) of a point from the compressed chunks that overlap
+    the time range, only those chunks are decoded. Chunks that overlap each
+    other (backfilled samples older than the newest chunk) are merged.
+    """
+    chunks = connection.execute(
+        "SELECT start, end, data FROM chunks WHERE point_id = ? AND end >= ? AND start < ? "
+        "ORDER BY start",
+        (point_id, start, end),
+    )
+
+    def decoded(data):
+        times, values = decode_chunk(data)
+        timestamps = [time / TIMESTAMP_SCALE for time in times]
+        low = bisect.bisect_left(timestamps, start)
+        high = bisect.bisect_left(timestamps, end)
+        return zip(timestamps[low:high], values[low:high])
+
+    group: List[bytes] = []
+    group_end = float("-inf")
+    for chunk_start, chunk_end, data in chunks:
+        if group and chunk_start > group_end:
+            yield from heapq.merge(*map(decoded, group))
+            group = []
+        group.append(data)
+        group_end = max(group_end, chunk_end)
+    if group:
+        yield from heapq.merge(*map(decoded, group))
+
+
+def raw_samples(
+    connection: sqlite3.Connection,
+    point_id: int,
+    start: float,
+    end: float,
+    chunk_size: int,
+) -> Iterator[Tuple[float, float]]:
+    """
+    (timestamp, value) of a point that aren't compressed yet. Each query is
+    a keyset query that continues after the last timestamp of the one
+    before, so only one chunk of rows is ever in memory.
+    """
+    after = start
+    first = True
+    while True:
+        samples = connection.execute(
+            "SELECT timestamp, value FROM samples WHERE point_id = ? "
+            f"AND timestamp {'>=' if first else '>'} ? AND timestamp < ? "
+            "ORDER BY timestamp LIMIT ?",
+            (point_id, after, end, chunk_size),
+        ).fetchall()
+        yield from samples
+        if len(samples) < chunk_size:
+            break
+        after = samples[-1][0]
+        first = False
+
+
+def export_chunks(
+    path: str,
+    points: Optional[List[PointKey]] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[List[tuple]]:
+    """
+    Rows of EXPORT_COLUMNS for the given points (all of them by default) and
+    time range, point by point in time order, at most `chunk_size` rows per
+    chunk. Compressed and plain samples are merged as they are read.
+    """
+    if not os.path.exists(path):
+        return
+    connection = connect(path, read_only=True)
+    try:
+        point_rows = connection.execute(
+            "SELECT id, device_instance, object_identifier, property_identifier "
+            "FROM points ORDER BY device_instance, object_identifier, property_identifier"
+        ).fetchall()
+        if points is not None:
+            wanted = set(points)
+            point_rows = [row for row in point_rows if tuple(row[1:]) in wanted]
+
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+
+        # databases written before compression have no chunks table
+        compressed = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks'"
+        ).fetchone()
+
+        for point_id, device_instance, object_identifier, property_identifier in point_rows:
+            samples = raw_samples(connection, point_id, start, end, chunk_size)
+            if compressed:
+                samples = heapq.merge(
+                    compressed_samples(connection, point_id, start, end), samples
+                )
+            while True:
+                rows = [
+                    (timestamp, device_instance, object_identifier, property_identifier, value)
+                    for timestamp, value in itertools.islice(samples, chunk_size)
+                ]
+                if not rows:
+                    break
+                yield rows
+    finally:
+        connection.close()
+
+
+def rollup_source(resolution: float) -> Optional[str]:
+    """
+    The coarsest rollup whose buckets add up to buckets of `resolution`
+    seconds, None when the samples have to be read.
+    """
+    for source in sorted(ROLLUP_RESOLUTIONS, key=ROLLUP_RESOLUTIONS.get, reverse=True):
+        if resolution % ROLLUP_RESOLUTIONS[source] == 0:
+            return source
+    return None
+
+
+def bucket_start(timestamp: float, resolution: float) -> float:
+    """
+    Start of the bucket of `resolution` seconds counted from the epoch, from
+    the bucket's index so every timestamp of a bucket gives the same start.
+    """
+    return math.floor(timestamp / resolution) * resolution
+
+
+def group_start(timestamp: float, resolution: float, source: Optional[str]) -> float:
+    """
+    Start of the bucket of `resolution` seconds a timestamp falls in, days
+    from local midnight when read from the daily rollup, otherwise counted
+    from the epoch.
+    """
+    if source == "day":
+        day = datetime.date.fromtimestamp(timestamp)
+        days = int(resolution // ROLLUP_RESOLUTIONS["day"])
+        return day_bounds(day - datetime.timedelta(days=day.toordinal() % days))[0]
+    return bucket_start(timestamp, resolution)
+
+
+def combined_totals(rows: Iterable[tuple]) -> list:
+    """[count, sum, min, max, runtime] of rollup rows (bucket, count, sum, min, max, runtime)."""
+    count, total, low, high, runtime = 0, 0.0, None, None, 0.0
+    for row in rows:
+        count += row[1]
+        total += row[2]
+        if row[3] is not None:
+            low = row[3] if low is None else min(low, row[3])
+        if row[4] is not None:
+            high = row[4] if high is None else max(high, row[4])
+        runtime += row[5]
+    return [count, total, low, high, runtime]
+
+
+def resampled_totals(
+    samples: Iterable[Tuple[float, float]],
+    start: float,
+    end: float,
+    resolution: float,
+    newest: float = float("inf"),
+) -> Iterator[Tuple[float, list]]:
+    """
+    (bucket, [count, sum, min, max, runtime]) of the buckets of `resolution`
+    seconds in [start, end) that have samples or runtime, in time order,
+    from samples in time order as for bucket_totals.
+    """
+    totals: Dict[float, list] = {}
+
+    def entry(bucket: float) -> list:
+        if bucket not in totals:
+            totals[bucket] = [0, 0.0, None, None, 0.0]
+        return totals[bucket]
+
+    def hold(held_start: float, held_end: float) -> None:
+        time = max(held_start, start)
+        held_end = min(held_end, end)
+        # step by the bucket index, with a resolution like 0.3 adding it to
+        # the bucket start can round back onto the same bucket
+        index = math.floor(time / resolution)
+        while time < held_end:
+            bucket = index * resolution
+            index += 1
+            bucket_end = min(index * resolution, held_end)
+            if bucket_end > time:
+                entry(bucket)[4] += bucket_end - time
+                time = bucket_end
+
+    previous = None
+    for timestamp, value in samples:
+        if previous is not None and previous[1]:
+            hold(previous[0], min(timestamp, previous[0] + ROLLUP_MAX_GAP))
+        if start <= timestamp < end:
+            bucket_entry = entry(bucket_start(timestamp, resolution))
+            bucket_entry[0] += 1
+            bucket_entry[1] += value
+            low, high = bucket_entry[2], bucket_entry[3]
+            bucket_entry[2] = value if low is None else min(low, value)
+            bucket_entry[3] = value if high is None else max(high, value)
+        previous = (timestamp, value)
+
+        # nothing after this sample goes into buckets that end before it
+        while totals:
+            bucket = next(iter(totals))
+            if bucket + resolution > timestamp:
+                break
+            yield bucket, totals.pop(bucket)
+
+    if previous is not None and previous[1] and previous[0] < newest:
+        hold(previous[0], previous[0] + ROLLUP_MAX_GAP)
+    yield from sorted(totals.items())
+
+
+def rollup_chunks(
+    path: str,
+    points: Optional[List[PointKey]] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    resolution: float = ROLLUP_RESOLUTIONS["hour"],
+) -> Iterator[List[tuple]]:
+    """
+    Rows of ROLLUP_COLUMNS for the given points (all of them by default) in
+    buckets of `resolution` seconds, one chunk per point. Read from the
+    coarsest rollup that fits (see rollup_source), a bucket that starts
+    before `start` is taken whole, otherwise computed from the samples.
+    """
+    if not os.path.exists(path):
+        return
+    connection = connect(path, read_only=True)
+    try:
+        point_rows = connection.execute(
+            "SELECT id, device_instance, object_identifier, property_identifier "
+            "FROM points ORDER BY device_instance, object_identifier, property_identifier"
+        ).fetchall()
+        if points is not None:
+            wanted = set(points)
+            point_rows = [row for row in point_rows if tuple(row[1:]) in wanted]
+
+        tables = {
+            row[0]
+            for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        # databases the writer hasn't opened since rollups came have none
+        source = rollup_source(resolution) if "rollups" in tables else None
+
+        for point_id, device_instance, object_identifier, property_identifier in point_rows:
+            if source:
+                buckets = connection.execute(
+                    "SELECT bucket, count, sum, min, max, runtime FROM rollups "
+                    "WHERE point_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? "
+                    "ORDER BY bucket",
+                    (
+                        point_id,
+                        source,
+                        float("-inf") if start is None else group_start(start, resolution, source),
+                        float("inf") if end is None else end,
+                    ),
+                )
+                totals = (
+                    (bucket, combined_totals(rows))
+                    for bucket, rows in itertools.groupby(
+                        buckets, key=lambda row: group_start(row[0], resolution, source)
+                    )
+                )
+            else:
+                first = float("-inf") if start is None else start
+                last = float("inf") if end is None else end
+                samples = raw_samples(
+                    connection,
+                    point_id,
+                    first - ROLLUP_MAX_GAP,
+                    last + ROLLUP_MAX_GAP,
+                    EXPORT_CHUNK_SIZE,
+                )
+                if "chunks" in tables:
+                    samples = heapq.merge(
+                        compressed_samples(
+                            connection, point_id, first - ROLLUP_MAX_GAP, last + ROLLUP_MAX_GAP
+                        ),
+                        samples,
+                    )
+                newest = connection.execute(
+                    "SELECT MAX(timestamp) FROM samples WHERE point_id = ?", (point_id,)
+                ).fetchone()[0]
+                if "chunks" in tables:
+                    newest = max(
+                        connection.execute(
+                            "SELECT MAX(end) FROM chunks WHERE point_id = ?", (point_id,)
+                        ).fetchone()[0]
+                        or float("-inf"),
+                        newest or float("-inf"),
+                    )
+                totals = resampled_totals(samples, first, last, resolution, newest)
+
+            rows = [
+                (
+                    bucket,
+                    device_instance,
+                    object_identifier,
+                    property_identifier,
+                    count,
+                    total / count if count else None,
+                    low,
+                    high,
+                    runtime / 3600,
+                )
+                for bucket, (count, total, low, high, runtime) in totals
+            ]
+            if rows:
+                yield rows
+    finally:
+        connection.close()
+
+
+def csv_stream(
+    chunks: Iterator[List[tuple]], columns: Tuple[str, ...] = EXPORT_COLUMNS
+) -> Iterator[str]:
+    """CSV text, one piece per chunk, timestamps in ISO 8601 UTC."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks:
+        writer.writerows(
+            (
+                datetime.datetime.fromtimestamp(row[0], datetime.timezone.utc).isoformat(),
+                *row[1:],
+            )
+            for row in chunk
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """
+    Write-only file object for pyarrow writers, hands the bytes written so
+    far back to the caller after every chunk instead of keeping them.
+    """
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_stream(chunks: Iterator[List[tuple]], export_format: str) -> Iterator[bytes]:
+    """
+    Parquet (one row group per chunk) or Arrow IPC stream bytes, requires
+    pyarrow.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("device_instance", pa.uint32()),
+            ("object_identifier", pa.string()),
+            ("property_identifier", pa.string()),
+            ("value", pa.float64()),
+        ]
+    )
+
+    sink = _ChunkSink()
+    if export_format == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for chunk in chunks:
+        columns = list(zip(*chunk))
+        table = pa.table(
+            [
+                pa.array([int(t * 1_000_000) for t in columns[0]], pa.int64()).cast(
+                    schema.field("timestamp").type
+                ),
+                pa.array(columns[1], pa.uint32()),
+                pa.array(columns[2], pa.string()),
+                pa.array(columns[3], pa.string()),
+                pa.array(columns[4], pa.float64()),
+            ],
+            schema=schema,
+        )
+        writer.write_table(table)
+        yield sink.take()
+
+    writer.close()
+    yield sink.take()
+
+
+def export_stream(
+    path: Union[str, List[str]],
+    export_format: str = "csv",
+    points: Optional[List[PointKey]] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[Any]:
+    """
+    Encoded export in one of EXPORT_FORMATS, str for CSV, bytes otherwise.
+    Several databases (one per BACnet stack) are exported one after another.
+    """
+    paths = [path] if isinstance(path, str) else path
+    chunks = itertools.chain.from_iterable(
+        export_chunks(path, points, start, end, chunk_size) for path in paths
+    )
+    if export_format == "csv":
+        return csv_stream(chunks)
+    return arrow_stream(chunks, export_format)
+
+
+def parse_time(value: str) -> float:
+    """ISO 8601 date or time (local time unless it has an offset) or epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export trend data from the historian")
+    parser.add_argument(
+        "--db",
+        action="append",
+        help="historian database, repeat for the databases of more stacks",
+    )
+    parser.add_argument(
+        "--point",
+        action="append",
+        type=parse_point,
+        help="device/object[/property], repeat for more points, default all",
+    )
+    parser.add_argument("--start", type=parse_time, help="ISO 8601 time or epoch seconds")
+    parser.add_argument("--end", type=parse_time, help="ISO 8601 time or epoch seconds")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument(
+        "--resolution",
+        type=float,
+        help="seconds per bucket, export count/mean/min/max/runtime per bucket as CSV",
+    )
+    parser.add_argument("-o", "--output", help="output file, default stdout")
+    args = parser.parse_args()
+
+    if args.resolution:
+        args.format = "csv"
+        paths = args.db or [HISTORIAN_PATH]
+        stream = csv_stream(
+            itertools.chain.from_iterable(
+                rollup_chunks(path, args.point, args.start, args.end, args.resolution)
+                for path in paths
+            ),
+            ROLLUP_COLUMNS,
+        )
+    else:
+        stream = export_stream(
+            args.db or HISTORIAN_PATH,
+            args.format,
+            args.point,
+            args.start,
+            args.end,
+            args.chunk_size,
+        )
+    if args.format == "csv":
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+    else:
+        output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for part in stream:
+            output.write(part)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,9 @@ import datetime
 import random
 import os
 import json
+import importlib.util
+import shlex
+import dataclasses
 from typing import Optional, Union
 
 from fastapi import FastAPI, HTTPException
@@ -48,6 +51,27 @@ from bacpypes3.local.analog import AnalogValueObject
 from bacpypes3.local.binary import BinaryValueObject
 
 from app.routes.web_routes import setup_routes
+from app.points import PointCache
+from app.snapshot import StateSnapshot, SNAPSHOT_INTERVAL
+from app.config_store import ConfigStore
+from app.registry import (
+    DeviceRegistry,
+    RegistryDeviceInfoCache,
+    OFFLINE,
+    MAX_DEVICE_INSTANCE,
+    WHOIS_SWEEP_CHUNK,
+    WHOIS_SWEEP_PACE,
+)
+from app.site_model import SiteModelStore
+from app.health import HealthMonitor
+from app.singleflight import SingleFlight
+from app.historian import Historian, HISTORIAN_PATH
+from app.overrides import OverrideScanner
+from app.backfill import TrendLogBackfill
+from app.fdd import FDD_REPORT_LIMIT, FaultDetection
+from app.poller import AdaptivePoller, MSTP_NETWORK_BUDGET
+from app.tracing import Tracer
+from app.gateway import serve_split
 
 
 # $ python main.py --tls
@@ -62,26 +86,45 @@ _log = logging.getLogger(__name__)
 # bacnet server update GLOBAL_VAR_UPDATE_INTERVAL
 GLOBAL_VAR_UPDATE_INTERVAL = 1.0
 
+# schedule.json is in the project root, the rest of the configuration
+# lives in the config directory
+PROJECT_DIR = os.path.join(os.path.dirname(__file__), "..")
+CONFIG_DIR = os.path.join(PROJECT_DIR, "config")
 
-class FreeBasApplication:
-    def __init__(self, args, building_occ, outside_air_temp, use_tls=False):
-        # embed an application
-        self.bacnet_app = Application.from_args(args)
+CONFIG_PATHS = {
+    "schedule": os.path.join(PROJECT_DIR, "schedule.json"),
+    "users": os.path.join(CONFIG_DIR, "users.json"),
+    "points": os.path.join(CONFIG_DIR, "points.json"),
+    "alarm_rules": os.path.join(CONFIG_DIR, "alarm_rules.json"),
+}
 
-        # extract the kwargs that are special to this application
-        self.building_occ = building_occ
-        self.bacnet_app.add_object(building_occ)
+CONFIG_DEFAULTS = {
+    "users": {"admin": {"username": "admin", "password": "admin"}},
+}
+
+# default location of the warm-start state snapshot, next to schedule.json
+SNAPSHOT_PATH = os.path.join(PROJECT_DIR, "freebas_snapshot.json")
+
+# pause between directed Who-Is requests when revalidating restored devices
+REVALIDATE_INTERVAL = 0.5
+
+# seconds the value of a read is handed out again to identical reads, by
+# default reads are only merged while one is in flight
+READ_TTL = 0.0
 
-        self.outside_air_temp = outside_air_temp
-        self.bacnet_app.add_object(outside_air_temp)
-        
-        # BACnet global vars for BAS
-        self.global_vars_last_update_time = 0
-        self.global_vars_update_interval = 60
-        self.global_current_outside_temperature = -555.
-        self.global_occupied_bool = False
 
-        self.web_app = FastAPI()
+class FreeBasWeb:
+    """
+    The web front end, FastAPI app, sessions, templates and the schedule.
+    FreeBasApplication serves it in the same process as the BACnet stack, in
+    a split deployment every HTTP worker runs one against the gateway.
+    """
+
+    def __init__(self, use_tls=False, session_secret=None, lifespan=None):
+        # request path timing, see /admin/traces
+        self.tracer = Tracer()
+
+        self.web_app = FastAPI(lifespan=lifespan)
 
         # Conditional TLS setup
         if use_tls:
@@ -96,10 +139,11 @@ class FreeBasApplication:
         self.time_slots = []
         self.default_schedule = {}
 
-        # Generates a 32-byte (256-bit) URL-safe secret key
-        secret_key = secrets.token_urlsafe(32)
+        # Generates a 32-byte (256-bit) URL-safe secret key, HTTP workers of a
+        # split deployment are handed the same one so sessions work on all
+        self.session_secret = session_secret or secrets.token_urlsafe(32)
 
-        self.web_app.add_middleware(SessionMiddleware, secret_key=secret_key)
+        self.web_app.add_middleware(SessionMiddleware, secret_key=self.session_secret)
 
         self.web_app.add_middleware(
             CORSMiddleware,
@@ -114,23 +158,12 @@ class FreeBasApplication:
         )
         self.templates = Jinja2Templates(directory="app/templates")
 
-        # Load the default schedule and user setup
+        # Load the default schedule
         self.initialize_schedule()
-        self.users = {"admin": {"username": "admin", "password": "admin"}}
 
         # OAuth2 setup
         self.oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-        # Setup FastAPI routes and additional functionalities
-        setup_routes(self.web_app, self)
-
-        # Add user authentication and schedule loading functions here
-        self.in_memory_schedule = self.load_schedule()
-
-        # create a task to update the values of the BACnet server
-        asyncio.create_task(self.check_global_vars())
-        
-
     # for FASTapi web app
     async def start_server(self, host="0.0.0.0", port=8000, log_level="info"):
         config_kwargs = {
@@ -148,6 +181,12 @@ class FreeBasApplication:
         config = uvicorn.Config(**config_kwargs)
         server = uvicorn.Server(config)
         await server.serve()
+        await self.shutdown()
+
+    async def shutdown(self):
+        """
+        Called after the web server stopped.
+        """
 
     def initialize_schedule(self):
         # Define days of the week
@@ -174,35 +213,261 @@ class FreeBasApplication:
 
         return self
 
-    def load_schedule(self):
-        """Load the schedule from the JSON file into the cache."""
-        try:
-            # Adjust the path since schedule.json is in the project root, not in a config directory
-            schedule_path = os.path.join(
-                os.path.dirname(__file__), "..", "schedule.json"
-            )
-            with open(schedule_path, "r") as file:
-                schedule = json.load(file)
-                _log.debug("Schedule loaded: \n", schedule)
-                return schedule
-        except FileNotFoundError:
-            _log.error("Error loading default schedule!")
-            return {}  # Or return an empty dict
-        
+    @property
+    def users(self):
+        return self.config_store.get("users")
+
+    @property
+    def in_memory_schedule(self):
+        return self.config_store.get("schedule")
+
     def save_schedule(self, schedule_data):
-        """Load the schedule from the JSON file into the cache."""
-        try:
-            # Adjusted path to point to the root directory
-            schedule_path = os.path.join(
-                os.path.dirname(__file__), "..", "schedule.json"
+        """
+        Replace the schedule in memory, schedule.json is rewritten in the
+        background so the caller never waits on the disk.
+        """
+        self.config_store.put("schedule", schedule_data)
+        _log.debug("Schedule updated, save queued.")
+
+    def etag(self, *parts):
+        """
+        Weak ETag for a response built only from the given version parts.
+        """
+        return 'W/"' + "-".join([self.etag_epoch, *map(str, parts)]) + '"'
+
+    def occupancy_etag(self):
+        # the occupancy payload changes with the schedule and the minute
+        now = datetime.datetime.now()
+        return self.etag("occ", self.config_store.version("schedule"), now.strftime("%A-%H:%M"))
+
+    async def check_occupancy_status(self):
+        now = datetime.datetime.now()
+        current_day = now.strftime("%A")
+        current_time = now.strftime("%H:%M")
+        todays_schedule = self.in_memory_schedule.get(current_day, {"start": None, "end": None})
+
+        is_occupied = False
+        if todays_schedule["start"] and todays_schedule["end"]:
+            is_occupied = todays_schedule["start"] <= current_time < todays_schedule["end"]
+        
+        return {
+            "current_time": current_time,
+            "current_day": current_day,
+            "is_occupied": is_occupied,
+            "schedule": todays_schedule,
+        }
+
+
+class FreeBasApplication(FreeBasWeb):
+    def __init__(
+        self,
+        args,
+        building_occ,
+        outside_air_temp,
+        use_tls=False,
+        snapshot_path=None,
+        snapshot_interval=SNAPSHOT_INTERVAL,
+        historian_path=HISTORIAN_PATH,
+        session_secret=None,
+        mstp_poll_budget=MSTP_NETWORK_BUDGET,
+        config_store=None,
+        read_ttl=READ_TTL,
+    ):
+        super().__init__(use_tls, session_secret)
+
+        # devices known on the network, fed by every I-Am the stack accepts
+        self.registry = DeviceRegistry()
+
+        # embed an application
+        self.bacnet_app = Application.from_args(
+            args, device_info_cache=RegistryDeviceInfoCache(self.registry)
+        )
+
+        # extract the kwargs that are special to this application
+        self.building_occ = building_occ
+        self.bacnet_app.add_object(building_occ)
+
+        self.outside_air_temp = outside_air_temp
+        self.bacnet_app.add_object(outside_air_temp)
+        
+        # BACnet global vars for BAS
+        self.global_vars_last_update_time = 0
+        self.global_vars_update_interval = 60
+        self.global_current_outside_temperature = -555.
+        self.global_occupied_bool = False
+
+        # last-known values of points read from the field bus
+        self.point_cache = PointCache()
+
+        # answers and timeouts per device, reads and writes to devices that
+        # stopped answering fail fast until they answer a check again
+        self.health = HealthMonitor(self)
+
+        # identical reads at the same time share one ReadProperty
+        self.reads = SingleFlight(read_ttl)
+
+        # finds forgotten operator overrides in the priority arrays
+        self.override_scanner = OverrideScanner(self)
+
+        # every numeric value read is also trended, unless disabled
+        self.historian = Historian(historian_path) if historian_path else None
+
+        # fills gaps in the trends from the trend logs in the devices
+        self.backfill = TrendLogBackfill(self) if self.historian else None
+
+        # runs the fault rules over the trends of the site model's equipment
+        self.fdd = FaultDetection(self) if self.historian else None
+
+        # version counters for conditional GET, the epoch changes on every
+        # start so ETags handed out by a previous process never match
+        self.etag_epoch = secrets.token_hex(4)
+        self.local_objects_version = 0
+
+        # configuration is read from memory and written back to disk in the
+        # background, a shard follows the primary gateway's copy instead
+        self.config_store = config_store or ConfigStore(CONFIG_PATHS, CONFIG_DEFAULTS)
+
+        # compiled Brick site model, recompiled in the background when the
+        # processed graph models change. Only the primary compiles it, a
+        # shard reopens what the primary wrote like the HTTP workers do,
+        # two compilers would hand out the same revision for different models.
+        self.site_model = SiteModelStore()
+        self.site_model.open()
+        if config_store is None:
+            asyncio.create_task(self.site_model.watch())
+        else:
+            asyncio.create_task(self.site_model.follow())
+
+        # polls the points of the point list and the site model into the
+        # point cache, each at an interval that follows how fast its value
+        # changes, in request groups planned from the registry
+        self.poller = AdaptivePoller(self, mstp_budget=mstp_poll_budget)
+        self.config_store.listeners.append(self.poller.config_changed)
+
+        # Setup FastAPI routes and additional functionalities
+        setup_routes(self.web_app, self)
+
+        # warm-start from the last runtime state snapshot
+        self.snapshot = None
+        restored_devices = []
+        if snapshot_path:
+            self.snapshot = StateSnapshot(snapshot_path, snapshot_interval)
+            restored_devices = self.restore_snapshot()
+
+        # create a task to update the values of the BACnet server
+        asyncio.create_task(self.check_global_vars())
+        asyncio.create_task(self.tracer.monitor_loop())
+        asyncio.create_task(self.poller.run())
+        asyncio.create_task(self.poller.watch())
+        asyncio.create_task(self.health.run())
+
+        if self.snapshot:
+            asyncio.create_task(self.snapshot.run(self.collect_state))
+        if self.historian:
+            asyncio.create_task(self.historian.run())
+            asyncio.create_task(self.backfill.run())
+            asyncio.create_task(self.fdd.run())
+        if restored_devices:
+            asyncio.create_task(self.revalidate_devices(restored_devices))
+        
+
+    async def shutdown(self):
+        # write any pending configuration edits and trend samples
+        await self.config_store.flush()
+        if self.historian:
+            await self.historian.flush()
+            self.historian.close()
+            self.fdd.close()
+
+        # keep the latest state for the next start
+        if self.snapshot:
+            self.snapshot.save(self.collect_state())
+
+    def collect_state(self):
+        """Gather the runtime state that is worth keeping across a restart."""
+        return {
+            "devices": self.registry.to_json(),
+            "points": self.point_cache.to_json(),
+            "schedule": self.in_memory_schedule,
+            "global_vars": {
+                "occupied": self.global_occupied_bool,
+                "outside_air_temp": self.global_current_outside_temperature,
+            },
+        }
+
+    def restore_snapshot(self):
+        """
+        Load the last state snapshot so the API can be served right away,
+        returns the restored device records that still need revalidating.
+        """
+        state = self.snapshot.load()
+        if not state:
+            return []
+
+        restored_devices = self.registry.load_json(state["devices"])
+
+        # seed the bacpypes3 device cache so reads skip the Who-Is fallback
+        device_info_cache = self.bacnet_app.device_info_cache
+        for record in restored_devices:
+            device_info = self.registry.device_info(
+                record, device_info_cache.device_info_class
             )
-            with open(schedule_path, "w") as file:
-                json.dump(schedule_data, file, indent=4)
-            _log.debug("Schedule successfully updated and saved.")
-        except Exception as e:
-            # Handle potential errors, perhaps logging them or notifying an admin
-            _log.error(f"Failed to save the updated schedule: {e}")
+            device_info_cache.instance_cache[record.device_instance] = device_info
+            device_info_cache.address_cache[device_info.device_address] = device_info
+
+        self.point_cache.load_json(state["points"])
+
+        # schedule.json stays the source of truth, the copy in the snapshot is
+        # only used when the file could not be loaded
+        if not self.in_memory_schedule:
+            self.save_schedule(state["schedule"])
+
+        global_vars = state["global_vars"]
+        self.global_occupied_bool = global_vars["occupied"]
+        self.building_occ.presentValue = (
+            "active" if self.global_occupied_bool else "inactive"
+        )
+        self.global_current_outside_temperature = global_vars["outside_air_temp"]
+        self.outside_air_temp.presentValue = self.global_current_outside_temperature
+        self.local_objects_version += 1
+
+        _log.info(
+            "Warm start: %d devices, %d point values restored",
+            len(restored_devices),
+            len(state["points"]),
+        )
+        return restored_devices
+
+    async def revalidate_devices(self, devices):
+        """
+        Confirm the restored device addresses in the background with directed
+        Who-Is requests, paced so a restart doesn't burst the network.
+        """
+        device_info_cache = self.bacnet_app.device_info_cache
+
+        for record in devices:
+            await asyncio.sleep(REVALIDATE_INTERVAL)
+
+            device_instance = record.device_instance
+            device_address = Address(record.address)
+            try:
+                # a matching I-Am refreshes the registry by itself
+                i_ams = await self.bacnet_app.who_is(
+                    device_instance, device_instance, device_address
+                )
+            except Exception as e:
+                _log.error(f"Error revalidating device {device_instance}: {e}")
+                continue
+
+            if i_ams:
+                continue
 
+            # gone from its old address, the next read rebroadcasts for it
+            _log.info("Device %r did not answer at %s", device_instance, record.address)
+            self.registry.upsert(device_instance, status=OFFLINE)
+            device_info = device_info_cache.instance_cache.pop(device_instance, None)
+            if device_info:
+                device_info_cache.address_cache.pop(device_info.device_address, None)
 
     async def check_global_vars(self):
         while True:
@@ -223,6 +488,7 @@ class FreeBasApplication:
                     
                     # Update bacpypes3 bacnet server value
                     self.building_occ.presentValue = occ_str
+                    self.local_objects_version += 1
 
             except Exception as e:
                 _log.error(f"Error checking occupancy status: {e}")
@@ -249,60 +515,82 @@ class FreeBasApplication:
                 
                 # update bacpypes3 bacnet server value
                 self.outside_air_temp.presentValue = current_temperature
+                self.local_objects_version += 1
 
 
-    async def check_occupancy_status(self):
-        now = datetime.datetime.now()
-        current_day = now.strftime("%A")
-        current_time = now.strftime("%H:%M")
-        todays_schedule = self.in_memory_schedule.get(current_day, {"start": None, "end": None})
+    def point_etag(self, device_instance, object_identifier, property_identifier):
+        """
+        ETag of a cached point value, None when the point isn't cached.
+        """
+        entry = self.point_cache.get(
+            int(device_instance),
+            str(ObjectIdentifier(object_identifier)),
+            property_identifier,
+        )
+        if entry is None:
+            return None
+        return self.etag("pt", entry["version"], int(entry["stale"]))
 
-        is_occupied = False
-        if todays_schedule["start"] and todays_schedule["end"]:
-            is_occupied = todays_schedule["start"] <= current_time < todays_schedule["end"]
-        
-        return {
-            "current_time": current_time,
-            "current_day": current_day,
-            "is_occupied": is_occupied,
-            "schedule": todays_schedule,
-        }
+    async def _device_address(self, device_instance: int) -> Address:
+        """
+        Look up the address of a device in the registry, falling back to a
+        Who-Is for devices that are unknown or were last seen offline.
+        """
+        record = self.registry.get(device_instance)
+        if record and record.status != OFFLINE:
+            _log.debug("    - registry address: %r", record.address)
+            return Address(record.address)
+
+        # returns a list, there should be only one
+        with self.tracer.span("who-is"):
+            i_ams = await self.bacnet_app.who_is(device_instance, device_instance)
+        if not i_ams:
+            if record:
+                self.health.timed_out(device_instance)
+            raise HTTPException(
+                status_code=400, detail=f"device not found: {device_instance}"
+            )
+        if len(i_ams) > 1:
+            raise HTTPException(
+                status_code=400, detail=f"multiple devices: {device_instance}"
+            )
 
+        device_address = i_ams[0].pduSource
+        _log.debug("    - i-am response: %r", device_address)
+        return device_address
 
     async def _read_property(
         self, device_instance: int, object_identifier: str, property_identifier: str
     ):
         """
-        Read a property from an object.
+        Read a property from an object, reads of the same property that
+        overlap share one request and its result or error.
         """
-        _log.debug("_read_property %r %r", device_instance, object_identifier)
-
-        device_address: Address
-        device_info = self.bacnet_app.device_info_cache.instance_cache.get(
-            device_instance, None
+        key = (device_instance, str(ObjectIdentifier(object_identifier)), property_identifier)
+        return await self.reads.call(
+            key,
+            lambda: self._read_property_once(
+                device_instance, object_identifier, property_identifier
+            ),
         )
-        if device_info:
-            device_address = device_info.device_address
-            _log.debug("    - cached address: %r", device_address)
-        else:
-            # returns a list, there should be only one
-            i_ams = await self.bacnet_app.who_is(device_instance, device_instance)
-            if not i_ams:
-                raise HTTPException(
-                    status_code=400, detail=f"device not found: {device_instance}"
-                )
-            if len(i_ams) > 1:
-                raise HTTPException(
-                    status_code=400, detail=f"multiple devices: {device_instance}"
-                )
 
-            device_address = i_ams[0].pduSource
-            _log.debug("    - i-am response: %r", device_address)
+    async def _read_property_once(
+        self, device_instance: int, object_identifier: str, property_identifier: str
+    ):
+        _log.debug("_read_property %r %r", device_instance, object_identifier)
+
+        object_identifier = ObjectIdentifier(object_identifier)
+        self.health.check(device_instance)
+        with self.tracer.span("resolve"):
+            device_address = await self._device_address(device_instance)
 
         try:
-            property_value = await self.bacnet_app.read_property(
-                device_address, ObjectIdentifier(object_identifier), property_identifier
-            )
+            with self.tracer.span("apdu", address=str(device_address)), self.health.track(
+                device_instance
+            ):
+                property_value = await self.bacnet_app.read_property(
+                    device_address, object_identifier, property_identifier
+                )
             if _debug:
                 _log.debug("    - property_value: %r", property_value)
         except ErrorRejectAbortNack as err:
@@ -310,6 +598,25 @@ class FreeBasApplication:
                 _log.debug("    - exception: %r", err)
             raise HTTPException(status_code=400, detail=f"error/reject/abort: {err}")
 
+        with self.tracer.span("encode"):
+            return self._encode_read(
+                device_instance, object_identifier, property_identifier, property_value
+            )
+
+    def _encode_read(
+        self,
+        device_instance: int,
+        object_identifier: ObjectIdentifier,
+        property_identifier: str,
+        property_value,
+    ):
+        """
+        JSON encode a value read from a device and record it.
+        """
+        self.registry.seen(device_instance)
+        if property_identifier == "object-list" and isinstance(property_value, list):
+            self.registry.upsert(device_instance, object_count=len(property_value))
+
         if isinstance(property_value, AnyAtomic):
             if _debug:
                 _log.debug("    - schedule objects")
@@ -328,10 +635,28 @@ class FreeBasApplication:
         if _debug:
             _log.debug("    - encoded_value: %r", encoded_value)
 
+        timestamp = time.time()
+        self.point_cache.update(
+            device_instance,
+            str(object_identifier),
+            property_identifier,
+            encoded_value,
+            timestamp,
+        )
+        if self.historian:
+            self.historian.record(
+                device_instance,
+                str(object_identifier),
+                property_identifier,
+                encoded_value,
+                timestamp,
+            )
+
         return {property_identifier: encoded_value}
 
     async def _write_property(
         self,
+        device_instance: int,
         address: Address,
         object_identifier: ObjectIdentifier,
         property_identifier: str,
@@ -369,14 +694,17 @@ class FreeBasApplication:
             value = Null(())
 
         try:
-            response = await self.bacnet_app.write_property(
-                address,
-                object_identifier,
-                property_identifier,
-                value,
-                property_array_index,
-                priority,
-            )
+            with self.tracer.span("apdu", address=str(address)), self.health.track(
+                device_instance
+            ):
+                response = await self.bacnet_app.write_property(
+                    address,
+                    object_identifier,
+                    property_identifier,
+                    value,
+                    property_array_index,
+                    priority,
+                )
             if _debug:
                 _log.debug("    - response: %r", response)
             return response
@@ -435,6 +763,81 @@ class FreeBasApplication:
 
         return result
 
+    async def who_is_sweep(
+        self,
+        low_limit: int = 0,
+        high_limit: int = MAX_DEVICE_INSTANCE,
+        chunk_size: int = WHOIS_SWEEP_CHUNK,
+        pace: float = WHOIS_SWEEP_PACE,
+        address: Optional[str] = None,
+    ):
+        """
+        Sweep a device instance range with one Who-Is per chunk, sent `pace`
+        seconds apart so routers aren't flooded. Yields each device once, as
+        soon as the chunk it answered in completes.
+        """
+        destination: Address
+        if address:
+            destination = Address(address)
+        else:
+            destination = GlobalBroadcast()
+
+        chunks = [
+            (chunk_low, min(chunk_low + chunk_size - 1, high_limit))
+            for chunk_low in range(low_limit, high_limit + 1, chunk_size)
+        ]
+        _log.debug("who_is_sweep %r-%r in %d chunks", low_limit, high_limit, len(chunks))
+
+        seen = {}
+
+        def new_devices(done):
+            # I-Am responses for devices that haven't been reported yet
+            result = []
+            for future in done:
+                for i_am in future.result():
+                    device_instance = i_am.iAmDeviceIdentifier[1]
+                    if device_instance in seen:
+                        if seen[device_instance] != i_am.pduSource:
+                            _log.warning(
+                                "Device %r answered from %s and %s",
+                                device_instance,
+                                seen[device_instance],
+                                i_am.pduSource,
+                            )
+                        continue
+
+                    seen[device_instance] = i_am.pduSource
+                    result.append(sequence_to_json(i_am))
+            return result
+
+        loop = asyncio.get_running_loop()
+        pending = set()
+        try:
+            for chunk_low, chunk_high in chunks:
+                pending.add(self.bacnet_app.who_is(chunk_low, chunk_high, destination))
+
+                # hand out finished chunks while waiting for the next send
+                next_send = loop.time() + pace
+                while pending and loop.time() < next_send:
+                    done, pending = await asyncio.wait(
+                        pending,
+                        timeout=next_send - loop.time(),
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    for device in new_devices(done):
+                        yield device
+                await asyncio.sleep(max(0.0, next_send - loop.time()))
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for device in new_devices(done):
+                    yield device
+        finally:
+            for future in pending:
+                future.cancel()
+
     async def read_present_value(self, device_instance: int, object_identifier: str):
         """
         Read the `present-value` property from an object.
@@ -463,6 +866,148 @@ class FreeBasApplication:
             device_instance, object_identifier, property_identifier
         )
 
+    async def devices(
+        self,
+        network: Optional[int] = None,
+        vendor_id: Optional[int] = None,
+        status: Optional[str] = None,
+        page: int = 1,
+        page_size: int = 100,
+    ):
+        """
+        Return a page of the device registry, optionally filtered.
+        """
+        total, records = self.registry.query(
+            network=network,
+            vendor_id=vendor_id,
+            status=status,
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "devices": [dataclasses.asdict(record) for record in records],
+        }
+
+    async def device(self, device_instance: int):
+        """
+        Return the registry record of one device.
+        """
+        record = self.registry.get(int(device_instance))
+        if record is None:
+            raise HTTPException(
+                status_code=404, detail=f"device not found: {device_instance}"
+            )
+        return dataclasses.asdict(record)
+
+    def cached_property(
+        self, device_instance: int, object_identifier: str, property_identifier: str
+    ):
+        """
+        Return the last-known value of a property without going to the device.
+        """
+        if isinstance(device_instance, str):
+            device_instance = int(device_instance)
+
+        entry = self.point_cache.get(
+            device_instance, str(ObjectIdentifier(object_identifier)), property_identifier
+        )
+        if entry is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"no cached value: {device_instance} {object_identifier} {property_identifier}",
+            )
+
+        return {
+            property_identifier: entry["value"],
+            "timestamp": entry["timestamp"],
+            "stale": entry["stale"],
+        }
+
+    async def poller_stats(self, limit: int = 1000):
+        """
+        Return the poll budget use per network and the effective interval of
+        every polled point.
+        """
+        return self.poller.stats(limit)
+
+    async def read_stats(self):
+        return self.reads.stats()
+
+    async def device_health(self, state: Optional[str] = None):
+        return self.health.report(state)
+
+    async def poll_plan(self):
+        """
+        Return the request groups the points are polled in, per device, and
+        their offsets into the poll round of their network.
+        """
+        return self.poller.plan.to_json()
+
+    async def scan_overrides(self, force: bool = False, priorities=None):
+        """
+        Scan every device for active priority array slots and return the
+        report, optionally only some priorities.
+        """
+        await self.override_scanner.scan(force)
+        return self.override_scanner.report(priorities)
+
+    async def override_report(self, priorities=None):
+        """
+        Return the overrides found by the scans so far.
+        """
+        return self.override_scanner.report(priorities)
+
+    async def backfill_trend_logs(self, force: bool = False):
+        """
+        Read the records the historian is missing from the trend logs of
+        every device, `force` lists the objects of every device again.
+        """
+        if self.backfill is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        await self.backfill.backfill(force)
+        return self.backfill.report()
+
+    async def trend_log_report(self):
+        """
+        Return the last backfill run and the read position of every trend log.
+        """
+        if self.backfill is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        return self.backfill.report()
+
+    async def run_fault_rules(self):
+        """
+        Run the fault rules over the recent trends now and return the run.
+        """
+        if self.fdd is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        if importlib.util.find_spec("numpy") is None:
+            raise HTTPException(status_code=400, detail="numpy is required for fault detection")
+        return await self.fdd.evaluate()
+
+    async def fault_report(
+        self,
+        rule=None,
+        equipment=None,
+        start=None,
+        end=None,
+        active=None,
+        limit=FDD_REPORT_LIMIT,
+    ):
+        """
+        Return the fault rules, their last run and the fault intervals found,
+        latest first, optionally of one rule or equipment, in a time range or
+        only the ones still active.
+        """
+        if self.fdd is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        return await self.fdd.report(
+            rule=rule, equipment=equipment, start=start, end=end, active=active, limit=limit
+        )
+
     async def write_property(
         self,
         device_instance: int,
@@ -478,14 +1023,84 @@ class FreeBasApplication:
         if isinstance(device_instance, str):
             device_instance = int(device_instance)
 
-        return await self._write_property(
-            device_instance, object_identifier, property_identifier, value, priority
-        )
+        self.health.check(device_instance)
+        with self.tracer.span("resolve"):
+            device_address = await self._device_address(device_instance)
+
+        # the write may have set or relinquished an override
+        self.override_scanner.invalidate(device_instance)
+
+        object_identifier = ObjectIdentifier(object_identifier)
+        try:
+            return await self._write_property(
+                device_instance,
+                device_address,
+                object_identifier,
+                property_identifier,
+                value,
+                priority,
+            )
+        finally:
+            # reads in flight or cached from before the write are out of date
+            self.reads.forget((device_instance, str(object_identifier), property_identifier))
+
+
+
+
+
+
+
+def create_local_objects():
+    """The BACnet objects FreeBAS serves, outside air temp and occupancy."""
+    outside_air_temp = AnalogValueObject(
+        objectIdentifier=("analogValue", 1),
+        objectName="Outside_Air_Temp_Sensor",
+        presentValue=0.0,
+        statusFlags=[0, 0, 0, 0],
+        covIncrement=1.0,
+    )
+    _log.debug("    - outside_air_temp: %r", outside_air_temp)
+
+    building_occ = BinaryValueObject(
+        objectIdentifier=("binaryValue", 1),
+        objectName="Occupied",
+        presentValue="inactive",
+        statusFlags=[0, 0, 0, 0],
+    )
+    _log.debug("    - building_occ: %r", building_occ)
 
+    return outside_air_temp, building_occ
 
 
+def shard_path(path, index):
+    """Per shard file next to `path`, historian.db -> historian-shard1.db."""
+    root, ext = os.path.splitext(path)
+    return f"{root}-shard{index}{ext}"
 
 
+def shard_arguments(args, index, spec):
+    """
+    Command line of the shard process for one --shard, an address followed
+    by any other BACnet options ("10.0.3.5/24 --foreign 10.0.3.1"). The
+    device instance and name follow the primary stack's.
+    """
+    shard_args = shlex.split(spec)
+    if shard_args and not shard_args[0].startswith("-"):
+        shard_args[:1] = ["--address", shard_args[0]]
+
+    command = [
+        "--instance", str(args.instance + index),
+        "--name", f"{args.name}-{index}",
+        "--vendoridentifier", str(args.vendoridentifier),
+        "--mstp-poll-budget", str(args.mstp_poll_budget),
+        "--read-ttl", str(args.read_ttl),
+        "--snapshot-interval", str(args.snapshot_interval),
+    ]
+    if args.snapshot:
+        command += ["--snapshot", shard_path(args.snapshot, index)]
+    if args.historian:
+        command += ["--historian", shard_path(args.historian, index)]
+    return command + shard_args
 
 
 async def main():
@@ -501,6 +1116,63 @@ async def main():
         action="store_true",
         help="Enable TLS by using SSL cert and key from the certs directory",
     )
+    parser.add_argument(
+        "--snapshot",
+        help="Path of the warm-start state snapshot file",
+        default=SNAPSHOT_PATH,
+    )
+    parser.add_argument(
+        "--no-snapshot",
+        dest="snapshot",
+        action="store_const",
+        const=None,
+        help="Disable the warm-start state snapshot",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        help="Seconds between state snapshots",
+        default=SNAPSHOT_INTERVAL,
+    )
+    parser.add_argument(
+        "--historian",
+        help="Path of the trend historian database",
+        default=HISTORIAN_PATH,
+    )
+    parser.add_argument(
+        "--no-historian",
+        dest="historian",
+        action="store_const",
+        const=None,
+        help="Disable the trend historian",
+    )
+    parser.add_argument(
+        "--mstp-poll-budget",
+        type=float,
+        default=MSTP_NETWORK_BUDGET,
+        help="Requests per second the poller may send to each routed network",
+    )
+    parser.add_argument(
+        "--read-ttl",
+        type=float,
+        default=READ_TTL,
+        help="Seconds a value read is handed out again to identical reads",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Serve the API from this many HTTP worker processes, with this "
+        "process as the BACnet gateway",
+    )
+    parser.add_argument(
+        "--shard",
+        action="append",
+        default=[],
+        help="Run one more BACnet stack in its own process, an address and "
+        "optionally its BBMD options, e.g. \"10.0.3.5/24 --foreign 10.0.3.1\". "
+        "Repeat for more, implies --workers 1",
+    )
 
     args = parser.parse_args()
 
@@ -508,22 +1180,7 @@ async def main():
         _log.debug("args: %r", args)
 
     # define BACnet objects
-    outside_air_temp = AnalogValueObject(
-        objectIdentifier=("analogValue", 1),
-        objectName="Outside_Air_Temp_Sensor",
-        presentValue=0.0,
-        statusFlags=[0, 0, 0, 0],
-        covIncrement=1.0,
-    )
-    _log.debug("    - outside_air_temp: %r", outside_air_temp)
-
-    building_occ = BinaryValueObject(
-        objectIdentifier=("binaryValue", 1),
-        objectName="Occupied",
-        presentValue="inactive",
-        statusFlags=[0, 0, 0, 0],
-    )
-    _log.debug("    - building_occ: %r", building_occ)
+    outside_air_temp, building_occ = create_local_objects()
 
 
     # Instantiate the FreeBasApplication with BACnet objects and TLS flag
@@ -532,14 +1189,35 @@ async def main():
         outside_air_temp=outside_air_temp,
         building_occ=building_occ,
         use_tls=args.tls,  # Pass the TLS flag directly
+        snapshot_path=args.snapshot,
+        snapshot_interval=args.snapshot_interval,
+        historian_path=args.historian,
+        mstp_poll_budget=args.mstp_poll_budget,
+        read_ttl=args.read_ttl,
     )
 
     # Start the web server with host, port, and log level from command-line arguments
-    await sample_app.start_server(
-        host=args.host,
-        port=args.port,
-        log_level=args.log_level,
-    )
+    if args.workers or args.shard:
+        # with shards every device is in exactly one registry, each stack
+        # only polls its own
+        sample_app.poller.known_devices_only = bool(args.shard)
+        await serve_split(
+            sample_app,
+            args.workers or 1,
+            host=args.host,
+            port=args.port,
+            log_level=args.log_level,
+            shards=[
+                shard_arguments(args, index, spec)
+                for index, spec in enumerate(args.shard, start=1)
+            ],
+        )
+    else:
+        await sample_app.start_server(
+            host=args.host,
+            port=args.port,
+            log_level=args.log_level,
+        )
 
 
 if __name__ == "__main__":
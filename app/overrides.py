@@ -0,0 +1,430 @@
+import asyncio
+import dataclasses
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bacpypes3.apdu import AbortPDU, ErrorRejectAbortNack, RejectPDU
+from bacpypes3.basetypes import ErrorType
+from bacpypes3.pdu import Address
+from bacpypes3.primitivedata import ObjectIdentifier
+
+from app.registry import DeviceRecord, OFFLINE
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# object types with a priority array
+COMMANDABLE_TYPES = {
+    "analog-output",
+    "analog-value",
+    "binary-output",
+    "binary-value",
+    "multi-state-output",
+    "multi-state-value",
+    "integer-value",
+    "positive-integer-value",
+    "large-analog-value",
+    "characterstring-value",
+    "lighting-output",
+    "binary-lighting-output",
+}
+
+# names of the priorities the standard assigns, the rest are unnamed
+PRIORITY_NAMES = {
+    1: "manual-life-safety",
+    2: "automatic-life-safety",
+    5: "critical-equipment-control",
+    6: "minimum-on-off",
+    8: "manual-operator",
+}
+
+# devices scanned at the same time
+SCAN_DEVICE_CONCURRENCY = 8
+
+# requests outstanding to one device, small MS/TP controllers often handle
+# only one at a time
+DEVICE_CONCURRENCY = 2
+
+# encoded size estimates used to fill a ReadPropertyMultiple request up to
+# what fits in one unsegmented response from the device
+PRIORITY_ARRAY_RESULT_BYTES = 48
+PRESENT_VALUE_RESULT_BYTES = 16
+RPM_OVERHEAD_BYTES = 16
+MAX_RPM_OBJECTS = 64
+
+# unchanged devices are still re-read after this long, an override that
+# leaves the present value where it was doesn't show in the probe
+FULL_SCAN_INTERVAL = 3600.0
+
+# outcomes of scanning one device
+RESCANNED = "rescanned"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+@dataclasses.dataclass
+class DeviceScan:
+    """What the scans learned about one device."""
+
+    database_revision: Optional[int] = None
+    objects: Optional[List[str]] = None
+    fingerprint: Optional[int] = None
+    scanned_at: float = 0.0
+    overrides: List[Dict[str, Any]] = dataclasses.field(default_factory=list)
+    rpm: bool = True  # cleared when the device rejects ReadPropertyMultiple
+    max_batch: int = MAX_RPM_OBJECTS  # halved when a response doesn't fit
+    error: Optional[str] = None
+
+
+def batch_size(record: DeviceRecord, result_bytes: int, max_batch: int) -> int:
+    """Objects per ReadPropertyMultiple request that fit the device's max APDU."""
+    return max(1, min(max_batch, (record.max_apdu - RPM_OVERHEAD_BYTES) // result_bytes))
+
+
+def override_slots(priority_array: list) -> List[Tuple[int, Any]]:
+    """(priority, value) of the active slots of a JSON encoded priority array."""
+    slots = []
+    for index, slot in enumerate(priority_array):
+        if not isinstance(slot, dict) or "null" in slot:
+            continue
+        slots.append((index + 1, next(iter(slot.values()), None)))
+    return slots
+
+
+class OverrideScanner:
+    """
+    Finds the active slots in the priority arrays of every commandable object
+    on the network. Each scan first probes a device with its database revision
+    and the present values of its commandable objects, which are much smaller
+    than priority arrays, and only reads the priority arrays again when the
+    probe changed since the last scan.
+    """
+
+    def __init__(
+        self,
+        app,
+        device_concurrency: int = DEVICE_CONCURRENCY,
+        scan_concurrency: int = SCAN_DEVICE_CONCURRENCY,
+        full_scan_interval: float = FULL_SCAN_INTERVAL,
+    ):
+        self.app = app
+        self.device_concurrency = device_concurrency
+        self.scan_concurrency = scan_concurrency
+        self.full_scan_interval = full_scan_interval
+
+        self.devices: Dict[int, DeviceScan] = {}
+
+        # devices written to through the API since their last scan
+        self.dirty: Set[int] = set()
+
+        self.requests = 0
+        self.last_scan: Optional[Dict[str, Any]] = None
+        self._scan: Optional[asyncio.Task] = None
+
+    def invalidate(self, device_instance: int) -> None:
+        """Re-read the device on the next scan whatever its probe says."""
+        self.dirty.add(device_instance)
+
+    async def scan(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Scan every device that isn't offline, a call while a scan is running
+        waits for that one instead of starting another.
+        """
+        if self._scan is None or self._scan.done():
+            self._scan = asyncio.create_task(self._run(force))
+        return await asyncio.shield(self._scan)
+
+    async def _run(self, force: bool) -> Dict[str, Any]:
+        started = time.time()
+        requests = self.requests
+        records = [
+            record
+            for record in self.app.registry.devices.values()
+            if record.status != OFFLINE
+        ]
+        limit = asyncio.Semaphore(self.scan_concurrency)
+
+        async def scan_device(record):
+            async with limit:
+                return await self.scan_device(record, force)
+
+        outcomes = await asyncio.gather(*(scan_device(record) for record in records))
+
+        self.last_scan = {
+            "started": started,
+            "duration": round(time.time() - started, 3),
+            "devices": len(records),
+            RESCANNED: outcomes.count(RESCANNED),
+            UNCHANGED: outcomes.count(UNCHANGED),
+            FAILED: outcomes.count(FAILED),
+            "requests": self.requests - requests,
+        }
+        _log.info(
+            "Override scan of %d devices: %d re-read, %d unchanged, %d failed, %d requests",
+            len(records),
+            self.last_scan[RESCANNED],
+            self.last_scan[UNCHANGED],
+            self.last_scan[FAILED],
+            self.last_scan["requests"],
+        )
+        return self.last_scan
+
+    async def scan_device(self, record: DeviceRecord, force: bool = False) -> str:
+        device_instance = record.device_instance
+        state = self.devices.setdefault(device_instance, DeviceScan())
+        address = Address(record.address)
+        device_limit = asyncio.Semaphore(self.device_concurrency)
+        now = time.time()
+        expired = now - state.scanned_at > self.full_scan_interval
+
+        try:
+            revision = await self._read(
+                address, f"device,{device_instance}", "database-revision"
+            )
+            if revision is not None:
+                revision = int(revision)
+
+            # the object list only changes with the database revision, devices
+            # that don't keep one are listed again on full scans
+            if (
+                state.objects is None
+                or revision != state.database_revision
+                or (revision is None and (expired or force))
+            ):
+                state.objects = await self._commandable_objects(
+                    address, device_instance
+                )
+
+            present_values = await self._read_multiple(
+                record, state, device_limit, "present-value", PRESENT_VALUE_RESULT_BYTES
+            )
+            fingerprint = hash(
+                tuple((obj, repr(value)) for obj, value in sorted(present_values.items()))
+            )
+
+            if not (
+                force
+                or expired
+                or device_instance in self.dirty
+                or revision != state.database_revision
+                or fingerprint != state.fingerprint
+            ):
+                state.error = None
+                return UNCHANGED
+
+            priority_arrays = await self._read_multiple(
+                record, state, device_limit, "priority-array", PRIORITY_ARRAY_RESULT_BYTES
+            )
+        except ErrorRejectAbortNack as err:
+            state.error = f"error/reject/abort: {err}"
+            _log.warning(f"Override scan of device {device_instance} failed: {err}")
+            return FAILED
+        except Exception as e:
+            state.error = str(e)
+            _log.error(f"Error scanning device {device_instance} for overrides: {e}")
+            return FAILED
+
+        state.overrides = self._overrides(device_instance, state, priority_arrays, now)
+        state.database_revision = revision
+        state.fingerprint = fingerprint
+        state.scanned_at = now
+        state.error = None
+        self.dirty.discard(device_instance)
+        return RESCANNED
+
+    def _overrides(
+        self,
+        device_instance: int,
+        state: DeviceScan,
+        priority_arrays: Dict[str, Any],
+        now: float,
+    ) -> List[Dict[str, Any]]:
+        # slots that stay active keep the time they were first seen
+        first_seen = {
+            (override["object_identifier"], override["priority"]): override["first_seen"]
+            for override in state.overrides
+        }
+
+        overrides = []
+        for object_identifier, property_value in priority_arrays.items():
+            if property_value is None:
+                continue
+            try:
+                # cached like any other read, /bacnet/cache serves it afterwards
+                encoded = self.app._encode_read(
+                    device_instance,
+                    ObjectIdentifier(object_identifier),
+                    "priority-array",
+                    property_value,
+                )["priority-array"]
+            except Exception as e:
+                _log.error(
+                    f"Error encoding priority array of {device_instance} {object_identifier}: {e}"
+                )
+                continue
+
+            for priority, value in override_slots(encoded):
+                overrides.append(
+                    {
+                        "device_instance": device_instance,
+                        "object_identifier": object_identifier,
+                        "priority": priority,
+                        "value": value,
+                        "first_seen": first_seen.get((object_identifier, priority), now),
+                    }
+                )
+        return overrides
+
+    async def _read(
+        self, address: Address, object_identifier: str, property_identifier: str, array_index=None
+    ) -> Any:
+        """Read one property, None when the device has no such property."""
+        self.requests += 1
+        try:
+            return await self.app.bacnet_app.read_property(
+                address, ObjectIdentifier(object_identifier), property_identifier, array_index
+            )
+        except ErrorRejectAbortNack as err:
+            if isinstance(err, (RejectPDU, AbortPDU)):
+                raise
+            return None
+
+    async def _commandable_objects(self, address: Address, device_instance: int) -> List[str]:
+        device_identifier = f"device,{device_instance}"
+        try:
+            self.requests += 1
+            object_list = await self.app.bacnet_app.read_property(
+                address, ObjectIdentifier(device_identifier), "object-list"
+            )
+        except AbortPDU as err:
+            # too long for a device that can't segment, read it one entry
+            # at a time
+            _log.debug("    - object-list by index: %r", err)
+            length = await self._read(address, device_identifier, "object-list", 0)
+            object_list = [
+                await self._read(address, device_identifier, "object-list", index)
+                for index in range(1, int(length or 0) + 1)
+            ]
+
+        self.app.registry.upsert(device_instance, object_count=len(object_list))
+        return [
+            str(object_identifier)
+            for object_identifier in object_list
+            if object_identifier is not None
+            and str(object_identifier[0]) in COMMANDABLE_TYPES
+        ]
+
+    async def _read_multiple(
+        self,
+        record: DeviceRecord,
+        state: DeviceScan,
+        device_limit: asyncio.Semaphore,
+        property_identifier: str,
+        result_bytes: int,
+    ) -> Dict[str, Any]:
+        """
+        One property of every commandable object of the device, batched into
+        ReadPropertyMultiple requests with at most `device_concurrency` of
+        them outstanding. Objects without the property map to None.
+        """
+        address = Address(record.address)
+        objects = state.objects or []
+        values: Dict[str, Any] = {}
+
+        async def read_batch(batch):
+            async with device_limit:
+                if not state.rpm:
+                    for object_identifier in batch:
+                        values[object_identifier] = await self._read(
+                            address, object_identifier, property_identifier
+                        )
+                    return
+
+                self.requests += 1
+                try:
+                    # alternating object identifiers and property lists
+                    parameter_list = []
+                    for object_identifier in batch:
+                        parameter_list.append(ObjectIdentifier(object_identifier))
+                        parameter_list.append([property_identifier])
+                    results = await self.app.bacnet_app.read_property_multiple(
+                        address, parameter_list
+                    )
+                except RejectPDU as err:
+                    if str(err) != "unrecognized-service":
+                        raise
+                    _log.info("Device %r doesn't support ReadPropertyMultiple", record.device_instance)
+                    state.rpm = False
+                    results = None
+                except AbortPDU as err:
+                    if len(batch) == 1 or str(err) not in (
+                        "segmentation-not-supported",
+                        "buffer-overflow",
+                    ):
+                        raise
+                    state.max_batch = max(1, len(batch) // 2)
+                    results = None
+
+            if results is None:
+                # retry with what the device turned out to handle
+                for smaller in batches(batch):
+                    await read_batch(smaller)
+                return
+
+            for object_identifier, _, _, property_value in results:
+                # access errors come back in place of the value
+                if isinstance(property_value, ErrorType):
+                    property_value = None
+                values[str(object_identifier)] = property_value
+
+        def batches(items):
+            size = batch_size(record, result_bytes, state.max_batch)
+            return [items[start : start + size] for start in range(0, len(items), size)]
+
+        await asyncio.gather(*(read_batch(batch) for batch in batches(objects)))
+        return values
+
+    def report(self, priorities: Optional[List[int]] = None) -> Dict[str, Any]:
+        """
+        Active overrides grouped by priority, then device, from the latest
+        scan of every device.
+        """
+        by_priority: Dict[int, Dict[int, List[Dict[str, Any]]]] = {}
+        for device_instance, state in sorted(self.devices.items()):
+            for override in state.overrides:
+                priority = override["priority"]
+                if priorities and priority not in priorities:
+                    continue
+                by_priority.setdefault(priority, {}).setdefault(device_instance, []).append(
+                    {
+                        "object_identifier": override["object_identifier"],
+                        "value": override["value"],
+                        "first_seen": override["first_seen"],
+                    }
+                )
+
+        return {
+            "scan": self.last_scan,
+            "total": sum(
+                len(points) for devices in by_priority.values() for points in devices.values()
+            ),
+            "priorities": [
+                {
+                    "priority": priority,
+                    "name": PRIORITY_NAMES.get(priority),
+                    "count": sum(len(points) for points in devices.values()),
+                    "devices": [
+                        {"device_instance": device_instance, "points": points}
+                        for device_instance, points in devices.items()
+                    ],
+                }
+                for priority, devices in sorted(by_priority.items())
+            ],
+            "errors": {
+                device_instance: state.error
+                for device_instance, state in self.devices.items()
+                if state.error
+            },
+        }
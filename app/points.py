@@ -0,0 +1,289 @@
+import array
+import sys
+import time
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# (device instance, object identifier, property identifier)
+PointKey = Tuple[int, str, str]
+
+# status flags, one byte per point, the low bits say how the value is stored
+KIND_FLOAT = 0x00
+KIND_INT = 0x01
+KIND_BOOL = 0x02
+KIND_LABEL = 0x03  # index into the label table
+KIND_OBJECT = 0x04  # anything else, kept in a side table
+KIND_MASK = 0x07
+STALE = 0x08
+
+# strings up to this length are interned as labels (active, inactive,
+# multi-state texts), longer ones are kept as objects
+MAX_LABEL_LENGTH = 64
+MAX_LABELS = 65536
+
+# integers beyond this lose precision as doubles
+MAX_EXACT_INT = 2**53
+
+# rows the columns start with, they double when full
+INITIAL_CAPACITY = 1024
+
+# a point's index key packs the device instance (22 bits) with codes for
+# the object identifier and property names into one small integer
+OBJECT_CODE_BITS = 24
+PROPERTY_CODE_BITS = 12
+
+
+class PointCache:
+    """
+    Last-known values of the points read from the field bus, already JSON
+    encoded the same way the REST API returns them.
+
+    The values are stored column-wise, every point gets an integer ID and its
+    value, timestamp and version sit in typed arrays next to a byte of status
+    flags, so a large site costs tens of bytes per point instead of a dict of
+    Python objects each. `columns()` hands the arrays out without copying.
+    """
+
+    def __init__(self):
+        # name -> ID index, object identifiers and property names are coded
+        # once so the index key is an int rather than a tuple of strings
+        self.ids: Dict[int, int] = {}
+        self.object_codes: Dict[str, int] = {}
+        self.object_names: List[str] = []
+        self.property_codes: Dict[str, int] = {}
+        self.property_names: List[str] = []
+
+        self.count = 0
+        self.capacity = 0
+        self.devices = array.array("I")
+        self.objects_column = array.array("I")
+        self.properties = array.array("H")
+        self.values = array.array("d")
+        self.timestamps = array.array("d")
+        self.versions = array.array("Q")
+        self.flags = bytearray()
+        self._grow(INITIAL_CAPACITY)
+
+        self.labels: List[str] = []
+        self.label_ids: Dict[str, int] = {}
+        self.objects: Dict[int, Any] = {}
+
+        # bumped every time a value changes, each point keeps the version it
+        # was last changed at so responses built from it can be validated
+        self.version = 0
+
+        # optional copy of every entry for other processes, anything with a
+        # publish(key, entry) method such as the gateway's shared point table
+        self.mirror = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _grow(self, capacity: int) -> None:
+        # new arrays instead of resizing in place, views handed out by
+        # columns() keep pointing at the old ones and stay valid
+        extra = capacity - self.capacity
+        for name in ("devices", "objects_column", "properties", "values", "timestamps", "versions"):
+            column = getattr(self, name)
+            grown = array.array(column.typecode, column.tobytes() + bytes(column.itemsize * extra))
+            setattr(self, name, grown)
+        self.flags = self.flags + bytes(extra)
+        self.capacity = capacity
+
+    def _code(self, codes: Dict[str, int], names: List[str], name: str, bits: int) -> int:
+        code = codes.get(name)
+        if code is None:
+            if len(names) >= 1 << bits:
+                raise OverflowError(f"more than {1 << bits} distinct names")
+            code = codes[name] = len(names)
+            names.append(sys.intern(name))
+        return code
+
+    def _index_key(
+        self, device_instance: int, object_code: int, property_code: int
+    ) -> int:
+        return (
+            ((device_instance << OBJECT_CODE_BITS) | object_code) << PROPERTY_CODE_BITS
+        ) | property_code
+
+    def point_id(
+        self, device_instance: int, object_identifier: str, property_identifier: str
+    ) -> Optional[int]:
+        object_code = self.object_codes.get(object_identifier)
+        property_code = self.property_codes.get(property_identifier)
+        if object_code is None or property_code is None:
+            return None
+        return self.ids.get(self._index_key(device_instance, object_code, property_code))
+
+    def key(self, point_id: int) -> PointKey:
+        return (
+            self.devices[point_id],
+            self.object_names[self.objects_column[point_id]],
+            self.property_names[self.properties[point_id]],
+        )
+
+    def _add(
+        self, device_instance: int, object_identifier: str, property_identifier: str
+    ) -> int:
+        object_code = self._code(
+            self.object_codes, self.object_names, object_identifier, OBJECT_CODE_BITS
+        )
+        property_code = self._code(
+            self.property_codes, self.property_names, property_identifier, PROPERTY_CODE_BITS
+        )
+
+        if self.count == self.capacity:
+            self._grow(self.capacity * 2)
+        point_id = self.count
+        self.count += 1
+
+        self.devices[point_id] = device_instance
+        self.objects_column[point_id] = object_code
+        self.properties[point_id] = property_code
+        self.ids[self._index_key(device_instance, object_code, property_code)] = point_id
+        return point_id
+
+    def _encode(self, value: Any) -> Tuple[int, float]:
+        """Storage kind and number of a value, KIND_OBJECT values aren't numbers."""
+        if isinstance(value, bool):
+            return KIND_BOOL, float(value)
+        if isinstance(value, int):
+            if -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+                return KIND_INT, float(value)
+            return KIND_OBJECT, 0.0
+        if isinstance(value, float):
+            return KIND_FLOAT, value
+        if isinstance(value, str) and len(value) <= MAX_LABEL_LENGTH:
+            label_id = self.label_ids.get(value)
+            if label_id is None and len(self.labels) < MAX_LABELS:
+                label_id = self.label_ids[value] = len(self.labels)
+                self.labels.append(sys.intern(value))
+            if label_id is not None:
+                return KIND_LABEL, float(label_id)
+        return KIND_OBJECT, 0.0
+
+    def value(self, point_id: int) -> Any:
+        kind = self.flags[point_id] & KIND_MASK
+        if kind == KIND_FLOAT:
+            return self.values[point_id]
+        if kind == KIND_INT:
+            return int(self.values[point_id])
+        if kind == KIND_BOOL:
+            return bool(self.values[point_id])
+        if kind == KIND_LABEL:
+            return self.labels[int(self.values[point_id])]
+        return self.objects[point_id]
+
+    def update(
+        self,
+        device_instance: int,
+        object_identifier: str,
+        property_identifier: str,
+        value: Any,
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """
+        Record a freshly read value.
+        """
+        timestamp = timestamp or time.time()
+        if type(value) is float:
+            kind, number = KIND_FLOAT, value
+        else:
+            kind, number = self._encode(value)
+
+        # point_id() inlined, this runs for every value of every poll
+        object_code = self.object_codes.get(object_identifier)
+        property_code = self.property_codes.get(property_identifier)
+        point_id = None
+        if object_code is not None and property_code is not None:
+            point_id = self.ids.get(
+                (((device_instance << OBJECT_CODE_BITS) | object_code) << PROPERTY_CODE_BITS)
+                | property_code
+            )
+        if point_id is None:
+            point_id = self._add(device_instance, object_identifier, property_identifier)
+            changed = True
+        elif kind == KIND_OBJECT:
+            changed = self.objects.get(point_id) != value
+        else:
+            old_kind = self.flags[point_id] & KIND_MASK
+            changed = old_kind != kind or self.values[point_id] != number
+
+        if changed:
+            self.values[point_id] = number
+            if kind == KIND_OBJECT:
+                self.objects[point_id] = value
+            else:
+                self.objects.pop(point_id, None)
+            self.version += 1
+            self.versions[point_id] = self.version
+            self.flags[point_id] = kind
+        else:
+            self.flags[point_id] &= ~STALE
+        self.timestamps[point_id] = timestamp
+
+        if self.mirror is not None:
+            self.mirror.publish(self.key(point_id), self.entry(point_id))
+
+    def entry(self, point_id: int) -> Dict[str, Any]:
+        return {
+            "value": self.value(point_id),
+            "timestamp": self.timestamps[point_id],
+            "stale": bool(self.flags[point_id] & STALE),
+            "version": self.versions[point_id],
+        }
+
+    def get(
+        self, device_instance: int, object_identifier: str, property_identifier: str
+    ) -> Optional[Dict[str, Any]]:
+        point_id = self.point_id(device_instance, object_identifier, property_identifier)
+        if point_id is None:
+            return None
+        return self.entry(point_id)
+
+    def columns(self) -> Dict[str, memoryview]:
+        """
+        Zero-copy views of the columns, row N is point ID N. Numbers of
+        label and object values are meaningless, check the kind in `flags`.
+        Points added later aren't in the views, call again for a fresh set.
+        """
+        count = self.count
+        return {
+            "devices": memoryview(self.devices)[:count],
+            "values": memoryview(self.values)[:count],
+            "timestamps": memoryview(self.timestamps)[:count],
+            "versions": memoryview(self.versions)[:count],
+            "flags": memoryview(self.flags)[:count],
+        }
+
+    def publish_all(self) -> None:
+        """Copy every entry to the mirror, after it is attached."""
+        for point_id in range(self.count):
+            self.mirror.publish(self.key(point_id), self.entry(point_id))
+
+    def to_json(self) -> List[list]:
+        """
+        Compact rows for the state snapshot.
+        """
+        timestamps = self.columns()["timestamps"]
+        return [
+            [*self.key(point_id), self.value(point_id), timestamps[point_id]]
+            for point_id in range(self.count)
+        ]
+
+    def load_json(self, rows: List[list]) -> None:
+        """
+        Restore rows written by `to_json`, every value is stale until it is
+        read from the device again.
+        """
+        for device_instance, object_identifier, property_identifier, value, timestamp in rows:
+            self.update(
+                device_instance, object_identifier, property_identifier, value, timestamp
+            )
+            point_id = self.point_id(device_instance, object_identifier, property_identifier)
+            self.flags[point_id] |= STALE
+        _log.debug("restored %d point values", len(rows))
@@ -0,0 +1,279 @@
+import dataclasses
+import heapq
+import itertools
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+from bacpypes3.primitivedata import ObjectIdentifier
+
+from app.overrides import RPM_OVERHEAD_BYTES
+from app.points import PointKey
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# encoded size estimates of a ReadPropertyMultiple request and its response,
+# per object (its identifier and the tags around its list) and per property
+# (its identifier, and in the response the value and the tags around it)
+OBJECT_REQUEST_BYTES = 7
+PROPERTY_REQUEST_BYTES = 3
+OBJECT_RESULT_BYTES = 7
+PROPERTY_RESULT_BYTES = 12
+
+# a device that segments may answer over this many segments, more would put
+# a whole group at the mercy of one lost segment on an MS/TP trunk
+SEGMENTED_RESPONSE_APDUS = 4
+
+# most properties read with one request, whatever the device's APDU
+MAX_GROUP_PROPERTIES = 128
+
+
+@dataclasses.dataclass
+class RequestGroup:
+    """Properties of one device that are read with one ReadPropertyMultiple."""
+
+    device_instance: int
+    points: List[PointKey]
+    request_bytes: int
+    response_bytes: int
+    offset: float = 0.0  # share of its network's poll round before it starts
+
+    def parameter_list(self) -> list:
+        """Alternating object identifiers and property lists, for read_property_multiple."""
+        parameter_list = []
+        for object_identifier, keys in itertools.groupby(self.points, key=lambda key: key[1]):
+            parameter_list.append(ObjectIdentifier(object_identifier))
+            parameter_list.append([key[2] for key in keys])
+        return parameter_list
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "points": [
+                {"object_identifier": key[1], "property_identifier": key[2]}
+                for key in self.points
+            ],
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "offset": round(self.offset, 4),
+        }
+
+
+@dataclasses.dataclass
+class DevicePlan:
+    """The request groups of one device and what they were packed from."""
+
+    device_instance: int
+    network: Optional[int]  # None while the device isn't in the registry
+    fingerprint: Optional[tuple]
+    groups: List[RequestGroup]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "device_instance": self.device_instance,
+            "network": self.network,
+            "groups": [group.to_json() for group in self.groups],
+        }
+
+
+def pack(
+    device_instance: int,
+    points: Iterable[PointKey],
+    max_apdu: int,
+    segmented: bool,
+    max_properties: int = MAX_GROUP_PROPERTIES,
+) -> List[RequestGroup]:
+    """
+    Fill requests in object order until the request would no longer fit the
+    device's max APDU, or the response wouldn't fit one APDU (a few for a
+    device that segments), so the properties of an object stay together.
+    """
+    request_limit = max(1, max_apdu - RPM_OVERHEAD_BYTES)
+    response_limit = request_limit * (SEGMENTED_RESPONSE_APDUS if segmented else 1)
+
+    groups: List[RequestGroup] = []
+    group: Optional[RequestGroup] = None
+    for key in sorted(set(points)):
+        same_object = group is not None and group.points[-1][1] == key[1]
+        request_bytes = PROPERTY_REQUEST_BYTES + (0 if same_object else OBJECT_REQUEST_BYTES)
+        response_bytes = PROPERTY_RESULT_BYTES + (0 if same_object else OBJECT_RESULT_BYTES)
+        if (
+            group is None
+            or len(group.points) >= max_properties
+            or group.request_bytes + request_bytes > request_limit
+            or group.response_bytes + response_bytes > response_limit
+        ):
+            group = RequestGroup(device_instance, [], 0, 0)
+            groups.append(group)
+            request_bytes = PROPERTY_REQUEST_BYTES + OBJECT_REQUEST_BYTES
+            response_bytes = PROPERTY_RESULT_BYTES + OBJECT_RESULT_BYTES
+        group.points.append(key)
+        group.request_bytes += request_bytes
+        group.response_bytes += response_bytes
+    return groups
+
+
+def spread(taken: Iterable[float], count: int) -> List[float]:
+    """
+    `count` new offsets in [0, 1), evenly apart on an empty round, otherwise
+    each in the middle of the largest gap left between the ones taken, so
+    the groups already planned keep their place.
+    """
+    taken = sorted(taken)
+    if not taken:
+        return [index / count for index in range(count)]
+
+    # (-length, start) of the gaps, the last one wraps around to the first
+    gaps = [(-(end - start), start) for start, end in zip(taken, taken[1:])]
+    gaps.append((-(taken[0] + 1.0 - taken[-1]), taken[-1]))
+    heapq.heapify(gaps)
+    offsets = []
+    for _ in range(count):
+        length, start = heapq.heappop(gaps)
+        half = -length / 2
+        offsets.append((start + half) % 1.0)
+        heapq.heappush(gaps, (-half, start))
+        heapq.heappush(gaps, (-half, start + half))
+    return offsets
+
+
+class PollPlanCompiler:
+    """
+    Turns the points to poll and what the registry knows about their devices
+    into request groups, each read with one ReadPropertyMultiple sized to its
+    device's max APDU and segmentation support. Every group gets an offset
+    into its network's poll round, groups of the same network are spread
+    evenly over it and those of one device are kept apart, so the reads of
+    a network don't come in bursts.
+
+    Compiling again only packs the devices whose points, registry entry or
+    limits changed, their new groups go into the gaps the others leave.
+    """
+
+    def __init__(self, max_properties: int = MAX_GROUP_PROPERTIES):
+        self.max_properties = max_properties
+        self.devices: Dict[int, DevicePlan] = {}
+
+        # lowered for devices that turned out to handle less, 1 for devices
+        # without ReadPropertyMultiple
+        self.device_limits: Dict[int, int] = {}
+
+        self.groups: Dict[PointKey, RequestGroup] = {}
+        self.revision = 0
+
+    def group(self, key: PointKey) -> Optional[RequestGroup]:
+        return self.groups.get(key)
+
+    def network_groups(self, network: int) -> int:
+        """Groups in the poll round of a network."""
+        return sum(
+            len(plan.groups) for plan in self.devices.values() if plan.network == network
+        )
+
+    def limit(self, device_instance: int, max_properties: int) -> None:
+        """Pack the device's groups smaller from the next compile on."""
+        self.device_limits[device_instance] = max(1, max_properties)
+
+    def compile(self, points: Iterable[PointKey], registry) -> Dict[str, int]:
+        by_device: Dict[int, List[PointKey]] = {}
+        for key in points:
+            by_device.setdefault(key[0], []).append(key)
+
+        removed = [
+            device_instance for device_instance in self.devices if device_instance not in by_device
+        ]
+        changed = []
+        for device_instance, keys in by_device.items():
+            record = registry.get(device_instance)
+            max_properties = self.device_limits.get(device_instance, self.max_properties)
+            fingerprint = (
+                (record.network, record.max_apdu, record.segmented, max_properties, frozenset(keys))
+                if record
+                else None
+            )
+            plan = self.devices.get(device_instance)
+            if plan is not None and plan.fingerprint == fingerprint:
+                continue
+
+            # devices not found yet are planned once they are, until then
+            # their points are read one by one
+            groups = (
+                pack(device_instance, keys, record.max_apdu, record.segmented, max_properties)
+                if record
+                else []
+            )
+            changed.append(
+                DevicePlan(device_instance, record.network if record else None, fingerprint, groups)
+            )
+
+        if not changed and not removed:
+            return {"devices": len(self.devices), "compiled": 0, "removed": 0}
+
+        for device_instance in removed + [plan.device_instance for plan in changed]:
+            plan = self.devices.pop(device_instance, None)
+            for group in plan.groups if plan else []:
+                for key in group.points:
+                    del self.groups[key]
+        self._stagger(changed)
+        for plan in changed:
+            self.devices[plan.device_instance] = plan
+            for group in plan.groups:
+                for key in group.points:
+                    self.groups[key] = group
+        self.revision += 1
+
+        compiled = sum(1 for plan in changed if plan.groups)
+        _log.info(
+            "Poll plan %d: %d devices packed, %d removed, %d groups in all",
+            self.revision,
+            compiled,
+            len(removed),
+            sum(len(plan.groups) for plan in self.devices.values()),
+        )
+        return {"devices": len(self.devices), "compiled": compiled, "removed": len(removed)}
+
+    def _stagger(self, plans: List[DevicePlan]) -> None:
+        """Offsets of the new groups, network by network."""
+        by_network: Dict[int, List[DevicePlan]] = {}
+        for plan in plans:
+            if plan.groups:
+                by_network.setdefault(plan.network, []).append(plan)
+
+        for network, network_plans in by_network.items():
+            taken = [
+                group.offset
+                for plan in self.devices.values()
+                if plan.network == network
+                for group in plan.groups
+            ]
+            # one group of every device in turn, so neighbours in the round
+            # are different devices
+            new_groups = [
+                group
+                for groups in itertools.zip_longest(*(plan.groups for plan in network_plans))
+                for group in groups
+                if group is not None
+            ]
+            for group, offset in zip(new_groups, spread(taken, len(new_groups))):
+                group.offset = offset
+
+    def to_json(self) -> Dict[str, Any]:
+        networks: Dict[Any, Dict[str, Any]] = {}
+        for plan in self.devices.values():
+            network = networks.setdefault(
+                plan.network, {"network": plan.network, "devices": 0, "groups": 0, "points": 0}
+            )
+            network["devices"] += 1
+            network["groups"] += len(plan.groups)
+            network["points"] += sum(len(group.points) for group in plan.groups)
+        return {
+            "revision": self.revision,
+            "networks": sorted(
+                networks.values(),
+                key=lambda network: (network["network"] is None, network["network"] or 0),
+            ),
+            "devices": [
+                self.devices[device_instance].to_json()
+                for device_instance in sorted(self.devices)
+            ],
+        }
@@ -0,0 +1,634 @@
+import asyncio
+import heapq
+import logging
+import math
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from bacpypes3.apdu import AbortPDU, ErrorRejectAbortNack, RejectPDU
+from bacpypes3.basetypes import ErrorType
+from bacpypes3.primitivedata import ObjectIdentifier
+
+from app.historian import sample_value
+from app.points import PointKey
+from app.poll_plan import PollPlanCompiler, RequestGroup
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# default bounds of a point's poll interval, in seconds
+MIN_POLL_INTERVAL = 5.0
+MAX_POLL_INTERVAL = 300.0
+
+# used when neither the point list nor the device gives a COV increment
+DEFAULT_COV_INCREMENT = 0.5
+
+# weight of the newest rate of change in its moving average
+RATE_SMOOTHING = 0.3
+
+# how fast the interval of a quiet point grows, per poll
+INTERVAL_GROWTH = 1.5
+
+# requests per second the poller may send to one network, BACnet/IP on the
+# local network (0) has room to spare, a routed MS/TP trunk at 38400 baud
+# is shared with the controllers' own traffic
+LOCAL_NETWORK_BUDGET = 50.0
+MSTP_NETWORK_BUDGET = 5.0
+
+# how often a stack that only polls its own devices looks for the device of
+# a point again, it may be discovered in the meantime
+UNKNOWN_DEVICE_RECHECK = 30.0
+
+# reads outstanding at once across all networks
+POLL_CONCURRENCY = 16
+
+# a point due within this share of its interval is read early along with
+# its group, rather than on its own a moment later
+GROUP_SLACK = 0.5
+
+# how often the poll plan is checked against the site model and registry
+PLAN_CHECK_INTERVAL = 30.0
+
+
+class PolledPoint:
+    """Poll state of one configured point."""
+
+    __slots__ = (
+        "key",
+        "min_interval",
+        "max_interval",
+        "cov_increment",
+        "interval",
+        "network",
+        "next_due",
+        "last_value",
+        "last_number",
+        "last_read",
+        "rate",
+        "effective_interval",
+        "reads",
+        "errors",
+        "deferred",
+    )
+
+    def __init__(
+        self,
+        key: PointKey,
+        min_interval: float,
+        max_interval: float,
+        cov_increment: Optional[float],
+    ):
+        self.key = key
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cov_increment = cov_increment
+        self.interval = min_interval
+        self.network = 0
+        self.next_due = 0.0
+        self.last_value: Any = None
+        self.last_number: Optional[float] = None
+        self.last_read: Optional[float] = None
+        self.rate: Optional[float] = None  # smoothed change per second
+        self.effective_interval: Optional[float] = None  # smoothed, as polled
+        self.reads = 0
+        self.errors = 0
+        self.deferred = 0
+
+    def to_json(self) -> Dict[str, Any]:
+        device_instance, object_identifier, property_identifier = self.key
+        return {
+            "device_instance": device_instance,
+            "object_identifier": object_identifier,
+            "property_identifier": property_identifier,
+            "network": self.network,
+            "interval": round(self.interval, 3),
+            "effective_interval": round(self.effective_interval, 3)
+            if self.effective_interval is not None
+            else None,
+            "min_interval": self.min_interval,
+            "max_interval": self.max_interval,
+            "cov_increment": self.cov_increment,
+            "rate": self.rate,
+            # monotonic internally, wall clock time for the API
+            "last_read": time.time() - (time.monotonic() - self.last_read)
+            if self.last_read is not None
+            else None,
+            "reads": self.reads,
+            "errors": self.errors,
+            "deferred": self.deferred,
+        }
+
+
+class TokenBucket:
+    """Request budget of one network, `rate` per second with a second of burst."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.taken = 0
+
+    def take(self, now: float) -> float:
+        """Spend a token, or return how long until one is available."""
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.taken += 1
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class AdaptivePoller:
+    """
+    Polls the points of the `points` configuration into the point cache, each
+    at its own interval. A point's interval follows the time its value takes
+    to move by its COV increment at the observed rate of change, within the
+    point's min and max interval. When the points of one network want more
+    requests per second than its budget, all their intervals are stretched
+    by the same factor and a token bucket holds the network to the budget.
+
+    A point list item looks like
+
+        {"device_instance": 201201, "object_identifier": "analog-input,2",
+         "property_identifier": "present-value", "min_interval": 5,
+         "max_interval": 300, "cov_increment": 0.25}
+
+    and only the first two fields are required. The points of the site model
+    are polled as well, at the default intervals.
+
+    Points of one device are read together with ReadPropertyMultiple in the
+    request groups of the poll plan (see app.poll_plan), a point that comes
+    due takes along the points of its group that are nearly due. New points
+    start at their group's offset into the network's poll round.
+    """
+
+    def __init__(
+        self,
+        app,
+        local_budget: float = LOCAL_NETWORK_BUDGET,
+        mstp_budget: float = MSTP_NETWORK_BUDGET,
+        budgets: Optional[Dict[int, float]] = None,
+        concurrency: int = POLL_CONCURRENCY,
+    ):
+        self.app = app
+        self.local_budget = local_budget
+        self.mstp_budget = mstp_budget
+        self.budgets = dict(budgets or {})
+
+        self.points: Dict[PointKey, PolledPoint] = {}
+
+        # (due, sequence, key), entries of removed or rescheduled points are
+        # skipped when they come up
+        self.queue: List[Tuple[float, int, PointKey]] = []
+        self._sequence = 0
+
+        # network -> token bucket, and the requests per second its points
+        # would send at their adapted intervals, a group is read as often as
+        # its fastest point. Counted again whenever the plan changes.
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.demand: Dict[int, float] = {}
+        self._demand_revision: Optional[int] = None
+
+        # with several BACnet stacks every one loads the whole point list,
+        # a stack then only polls the devices in its own registry
+        self.known_devices_only = False
+
+        # request groups of the points, packed again when the points or
+        # their devices change
+        self.plan = PollPlanCompiler()
+        self._site_revision: Optional[int] = None
+
+        self.limit = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._reads = set()
+
+    def budget(self, network: int) -> float:
+        if network in self.budgets:
+            return self.budgets[network]
+        return self.local_budget if network == 0 else self.mstp_budget
+
+    def stretch(self, network: int) -> float:
+        """Factor the network's intervals are stretched by to fit its budget."""
+        self._check_demand()
+        return max(1.0, self.demand.get(network, 0.0) / self.budget(network))
+
+    def _group_rate(self, group: RequestGroup) -> float:
+        """Requests per second of a group, read whenever its fastest point is due."""
+        return max(
+            (1.0 / self.points[key].interval for key in group.points if key in self.points),
+            default=0.0,
+        )
+
+    def _check_demand(self) -> None:
+        """Count the demand of every network again if the plan changed since."""
+        if self._demand_revision == self.plan.revision:
+            return
+        demand: Dict[int, float] = {}
+        counted = set()
+        for point in self.points.values():
+            group = self.plan.group(point.key)
+            if group is None:
+                rate = 1.0 / point.interval
+            elif id(group) in counted:
+                continue
+            else:
+                counted.add(id(group))
+                rate = self._group_rate(group)
+            demand[point.network] = demand.get(point.network, 0.0) + rate
+        self.demand = demand
+        self._demand_revision = self.plan.revision
+
+    def _bucket(self, network: int) -> TokenBucket:
+        bucket = self.buckets.get(network)
+        if bucket is None:
+            bucket = self.buckets[network] = TokenBucket(self.budget(network))
+        return bucket
+
+    def poll_round(self, network: int) -> float:
+        """Time the budget of a network needs to read every group of it once."""
+        return max(MIN_POLL_INTERVAL, self.plan.network_groups(network) / self.budget(network))
+
+    def config_changed(self, collection: str) -> None:
+        if collection == "points":
+            self.load(self.app.config_store.get("points"))
+
+    def load(self, items: Dict[str, Any]) -> None:
+        """Start polling new points of the point list, stop polling removed ones."""
+        now = time.monotonic()
+        wanted = {}
+        for name, item in items.items():
+            if not isinstance(item, dict) or "device_instance" not in item:
+                continue
+            try:
+                key = (
+                    int(item["device_instance"]),
+                    str(ObjectIdentifier(item["object_identifier"])),
+                    item.get("property_identifier", "present-value"),
+                )
+                min_interval = float(item.get("min_interval", MIN_POLL_INTERVAL))
+                max_interval = max(
+                    min_interval, float(item.get("max_interval", MAX_POLL_INTERVAL))
+                )
+                cov_increment = item.get("cov_increment")
+                if cov_increment is not None:
+                    cov_increment = float(cov_increment)
+            except (KeyError, TypeError, ValueError) as e:
+                _log.error(f"Invalid point {name} in the point list: {e}")
+                continue
+            wanted[key] = (min_interval, max_interval, cov_increment)
+
+        for key in self.site_points():
+            wanted.setdefault(key, (MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, None))
+
+        for key in [key for key in self.points if key not in wanted]:
+            del self.points[key]
+
+        self.plan.compile(wanted, self.app.registry)
+
+        for key, (min_interval, max_interval, cov_increment) in wanted.items():
+            point = self.points.get(key)
+            if point is None:
+                point = self.points[key] = PolledPoint(
+                    key, min_interval, max_interval, cov_increment
+                )
+                point.network = self._network(key[0])
+                # spread the first reads out instead of sending them at
+                # once, a point with a group starts at the group's offset
+                group = self.plan.group(key)
+                if group is None:
+                    self._schedule(point, now + random.uniform(0.0, min_interval))
+                else:
+                    self._schedule(point, now + group.offset * self.poll_round(point.network))
+            else:
+                point.min_interval = min_interval
+                point.max_interval = max_interval
+                if cov_increment is not None:
+                    point.cov_increment = cov_increment
+                self._set_interval(point, point.interval)
+
+        # points came and went, count from scratch
+        self._demand_revision = None
+        _log.info("Polling %d points", len(self.points))
+        self._wakeup.set()
+
+    def site_points(self) -> List[PointKey]:
+        """Present values of the site model points that have a BACnet address."""
+        self._site_revision = self.app.site_model.revision
+        keys = []
+        for point in self.app.site_model.points():
+            if point["device_instance"] is None or not point["object_identifier"]:
+                continue
+            try:
+                object_identifier = str(ObjectIdentifier(point["object_identifier"]))
+            except (TypeError, ValueError):
+                continue
+            keys.append((int(point["device_instance"]), object_identifier, "present-value"))
+        return keys
+
+    async def watch(self, interval: float = PLAN_CHECK_INTERVAL) -> None:
+        """
+        Load the points again when the site model changed, otherwise pack
+        the groups of devices found or changed in the registry since.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.app.site_model.revision != self._site_revision:
+                    self.load(self.app.config_store.get("points"))
+                else:
+                    self.plan.compile(self.points, self.app.registry)
+            except Exception as e:
+                _log.error(f"Error compiling the poll plan: {e}")
+
+    def _network(self, device_instance: int) -> int:
+        record = self.app.registry.get(device_instance)
+        return record.network if record else 0
+
+    def _schedule(self, point: PolledPoint, due: float) -> None:
+        point.next_due = due
+        self._sequence += 1
+        heapq.heappush(self.queue, (due, self._sequence, point.key))
+
+    def _set_interval(self, point: PolledPoint, interval: float) -> None:
+        interval = min(point.max_interval, max(point.min_interval, interval))
+        self._check_demand()
+        group = self.plan.group(point.key)
+        if group is None or point.key not in self.points:
+            before = 1.0 / point.interval
+            point.interval = interval
+            after = 1.0 / point.interval
+        else:
+            before = self._group_rate(group)
+            point.interval = interval
+            after = self._group_rate(group)
+        self.demand[point.network] = self.demand.get(point.network, 0.0) + after - before
+
+    async def run(self) -> None:
+        self.load(self.app.config_store.get("points"))
+
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            if not self.queue:
+                await self._wakeup.wait()
+                continue
+
+            due, _, key = self.queue[0]
+            if due > now:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.queue)
+            point = self.points.get(key)
+            if point is None or point.next_due != due:
+                continue
+
+            if self.known_devices_only:
+                if self.app.registry.get(key[0]) is None:
+                    # another stack's device, or not found yet, look again
+                    # later without claiming the network's budget meanwhile
+                    self._set_interval(point, point.max_interval)
+                    self._schedule(point, now + UNKNOWN_DEVICE_RECHECK)
+                    continue
+                if point.last_read is None and not point.errors:
+                    # found since, start from the fastest rate like a new point
+                    self._set_interval(point, point.min_interval)
+
+            wait = self._bucket(point.network).take(now)
+            if wait:
+                # over budget, the point waits for the network to have room
+                point.deferred += 1
+                self._schedule(point, now + wait)
+                continue
+
+            # the points of the group that would come due soon are read
+            # along, they are in flight until rescheduled
+            points = [point]
+            group = self.plan.group(key)
+            if group is not None:
+                for member_key in group.points:
+                    member = self.points.get(member_key)
+                    if (
+                        member is not None
+                        and member is not point
+                        and member.next_due - now <= GROUP_SLACK * member.interval
+                    ):
+                        member.next_due = math.inf
+                        points.append(member)
+
+            await self.limit.acquire()
+            task = asyncio.create_task(self._poll(points))
+            self._reads.add(task)
+            task.add_done_callback(self._read_done)
+
+    def _read_done(self, task: asyncio.Task) -> None:
+        self._reads.discard(task)
+        self.limit.release()
+
+    async def _poll(self, points: List[PolledPoint]) -> None:
+        started = time.monotonic()
+        for point in points:
+            if point.cov_increment is None and point.key[2] == "present-value":
+                # a request of its own on the network like any other
+                await self._take(point.network)
+                try:
+                    point.cov_increment = await self._cov_increment(point)
+                except Exception as e:
+                    _log.debug("cov-increment of %r: %s", point.key, e)
+
+        values = await self._read(points)
+        now = time.monotonic()
+        for point, value in zip(points, values):
+            if self.points.get(point.key) is not point:
+                # removed from the point list while it was being read, its
+                # demand is already gone from the network
+                continue
+
+            if isinstance(value, HTTPException):
+                # unreachable or misconfigured, back off
+                point.errors += 1
+                self._set_interval(point, point.interval * 2)
+                _log.debug("poll of %r failed: %s", point.key, value.detail)
+            elif isinstance(value, Exception):
+                point.errors += 1
+                self._set_interval(point, point.interval * 2)
+                _log.error(f"Error polling {point.key}: {value}")
+            else:
+                self.adapt(point, value, now)
+
+            # the device may have been found behind a router since the last poll
+            network = self._network(point.key[0])
+            if network != point.network:
+                point.network = network
+                self._demand_revision = None
+
+            self._schedule(point, started + point.interval * self.stretch(point.network))
+        self._wakeup.set()
+
+    async def _take(self, network: int) -> None:
+        """Wait for a token of the network's bucket."""
+        while True:
+            wait = self._bucket(network).take(time.monotonic())
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _read(self, points: List[PolledPoint]) -> List[Any]:
+        """
+        The value of each point, or the exception reading it raised. Several
+        points (of one device) are read with one ReadPropertyMultiple, a
+        device that rejects it or can't fit the response gets smaller groups
+        from then on and the points are read one by one this time.
+        """
+        if len(points) == 1:
+            device_instance, object_identifier, property_identifier = points[0].key
+            try:
+                result = await self.app._read_property(
+                    device_instance, object_identifier, property_identifier
+                )
+                return [result[property_identifier]]
+            except Exception as e:
+                return [e]
+
+        device_instance = points[0].key[0]
+        group = RequestGroup(device_instance, sorted(point.key for point in points), 0, 0)
+        try:
+            self.app.health.check(device_instance)
+            device_address = await self.app._device_address(device_instance)
+            with self.app.health.track(device_instance):
+                results = await self.app.bacnet_app.read_property_multiple(
+                    device_address, group.parameter_list()
+                )
+        except (RejectPDU, AbortPDU) as err:
+            if isinstance(err, RejectPDU) and str(err) == "unrecognized-service":
+                _log.info("Device %r doesn't support ReadPropertyMultiple", device_instance)
+                self.plan.limit(device_instance, 1)
+            elif isinstance(err, AbortPDU) and str(err) in (
+                "segmentation-not-supported",
+                "buffer-overflow",
+            ):
+                self.plan.limit(device_instance, len(points) // 2)
+            else:
+                return [HTTPException(status_code=400, detail=f"error/reject/abort: {err}")] * len(points)
+            self.plan.compile(self.points, self.app.registry)
+            return [(await self._read([point]))[0] for point in points]
+        except ErrorRejectAbortNack as err:
+            return [HTTPException(status_code=400, detail=f"error/reject/abort: {err}")] * len(points)
+        except Exception as e:
+            return [e] * len(points)
+
+        values: Dict[PointKey, Any] = {}
+        for object_identifier, property_identifier, _, property_value in results:
+            key = (device_instance, str(object_identifier), str(property_identifier))
+            # access errors come back in place of the value
+            if isinstance(property_value, ErrorType):
+                values[key] = HTTPException(
+                    status_code=400, detail=f"error: {property_value.errorCode}"
+                )
+                continue
+            try:
+                values[key] = self.app._encode_read(
+                    device_instance, object_identifier, key[2], property_value
+                )[key[2]]
+            except Exception as e:
+                values[key] = e
+        return [
+            values.get(
+                point.key, HTTPException(status_code=400, detail="missing from the response")
+            )
+            for point in points
+        ]
+
+    async def _cov_increment(self, point: PolledPoint) -> Optional[float]:
+        """The object's own COV increment, DEFAULT_COV_INCREMENT if it has none."""
+        device_instance, object_identifier, _ = point.key
+        try:
+            self.app.health.check(device_instance)
+            device_address = await self.app._device_address(device_instance)
+            with self.app.health.track(device_instance):
+                value = await self.app.bacnet_app.read_property(
+                    device_address, ObjectIdentifier(object_identifier), "cov-increment"
+                )
+            if isinstance(value, (int, float)) and value > 0:
+                return float(value)
+        except ErrorRejectAbortNack:
+            pass
+        return DEFAULT_COV_INCREMENT
+
+    def adapt(self, point: PolledPoint, value: Any, now: float) -> None:
+        """Pick the next interval of a point from its newly read value."""
+        number = sample_value(value)
+        if point.last_read is not None:
+            elapsed = max(now - point.last_read, 1e-3)
+            point.effective_interval = (
+                elapsed
+                if point.effective_interval is None
+                else RATE_SMOOTHING * elapsed + (1 - RATE_SMOOTHING) * point.effective_interval
+            )
+
+            if number is not None and point.last_number is not None and point.cov_increment:
+                rate = abs(number - point.last_number) / elapsed
+                point.rate = (
+                    rate
+                    if point.rate is None
+                    else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * point.rate
+                )
+                # time to move one COV increment, a quiet point slows down
+                # gradually rather than jumping to its max interval
+                target = point.cov_increment / point.rate if point.rate else math.inf
+                interval = min(target, point.interval * INTERVAL_GROWTH)
+            elif value != point.last_value:
+                interval = point.interval / 2
+            else:
+                interval = point.interval * INTERVAL_GROWTH
+            self._set_interval(point, interval)
+
+        point.last_value = value
+        point.last_number = number
+        point.last_read = now
+        point.reads += 1
+
+    def stats(self, limit: int = 1000) -> Dict[str, Any]:
+        points = [
+            point
+            for point in self.points.values()
+            if not self.known_devices_only or self.app.registry.get(point.key[0])
+        ]
+        self._check_demand()
+        networks = {}
+        for point in points:
+            network = networks.setdefault(
+                point.network,
+                {
+                    "network": point.network,
+                    "points": 0,
+                    "budget": self.budget(point.network),
+                    "demand": round(self.demand.get(point.network, 0.0), 3),
+                    "stretch": round(self.stretch(point.network), 3),
+                    "requests": 0,
+                    "deferred": 0,
+                },
+            )
+            network["points"] += 1
+            network["deferred"] += point.deferred
+        for network, bucket in self.buckets.items():
+            if network in networks:
+                networks[network]["requests"] = bucket.taken
+
+        return {
+            "points": len(points),
+            "reading": len(self._reads),
+            "networks": sorted(networks.values(), key=lambda network: network["network"]),
+            "point_stats": [
+                point.to_json()
+                for point in sorted(points, key=lambda point: point.key)[:limit]
+            ],
+        }
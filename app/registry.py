@@ -0,0 +1,200 @@
+import bisect
+import dataclasses
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bacpypes3.app import DeviceInfoCache
+from bacpypes3.apdu import IAmRequest
+from bacpypes3.basetypes import Segmentation
+from bacpypes3.pdu import Address
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# device status values
+ONLINE = "online"
+RESTORED = "restored"  # loaded from the state snapshot, not confirmed yet
+OFFLINE = "offline"
+
+# fields with a secondary index
+INDEXED_FIELDS = ("network", "vendor_id", "status")
+
+# highest device instance number, 2^22 - 1
+MAX_DEVICE_INSTANCE = 4194303
+
+# network-wide Who-Is sweeps split the range into chunks and pace them
+WHOIS_SWEEP_CHUNK = 10000
+WHOIS_SWEEP_PACE = 0.5
+
+
+@dataclasses.dataclass
+class DeviceRecord:
+    device_instance: int
+    address: str
+    network: int = 0  # 0 is the local network
+    vendor_id: Optional[int] = None
+    max_apdu: int = 1024
+    segmentation: str = "no-segmentation"
+    object_count: Optional[int] = None
+    last_seen: float = 0.0
+    status: str = ONLINE
+
+    @property
+    def segmented(self) -> bool:
+        """True when the device can send segmented responses."""
+        return self.segmentation in ("segmented-both", "segmented-transmit")
+
+
+class DeviceRegistry:
+    """
+    Everything known about the devices on the network, with secondary indexes
+    by network, vendor and status for filtered, paginated queries.
+    """
+
+    def __init__(self):
+        self.devices: Dict[int, DeviceRecord] = {}
+
+        # device instances in order, for paging through everything
+        self._instances: List[int] = []
+
+        # field -> value -> device instances
+        self._indexes: Dict[str, Dict[Any, Set[int]]] = {
+            field: {} for field in INDEXED_FIELDS
+        }
+
+    def get(self, device_instance: int) -> Optional[DeviceRecord]:
+        return self.devices.get(device_instance)
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def upsert(self, device_instance: int, **fields) -> DeviceRecord:
+        """Add a device or update some of its fields, keeping the indexes current."""
+        record = self.devices.get(device_instance)
+        if record is None:
+            record = DeviceRecord(device_instance=device_instance, **fields)
+            self.devices[device_instance] = record
+            bisect.insort(self._instances, device_instance)
+            for field in INDEXED_FIELDS:
+                self._index_add(field, getattr(record, field), device_instance)
+            return record
+
+        for field, value in fields.items():
+            if field in INDEXED_FIELDS:
+                old_value = getattr(record, field)
+                if old_value != value:
+                    self._index_remove(field, old_value, device_instance)
+                    self._index_add(field, value, device_instance)
+            setattr(record, field, value)
+        return record
+
+    def remove(self, device_instance: int) -> None:
+        record = self.devices.pop(device_instance)
+        del self._instances[bisect.bisect_left(self._instances, device_instance)]
+        for field in INDEXED_FIELDS:
+            self._index_remove(field, getattr(record, field), device_instance)
+
+    def _index_add(self, field: str, value: Any, device_instance: int) -> None:
+        self._indexes[field].setdefault(value, set()).add(device_instance)
+
+    def _index_remove(self, field: str, value: Any, device_instance: int) -> None:
+        instances = self._indexes[field][value]
+        instances.discard(device_instance)
+        if not instances:
+            del self._indexes[field][value]
+
+    def update_from_i_am(self, i_am: IAmRequest) -> DeviceRecord:
+        address = i_am.pduSource
+        return self.upsert(
+            i_am.iAmDeviceIdentifier[1],
+            address=str(address),
+            network=address.addrNet or 0,
+            vendor_id=i_am.vendorID,
+            max_apdu=i_am.maxAPDULengthAccepted,
+            segmentation=str(Segmentation(int(i_am.segmentationSupported))),
+            last_seen=time.time(),
+            status=ONLINE,
+        )
+
+    def seen(self, device_instance: int) -> None:
+        """The device answered a request."""
+        if device_instance in self.devices:
+            self.upsert(device_instance, last_seen=time.time(), status=ONLINE)
+
+    def query(
+        self,
+        network: Optional[int] = None,
+        vendor_id: Optional[int] = None,
+        status: Optional[str] = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> Tuple[int, List[DeviceRecord]]:
+        """
+        Devices matching every given filter in device instance order, returns
+        the total number of matches and the requested page.
+        """
+        filters = [
+            self._indexes[field].get(value, set())
+            for field, value in (
+                ("network", network),
+                ("vendor_id", vendor_id),
+                ("status", status),
+            )
+            if value is not None
+        ]
+
+        if not filters:
+            instances = self._instances
+        else:
+            # intersect starting with the most selective index
+            filters.sort(key=len)
+            matches = set(filters[0])
+            for instances_set in filters[1:]:
+                matches &= instances_set
+            instances = sorted(matches)
+
+        page = instances[offset : offset + limit]
+        return len(instances), [self.devices[instance] for instance in page]
+
+    def device_info(self, record: DeviceRecord, device_info_class):
+        """Build a bacpypes3 device cache entry from a record."""
+        return device_info_class(
+            device_instance=record.device_instance,
+            device_address=Address(record.address),
+            max_apdu_length_accepted=record.max_apdu,
+            segmentation_supported=Segmentation(record.segmentation),
+            vendor_identifier=record.vendor_id,
+        )
+
+    def to_json(self) -> List[list]:
+        """Compact rows for the state snapshot."""
+        return [dataclasses.astuple(record) for record in self.devices.values()]
+
+    def load_json(self, rows: List[list]) -> List[DeviceRecord]:
+        """Restore rows written by `to_json`, marked as not yet confirmed."""
+        restored = []
+        for row in rows:
+            record = DeviceRecord(*row)
+            fields = dataclasses.asdict(record)
+            del fields["device_instance"]
+            fields["status"] = RESTORED
+            restored.append(self.upsert(record.device_instance, **fields))
+        return restored
+
+
+class RegistryDeviceInfoCache(DeviceInfoCache):
+    """
+    The bacpypes3 device information cache, every I-Am it accepts is also
+    recorded in the registry.
+    """
+
+    def __init__(self, registry: DeviceRegistry):
+        super().__init__()
+        self.registry = registry
+
+    async def set_device_info(self, apdu: IAmRequest):
+        device_info = await super().set_device_info(apdu)
+        self.registry.update_from_i_am(apdu)
+        return device_info
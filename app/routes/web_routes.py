@@ -1,44 +1,365 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+import asyncio
+import datetime
+import importlib.util
+import inspect
+import json
+from typing import List, Optional
+
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, status, Request
+from fastapi.responses import (
+    HTMLResponse,
+    RedirectResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 
 from app.models.models import WritePropertyRequest
+from app.fdd import FDD_REPORT_LIMIT
+from app.registry import MAX_DEVICE_INSTANCE, WHOIS_SWEEP_CHUNK, WHOIS_SWEEP_PACE
+from app.historian import (
+    EXPORT_FORMATS,
+    ROLLUP_COLUMNS,
+    export_stream,
+    parse_point,
+    rollup_chunks,
+    rollup_source,
+)
+from app.tracing import MAX_PROFILE_SECONDS
 
 
 """
 https://192.168.0.102:8000/occupancy
 https://192.168.0.102:8000/bacnet/whois/201201
+https://192.168.0.102:8000/bacnet/whois-sweep?low_limit=0&high_limit=300000
+https://192.168.0.102:8000/bacnet/devices?network=10&page=2
+https://192.168.0.102:8000/bacnet/overrides?priority=8
+https://192.168.0.102:8000/bacnet/health?state=open
+https://192.168.0.102:8000/site/points?brick_class=Temperature_Sensor&fed_by=AHU1
 https://192.168.0.102:8000/bacnet/read/201201/analog-input,2
+https://192.168.0.102:8000/bacnet/cache/201201/analog-input,2
+https://192.168.0.102:8000/fdd/faults?equipment=VAV_10&active=true
+https://192.168.0.102:8000/historian/export?point=201201/analog-input,2&start=2024-01-01&format=csv
+https://192.168.0.102:8000/historian/rollups?point=201201/analog-input,2&start=2024-01-01&resolution=86400
 https://192.168.0.102:8000/bacnet/write/201201/analog-value,300/present-value/99
 """
 
 
+def etag_matches(request: Request, etag) -> bool:
+    """
+    True when the If-None-Match header of the request names the ETag, using
+    the weak comparison conditional GET calls for.
+    """
+    if etag is None:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+async def conditional_json(request: Request, etag, build, cache_control="no-cache"):
+    """
+    Answer 304 Not Modified when the client copy is current, otherwise call
+    `build` (plain or async) for the payload and tag the response.
+    """
+    headers = {"Cache-Control": cache_control}
+    if etag is not None:
+        headers["ETag"] = etag
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    content = build()
+    if inspect.isawaitable(content):
+        content = await content
+    return JSONResponse(content=content, headers=headers)
+
+
 def setup_routes(app: FastAPI, bacnet_app):
 
+    # every request is timed, a sample ends up in /admin/traces
+    @app.middleware("http")
+    async def trace_requests(request: Request, call_next):
+        if request.url.path.startswith("/static"):
+            return await call_next(request)
+        with bacnet_app.tracer.trace(f"{request.method} {request.url.path}") as trace:
+            response = await call_next(request)
+            trace.attributes["status"] = response.status_code
+        return response
+
     # for testing purposes
     @app.get("/hello")
     async def hello_world():
         return {"message": "Hello!"}
 
     @app.get("/bacpypes/config")
-    async def bacpypes_config():
-        return await bacnet_app.config()
+    async def bacpypes_config(request: Request):
+        etag = bacnet_app.etag("cfg", bacnet_app.local_objects_version)
+        return await conditional_json(request, etag, bacnet_app.config)
 
     @app.get("/bacnet/whois/{device_instance}")
     async def bacnet_whois(device_instance):
         return await bacnet_app.who_is(device_instance)
 
+    @app.get("/bacnet/devices")
+    async def bacnet_devices(
+        network: Optional[int] = None,
+        vendor_id: Optional[int] = None,
+        status: Optional[str] = None,
+        page: int = Query(1, ge=1),
+        page_size: int = Query(100, ge=1, le=1000),
+    ):
+        return await bacnet_app.devices(network, vendor_id, status, page, page_size)
+
+    @app.get("/bacnet/devices/{device_instance}")
+    async def bacnet_device(device_instance: int):
+        return await bacnet_app.device(device_instance)
+
+    # poll budget use per network and each point's effective interval
+    @app.get("/bacnet/poller")
+    async def bacnet_poller(limit: int = Query(1000, ge=0, le=100000)):
+        return await bacnet_app.poller_stats(limit)
+
+    # the ReadPropertyMultiple groups the points are polled in
+    @app.get("/bacnet/poll-plan")
+    async def bacnet_poll_plan():
+        return await bacnet_app.poll_plan()
+
+    # how many reads shared a request with an identical one
+    @app.get("/bacnet/read-stats")
+    async def bacnet_read_stats():
+        return await bacnet_app.read_stats()
+
+    # answers and timeouts per device, and the devices failing fast
+    @app.get("/bacnet/health")
+    async def bacnet_health(state: Optional[str] = Query(None, pattern="^(open|closed)$")):
+        return await bacnet_app.device_health(state)
+
+    def override_priorities(priority: Optional[List[int]]):
+        if priority and not all(1 <= level <= 16 for level in priority):
+            raise HTTPException(status_code=400, detail="priorities are 1 to 16")
+        return priority
+
+    # reads the priority arrays of every commandable object, repeat scans
+    # only re-read the devices whose values changed, force re-reads all
+    @app.post("/bacnet/overrides/scan")
+    async def bacnet_overrides_scan(
+        force: bool = False, priority: Optional[List[int]] = Query(None)
+    ):
+        return await bacnet_app.scan_overrides(force, override_priorities(priority))
+
+    @app.get("/bacnet/overrides")
+    async def bacnet_overrides(priority: Optional[List[int]] = Query(None)):
+        return await bacnet_app.override_report(override_priorities(priority))
+
+    # reads the records the historian is missing from the devices' trend
+    # logs, a run also starts every 15 minutes by itself
+    @app.post("/bacnet/backfill")
+    async def bacnet_backfill(force: bool = False):
+        return await bacnet_app.backfill_trend_logs(force)
+
+    @app.get("/bacnet/backfill")
+    async def bacnet_backfill_report():
+        return await bacnet_app.trend_log_report()
+
+    # fault rules over the site model's equipment, they also run every 5
+    # minutes by themselves
+    @app.post("/fdd/run")
+    async def fdd_run():
+        return await bacnet_app.run_fault_rules()
+
+    @app.get("/fdd/faults")
+    async def fdd_faults(
+        rule: Optional[str] = None,
+        equipment: Optional[str] = None,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        active: Optional[bool] = None,
+        limit: int = Query(FDD_REPORT_LIMIT, ge=1, le=100000),
+    ):
+        return await bacnet_app.fault_report(
+            rule,
+            equipment,
+            start.timestamp() if start else None,
+            end.timestamp() if end else None,
+            active,
+            limit,
+        )
+
+    @app.get("/site/points")
+    async def site_points(
+        brick_class: Optional[str] = None,
+        equipment: Optional[str] = None,
+        room: Optional[str] = None,
+        fed_by: Optional[str] = None,
+    ):
+        return bacnet_app.site_model.points(brick_class, equipment, room, fed_by)
+
+    @app.get("/site/points/{device_instance}/{object_identifier}")
+    async def site_point(device_instance: int, object_identifier: str):
+        point = bacnet_app.site_model.point_by_address(device_instance, object_identifier)
+        if point is None:
+            raise HTTPException(status_code=404, detail="point not in the site model")
+        return point
+
+    @app.get("/site/equipment")
+    async def site_equipment(
+        brick_class: Optional[str] = None, fed_by: Optional[str] = None
+    ):
+        return bacnet_app.site_model.equipment(brick_class, fed_by)
+
+    @app.get("/site/stats")
+    async def site_stats():
+        return bacnet_app.site_model.cache.stats()
+
+    # streamed chunk by chunk, the export is never built in memory
+    @app.get("/historian/export")
+    async def historian_export(
+        point: Optional[List[str]] = Query(None),
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        format: str = Query("csv", pattern="^(csv|parquet|arrow)$"),
+    ):
+        if bacnet_app.historian is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        try:
+            points = [parse_point(spec) for spec in point] if point else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if format != "csv" and importlib.util.find_spec("pyarrow") is None:
+            raise HTTPException(
+                status_code=400, detail=f"pyarrow is required for {format} export"
+            )
+
+        # samples still buffered in memory belong in the export
+        await bacnet_app.historian.flush()
+
+        stream = export_stream(
+            bacnet_app.historian.paths,
+            format,
+            points,
+            start.timestamp() if start else None,
+            end.timestamp() if end else None,
+        )
+        return StreamingResponse(
+            stream,
+            media_type=EXPORT_FORMATS[format],
+            headers={
+                "Content-Disposition": f'attachment; filename="trends.{format}"'
+            },
+        )
+
+    # count, mean, extremes and runtime per bucket, from the hourly or daily
+    # rollups when the resolution is a multiple of them
+    @app.get("/historian/rollups")
+    async def historian_rollups(
+        point: Optional[List[str]] = Query(None),
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        resolution: float = Query(3600, ge=1),
+    ):
+        if bacnet_app.historian is None:
+            raise HTTPException(status_code=404, detail="historian is disabled")
+        try:
+            points = [parse_point(spec) for spec in point] if point else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        await bacnet_app.historian.flush()
+
+        def read():
+            return [
+                dict(zip(ROLLUP_COLUMNS, row))
+                for path in bacnet_app.historian.paths
+                for chunk in rollup_chunks(
+                    path,
+                    points,
+                    start.timestamp() if start else None,
+                    end.timestamp() if end else None,
+                    resolution,
+                )
+                for row in chunk
+            ]
+
+        return {
+            "resolution": resolution,
+            "source": rollup_source(resolution) or "samples",
+            "buckets": await asyncio.to_thread(read),
+        }
+
+    # point reads always go to the device, an unchanged value is answered
+    # with 304 so the client skips decoding it again
     @app.get("/bacnet/read/{device_instance}/{object_identifier}")
-    async def bacnet_read_present_value(device_instance, object_identifier):
-        return await bacnet_app.read_present_value(device_instance, object_identifier)
+    async def bacnet_read_present_value(
+        request: Request, device_instance, object_identifier
+    ):
+        result = await bacnet_app.read_present_value(device_instance, object_identifier)
+        etag = bacnet_app.point_etag(device_instance, object_identifier, "present-value")
+        return await conditional_json(request, etag, lambda: result)
 
     @app.get("/bacnet/read/{device_instance}/{object_identifier}/{property_identifier}")
     async def bacnet_read_property(
-        device_instance, object_identifier, property_identifier
+        request: Request, device_instance, object_identifier, property_identifier
+    ):
+        result = await bacnet_app.read_property(
+            device_instance, object_identifier, property_identifier
+        )
+        etag = bacnet_app.point_etag(
+            device_instance, object_identifier, property_identifier
+        )
+        return await conditional_json(request, etag, lambda: result)
+
+    # streams one I-Am per line (newline delimited JSON) as chunks complete
+    @app.get("/bacnet/whois-sweep")
+    async def bacnet_whois_sweep(
+        low_limit: int = Query(0, ge=0, le=MAX_DEVICE_INSTANCE),
+        high_limit: int = Query(MAX_DEVICE_INSTANCE, ge=0, le=MAX_DEVICE_INSTANCE),
+        chunk_size: int = Query(WHOIS_SWEEP_CHUNK, ge=1, le=MAX_DEVICE_INSTANCE + 1),
+        pace: float = Query(WHOIS_SWEEP_PACE, ge=0.0, le=60.0),
+        address: Optional[str] = None,
+    ):
+        if low_limit > high_limit:
+            raise HTTPException(
+                status_code=400, detail="low_limit must not exceed high_limit"
+            )
+
+        async def ndjson():
+            async for i_am in bacnet_app.who_is_sweep(
+                low_limit, high_limit, chunk_size, pace, address
+            ):
+                yield json.dumps(i_am) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    @app.get("/bacnet/cache/{device_instance}/{object_identifier}")
+    async def bacnet_cached_present_value(
+        request: Request, device_instance, object_identifier
+    ):
+        etag = bacnet_app.point_etag(device_instance, object_identifier, "present-value")
+        return await conditional_json(
+            request,
+            etag,
+            lambda: bacnet_app.cached_property(
+                device_instance, object_identifier, "present-value"
+            ),
+        )
+
+    @app.get("/bacnet/cache/{device_instance}/{object_identifier}/{property_identifier}")
+    async def bacnet_cached_property(
+        request: Request, device_instance, object_identifier, property_identifier
     ):
-        return await bacnet_app.read_property(
+        etag = bacnet_app.point_etag(
             device_instance, object_identifier, property_identifier
         )
+        return await conditional_json(
+            request,
+            etag,
+            lambda: bacnet_app.cached_property(
+                device_instance, object_identifier, property_identifier
+            ),
+        )
 
     @app.post("/bacnet/write")
     async def bacnet_write_property(request: WritePropertyRequest):
@@ -115,6 +436,14 @@ def setup_routes(app: FastAPI, bacnet_app):
     async def read_schedule(
         request: Request, user: dict = Depends(get_current_active_user)
     ):
+        # the page is per user, so shared caches must not keep it
+        etag = bacnet_app.etag(
+            "sch", bacnet_app.config_store.version("schedule"), user["username"]
+        )
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
         return bacnet_app.templates.TemplateResponse(
             "schedule.html",
             {
@@ -122,6 +451,7 @@ def setup_routes(app: FastAPI, bacnet_app):
                 "schedule": bacnet_app.in_memory_schedule,
                 "user": user,
             },
+            headers=headers,
         )
 
     @app.get("/manage-schedule", response_class=HTMLResponse)
@@ -172,18 +502,101 @@ def setup_routes(app: FastAPI, bacnet_app):
             )
 
         # Save the updated schedule both in-memory and to file
-        bacnet_app.in_memory_schedule = schedule_data
         bacnet_app.save_schedule(schedule_data)
 
         return RedirectResponse(url="/schedule", status_code=status.HTTP_302_FOUND)
 
     @app.get("/occupancy")
-    async def check_occupancy():
-        occupancy_status = await bacnet_app.check_occupancy_status()
+    async def check_occupancy(request: Request):
+        etag = bacnet_app.occupancy_etag()
 
-        return JSONResponse(
-            content={
+        async def build():
+            occupancy_status = await bacnet_app.check_occupancy_status()
+            return {
                 "status": "success",
                 "data": occupancy_status
             }
-        )
\ No newline at end of file
+
+        return await conditional_json(request, etag, build)
+
+    @app.get("/admin/traces")
+    async def admin_traces(
+        limit: int = Query(50, ge=1, le=1000),
+        min_duration_ms: float = Query(0.0, ge=0.0),
+        user: dict = Depends(get_current_active_user),
+    ):
+        return {
+            "stats": bacnet_app.tracer.stats(),
+            "traces": bacnet_app.tracer.recent(limit, min_duration_ms / 1000),
+        }
+
+    # profiles run for the given time while the server keeps working, the
+    # response arrives when they are done
+    @app.post("/admin/profile/cpu")
+    async def admin_profile_cpu(
+        seconds: float = Query(10.0, gt=0.0, le=MAX_PROFILE_SECONDS),
+        interval_ms: float = Query(5.0, ge=1.0, le=1000.0),
+        user: dict = Depends(get_current_active_user),
+    ):
+        try:
+            return await bacnet_app.tracer.profile_cpu(seconds, interval_ms / 1000)
+        except RuntimeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @app.post("/admin/profile/memory")
+    async def admin_profile_memory(
+        seconds: float = Query(10.0, gt=0.0, le=MAX_PROFILE_SECONDS),
+        limit: int = Query(25, ge=1, le=500),
+        user: dict = Depends(get_current_active_user),
+    ):
+        try:
+            return await bacnet_app.tracer.profile_memory(seconds, limit)
+        except RuntimeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # point lists and alarm rules can be edited over the API, users can't
+    editable_collections = ("points", "alarm_rules")
+
+    def config_collection(collection: str):
+        if collection not in editable_collections:
+            raise HTTPException(status_code=404, detail=f"unknown config: {collection}")
+        return collection
+
+    @app.get("/config/{collection}")
+    async def read_config(
+        collection: str = Depends(config_collection),
+        user: dict = Depends(get_current_active_user),
+    ):
+        return bacnet_app.config_store.get(collection)
+
+    @app.get("/config/{collection}/{key}")
+    async def read_config_item(
+        key: str,
+        collection: str = Depends(config_collection),
+        user: dict = Depends(get_current_active_user),
+    ):
+        item = bacnet_app.config_store.get_item(collection, key)
+        if item is None:
+            raise HTTPException(status_code=404, detail=f"not found: {key}")
+        return item
+
+    @app.put("/config/{collection}/{key}")
+    async def write_config_item(
+        key: str,
+        item: dict = Body(...),
+        collection: str = Depends(config_collection),
+        user: dict = Depends(get_current_active_user),
+    ):
+        bacnet_app.config_store.put_item(collection, key, item)
+        return item
+
+    @app.delete("/config/{collection}/{key}")
+    async def delete_config_item(
+        key: str,
+        collection: str = Depends(config_collection),
+        user: dict = Depends(get_current_active_user),
+    ):
+        if bacnet_app.config_store.get_item(collection, key) is None:
+            raise HTTPException(status_code=404, detail=f"not found: {key}")
+        bacnet_app.config_store.delete_item(collection, key)
+        return {"status": "success"}
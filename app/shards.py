@@ -0,0 +1,92 @@
+"""
+One more BACnet stack of a sharded split deployment, started by the
+gateway for every --shard
+
+$ python -m app.main --workers 4 --address 10.0.1.5/24 --shard 10.0.2.5/24
+
+as
+
+$ python -m app.shards --primary-socket freebas_gateway.sock \
+    --gateway-socket freebas_gateway-shard1.sock --address 10.0.2.5/24 ...
+
+The shard runs a full FreeBasApplication on its own UDP socket and event
+loop, with its own registry, point cache, poller, snapshot and historian.
+Its configuration (schedule, users, point list) follows the primary
+gateway's and it serves the workers on a gateway socket of its own.
+"""
+
+import asyncio
+import logging
+import signal
+
+from app.gateway import POINT_TABLE_SLOTS, GatewayClient, GatewayServer
+from app.main import READ_TTL, FreeBasApplication, create_local_objects
+from app.poller import MSTP_NETWORK_BUDGET
+from app.snapshot import SNAPSHOT_INTERVAL
+from app.worker import RemoteConfigStore
+
+from bacpypes3.argparse import SimpleArgumentParser
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+
+async def main():
+    parser = SimpleArgumentParser()
+    parser.add_argument("--primary-socket", required=True, help="primary gateway socket")
+    parser.add_argument("--gateway-socket", required=True, help="socket to serve the workers on")
+    parser.add_argument("--point-slots", type=int, default=POINT_TABLE_SLOTS)
+    parser.add_argument("--snapshot", help="Path of the warm-start state snapshot file")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL)
+    parser.add_argument("--historian", help="Path of the trend historian database")
+    parser.add_argument("--mstp-poll-budget", type=float, default=MSTP_NETWORK_BUDGET)
+    parser.add_argument("--read-ttl", type=float, default=READ_TTL)
+    args = parser.parse_args()
+
+    # the configuration arrives ahead of the hello, so it is complete
+    # before the application reads it
+    primary = GatewayClient(args.primary_socket)
+    config_store = RemoteConfigStore(primary)
+    primary.on_event = config_store.gateway_event
+    await primary.connect()
+
+    outside_air_temp, building_occ = create_local_objects()
+    shard_app = FreeBasApplication(
+        args,
+        outside_air_temp=outside_air_temp,
+        building_occ=building_occ,
+        snapshot_path=args.snapshot,
+        snapshot_interval=args.snapshot_interval,
+        historian_path=args.historian,
+        mstp_poll_budget=args.mstp_poll_budget,
+        config_store=config_store,
+        read_ttl=args.read_ttl,
+    )
+    shard_app.poller.known_devices_only = True
+
+    gateway = GatewayServer(shard_app, args.gateway_socket, args.point_slots)
+    await gateway.start()
+    _log.info("Shard %s on %s", args.instance, args.address)
+
+    # runs until the gateway stops it or goes away
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await asyncio.wait(
+            [
+                asyncio.create_task(stop.wait()),
+                asyncio.create_task(primary.wait_closed()),
+            ],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        await gateway.close()
+        await primary.close()
+        await shard_app.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
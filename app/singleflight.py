@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# finished results kept for the TTL before the expired ones are dropped
+PRUNE_RESULTS = 1024
+
+
+class SingleFlight:
+    """
+    Calls with the same key that overlap share one call, whoever comes while
+    it is in flight waits for it and gets the same result or exception. With
+    a TTL the result of a finished call is handed out again for that many
+    seconds, exceptions never are.
+
+    The shared call runs in its own task, a caller that is cancelled doesn't
+    cancel it for the others.
+    """
+
+    def __init__(self, ttl: float = 0.0):
+        self.ttl = ttl
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+
+        # calls made, calls that joined one in flight, calls answered from
+        # a finished one within the TTL
+        self.calls = 0
+        self.merged = 0
+        self.cached = 0
+
+    async def call(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        if self.ttl:
+            result = self._results.get(key)
+            if result is not None and result[0] > time.monotonic():
+                self.cached += 1
+                return result[1]
+
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.create_task(function())
+            self._calls[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            self.merged += 1
+        return await asyncio.shield(task)
+
+    def forget(self, key: Hashable) -> None:
+        """
+        Drop the call in flight and the result of a key, the next call makes
+        a new one. Callers already waiting still get the dropped call's result.
+        """
+        self._calls.pop(key, None)
+        self._results.pop(key, None)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is not task:
+            # forgotten while in flight, its result is out of date
+            if not task.cancelled():
+                task.exception()
+            return
+        del self._calls[key]
+        # retrieved here in case every caller was cancelled
+        if task.cancelled() or task.exception() is not None or not self.ttl:
+            return
+
+        now = time.monotonic()
+        if len(self._results) >= PRUNE_RESULTS:
+            self._results = {
+                key: result for key, result in self._results.items() if result[0] > now
+            }
+        self._results[key] = (now + self.ttl, task.result())
+
+    def stats(self) -> Dict[str, Any]:
+        requested = self.calls + self.merged + self.cached
+        return {
+            "ttl": self.ttl,
+            "requested": requested,
+            "calls": self.calls,
+            "merged": self.merged,
+            "cached": self.cached,
+            "in_flight": len(self._calls),
+            "saved": round((self.merged + self.cached) / requested, 4) if requested else 0.0,
+        }
@@ -0,0 +1,446 @@
+"""
+Compiled site model, the processed Brick/BACnet turtle files are flattened
+into an indexed SQLite database so the web app can answer point lookups by
+Brick class, equipment, room and BACnet address without parsing RDF.
+
+$ python -m app.site_model [--force]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# bump when the schema changes, older databases are recompiled
+SITE_MODEL_FORMAT = 1
+
+# most query results kept per model revision
+QUERY_CACHE_SIZE = 1024
+
+# how often the source files are checked for changes
+SITE_MODEL_CHECK_INTERVAL = 30.0
+
+PROJECT_DIR = os.path.join(os.path.dirname(__file__), "..")
+SITE_MODEL_SOURCE_DIR = os.path.join(PROJECT_DIR, "processed_graph_models")
+SITE_MODEL_PATH = os.path.join(PROJECT_DIR, "site_model.db")
+
+BACNET_NS = "http://data.ashrae.org/bacnet/2020#"
+BRICK_NS = "https://brickschema.org/schema/Brick#"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sources (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE points (
+    uri TEXT PRIMARY KEY,
+    name TEXT,
+    brick_class TEXT,
+    equipment TEXT,
+    device_instance INTEGER,
+    object_identifier TEXT,
+    units TEXT,
+    description TEXT
+);
+CREATE INDEX points_brick_class ON points (brick_class);
+CREATE INDEX points_equipment ON points (equipment);
+CREATE INDEX points_bacnet ON points (device_instance, object_identifier);
+CREATE TABLE equipment (name TEXT PRIMARY KEY, brick_class TEXT, fed_by TEXT);
+CREATE INDEX equipment_fed_by ON equipment (fed_by);
+CREATE TABLE equipment_rooms (equipment TEXT, room TEXT);
+CREATE INDEX equipment_rooms_room ON equipment_rooms (room);
+CREATE INDEX equipment_rooms_equipment ON equipment_rooms (equipment);
+"""
+
+
+def local_name(uri) -> str:
+    """The part of a URI after the namespace, `bldg:AHU1` -> `AHU1`."""
+    uri = str(uri)
+    return uri.rsplit("#", 1)[-1] if "#" in uri else uri.rsplit("/", 1)[-1]
+
+
+def source_files(source_dir: str) -> Dict[str, tuple]:
+    """Fingerprint (mtime, size) of every model file in the source directory."""
+    fingerprints = {}
+    if not os.path.isdir(source_dir):
+        return fingerprints
+    for file_name in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, file_name)
+        if file_name.startswith(".") or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        fingerprints[file_name] = (stat.st_mtime_ns, stat.st_size)
+    return fingerprints
+
+
+def compile_site_model(source_dir: str, db_path: str, revision: int) -> None:
+    """
+    Parse the processed turtle files and write a fresh database, moved into
+    place atomically so readers never see a half written model.
+    """
+    # only needed to compile, the web app itself reads the database
+    import rdflib
+    from rdflib import RDF
+
+    brick = rdflib.Namespace(BRICK_NS)
+    bacnet = rdflib.Namespace(BACNET_NS)
+
+    fingerprints = source_files(source_dir)
+    graph = rdflib.Graph()
+    for file_name in fingerprints:
+        graph.parse(os.path.join(source_dir, file_name), format="turtle")
+
+    def literal(subject, predicate):
+        value = graph.value(subject, predicate)
+        return None if value is None else value.toPython()
+
+    # equipment is anything with points, or that feeds or serves something
+    equipment = {}
+    for s, o in graph.subject_objects(brick.feeds):
+        equipment.setdefault(local_name(s), None)
+        equipment[local_name(o)] = local_name(s)
+    for s in graph.subjects(brick.serves, None):
+        equipment.setdefault(local_name(s), None)
+
+    points = []
+    for point, equip in graph.subject_objects(brick.isPointOf):
+        equipment.setdefault(local_name(equip), None)
+        brick_class = next(
+            (c for c in graph.objects(point, RDF.type) if str(c).startswith(BRICK_NS)),
+            None,
+        )
+        points.append(
+            (
+                str(point),
+                literal(point, bacnet["object-name"]),
+                local_name(brick_class) if brick_class is not None else None,
+                local_name(equip),
+                literal(point, bacnet["device-instance"]),
+                literal(point, bacnet["object-identifier"]),
+                literal(point, bacnet["units"]),
+                literal(point, bacnet["description"]),
+            )
+        )
+
+    def equipment_class(name_uri):
+        for c in graph.objects(name_uri, RDF.type):
+            if str(c).startswith(BRICK_NS):
+                return local_name(c)
+        return None
+
+    equipment_uris = {local_name(s): s for s in graph.subjects(RDF.type, None)}
+    equipment_rows = [
+        (name, equipment_class(equipment_uris[name]) if name in equipment_uris else None, fed_by)
+        for name, fed_by in equipment.items()
+    ]
+    room_rows = [
+        (local_name(s), local_name(o)) for s, o in graph.subject_objects(brick.serves)
+    ]
+
+    directory = os.path.dirname(os.path.abspath(db_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".site-model-")
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_path)
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.executemany(
+                "INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?, ?, ?)", points
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO equipment VALUES (?, ?, ?)", equipment_rows
+            )
+            connection.executemany(
+                "INSERT INTO equipment_rooms VALUES (?, ?)", room_rows
+            )
+            connection.executemany(
+                "INSERT INTO sources VALUES (?, ?, ?)",
+                [(path, *fingerprint) for path, fingerprint in fingerprints.items()],
+            )
+            connection.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [
+                    ("format", str(SITE_MODEL_FORMAT)),
+                    ("revision", str(revision)),
+                    ("compiled", str(time.time())),
+                ],
+            )
+        connection.close()
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    _log.info(
+        "Site model compiled: %d points, %d equipment from %d files",
+        len(points),
+        len(equipment_rows),
+        len(fingerprints),
+    )
+
+
+class QueryCache:
+    """
+    Query results keyed on the query and the model revision they were computed
+    from. A new revision drops every entry at once, so a result from an older
+    model is never served after a reload.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.revision: Optional[int] = None
+        self.entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self, revision: int) -> None:
+        self.entries = OrderedDict()
+        self.revision = revision
+        self.invalidations += 1
+
+    def get(self, revision: int, key: tuple, compute: Callable[[], Any]) -> Any:
+        if revision != self.revision:
+            self.invalidate(revision)
+
+        try:
+            result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            result = self.entries[key] = compute()
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return result
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "revision": self.revision,
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "invalidations": self.invalidations,
+        }
+
+
+class SiteModelStore:
+    """
+    Read side of the compiled site model, query results are cached until the
+    model is recompiled.
+    """
+
+    def __init__(self, db_path: str = SITE_MODEL_PATH, source_dir: str = SITE_MODEL_SOURCE_DIR):
+        self.db_path = db_path
+        self.source_dir = source_dir
+        self.connection: Optional[sqlite3.Connection] = None
+        self.revision = 0
+        self.opened_mtime_ns: Optional[int] = None
+        self.cache = QueryCache()
+
+    def open(self) -> None:
+        """Open the compiled database if there is one, this is only a file open."""
+        if not os.path.exists(self.db_path):
+            _log.info("No compiled site model at %s", self.db_path)
+            return
+
+        connection = sqlite3.connect(
+            f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False
+        )
+        connection.row_factory = sqlite3.Row
+        try:
+            meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+            current = int(meta.get("format", 0)) == SITE_MODEL_FORMAT
+            revision = int(meta["revision"]) if current else 0
+        except (sqlite3.DatabaseError, KeyError, ValueError) as e:
+            # corrupt, truncated or without its meta, like no model at all
+            # the next refresh() compiles it again
+            _log.error(f"Failed to open the site model {self.db_path}: {e}")
+            connection.close()
+            return
+        if not current:
+            _log.warning("Ignoring site model with format %r", meta.get("format"))
+            connection.close()
+            return
+
+        if self.connection:
+            self.connection.close()
+        self.connection = connection
+        self.opened_mtime_ns = os.stat(self.db_path).st_mtime_ns
+        self.revision = revision
+        self.cache.invalidate(self.revision)
+
+    def is_current(self) -> bool:
+        """True when the database was compiled from the current source files."""
+        if self.connection is None:
+            return False
+        compiled = {
+            row["path"]: (row["mtime_ns"], row["size"])
+            for row in self.connection.execute("SELECT * FROM sources")
+        }
+        return compiled == source_files(self.source_dir)
+
+    def compile(self, force: bool = False) -> bool:
+        """Recompile when the source model changed, returns True if it did."""
+        if not force and self.is_current():
+            return False
+        if not source_files(self.source_dir):
+            _log.info("No site model sources in %s", self.source_dir)
+            return False
+
+        compile_site_model(self.source_dir, self.db_path, self.revision + 1)
+        self.open()
+        return True
+
+    async def refresh(self) -> None:
+        """
+        Recompile in a worker thread when the sources changed, queries use the
+        old model until the new one is opened back on the event loop.
+        """
+        if self.is_current() or not source_files(self.source_dir):
+            return
+        try:
+            await asyncio.to_thread(
+                compile_site_model, self.source_dir, self.db_path, self.revision + 1
+            )
+        except ImportError:
+            _log.error("rdflib is required to compile the site model")
+            return
+        except Exception as e:
+            _log.error(f"Failed to compile the site model: {e}")
+            return
+        self.open()
+
+    async def watch(self, interval: float = SITE_MODEL_CHECK_INTERVAL) -> None:
+        """Pick up new output of process_graph_models.py while running."""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(interval)
+
+    async def follow(self, interval: float = SITE_MODEL_CHECK_INTERVAL) -> None:
+        """
+        Reopen the database after another process recompiled it, for the HTTP
+        workers of a split deployment where only the gateway compiles.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime_ns = os.stat(self.db_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if mtime_ns != self.opened_mtime_ns:
+                self.open()
+
+    def _rows(self, sql: str, *params) -> List[Dict[str, Any]]:
+        if self.connection is None:
+            return []
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def _cached(self, key: tuple, compute: Callable[[], Any]) -> Any:
+        return self.cache.get(self.revision, key, compute)
+
+    def points(
+        self,
+        brick_class: Optional[str] = None,
+        equipment: Optional[str] = None,
+        room: Optional[str] = None,
+        fed_by: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Points matching every given filter, `fed_by` selects the points of the
+        equipment fed by another, e.g. the zone temperatures of an AHU.
+        """
+        return self._cached(
+            ("points", brick_class, equipment, room, fed_by),
+            lambda: self._points(brick_class, equipment, room, fed_by),
+        )
+
+    def _points(self, brick_class, equipment, room, fed_by) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM points WHERE 1"
+        params = []
+        if brick_class:
+            sql += " AND brick_class = ?"
+            params.append(brick_class)
+        if equipment:
+            sql += " AND equipment = ?"
+            params.append(equipment)
+        if room:
+            sql += " AND equipment IN (SELECT equipment FROM equipment_rooms WHERE room = ?)"
+            params.append(room)
+        if fed_by:
+            sql += " AND equipment IN (SELECT name FROM equipment WHERE fed_by = ?)"
+            params.append(fed_by)
+        return self._rows(sql + " ORDER BY uri", *params)
+
+    def point_by_address(
+        self, device_instance: int, object_identifier: str
+    ) -> Optional[Dict[str, Any]]:
+        def compute():
+            rows = self._rows(
+                "SELECT * FROM points WHERE device_instance = ? AND object_identifier = ?",
+                device_instance,
+                object_identifier,
+            )
+            return rows[0] if rows else None
+
+        return self._cached(("point", device_instance, object_identifier), compute)
+
+    def equipment(
+        self, brick_class: Optional[str] = None, fed_by: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        return self._cached(
+            ("equipment", brick_class, fed_by),
+            lambda: self._equipment(brick_class, fed_by),
+        )
+
+    def _equipment(self, brick_class, fed_by) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM equipment WHERE 1"
+        params = []
+        if brick_class:
+            sql += " AND brick_class = ?"
+            params.append(brick_class)
+        if fed_by:
+            sql += " AND fed_by = ?"
+            params.append(fed_by)
+        equipment = self._rows(sql + " ORDER BY name", *params)
+        for item in equipment:
+            item["rooms"] = [
+                row["room"]
+                for row in self._rows(
+                    "SELECT room FROM equipment_rooms WHERE equipment = ? ORDER BY room",
+                    item["name"],
+                )
+            ]
+        return equipment
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the site model")
+    parser.add_argument("--source", default=SITE_MODEL_SOURCE_DIR, help="processed graph models")
+    parser.add_argument("--output", default=SITE_MODEL_PATH, help="compiled database")
+    parser.add_argument("--force", action="store_true", help="recompile even if current")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    store = SiteModelStore(args.output, args.source)
+    store.open()
+    if store.compile(force=args.force):
+        print(f"compiled revision {store.revision} to {args.output}")
+    else:
+        print("site model is current")
+
+
+if __name__ == "__main__":
+    main()
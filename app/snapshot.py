@@ -0,0 +1,72 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from app.config_store import atomic_write_json
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# bump when the layout of the snapshot changes, older files are ignored
+SNAPSHOT_FORMAT = 2
+
+# how often the runtime state is written to disk
+SNAPSHOT_INTERVAL = 60.0
+
+
+class StateSnapshot:
+    """
+    Periodically write the runtime state of the server to a compact local file
+    so a restart can serve the API right away instead of rebuilding everything
+    from the field bus.
+    """
+
+    def __init__(self, path: str, interval: float = SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Load the last snapshot, None if there isn't a usable one."""
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            _log.info("No state snapshot at %s, cold start", self.path)
+            return None
+        except (OSError, ValueError) as e:
+            _log.error(f"Failed to load state snapshot: {e}")
+            return None
+
+        if state.get("format") != SNAPSHOT_FORMAT:
+            _log.warning("Ignoring state snapshot with format %r", state.get("format"))
+            return None
+
+        _log.debug(
+            "State snapshot loaded, %.1f seconds old", time.time() - state["saved"]
+        )
+        return state
+
+    def save(self, state: Dict[str, Any]) -> None:
+        """
+        Write the snapshot, the file is replaced atomically so a crash in the
+        middle of a write leaves the previous snapshot in place.
+        """
+        state = dict(state, format=SNAPSHOT_FORMAT, saved=time.time())
+        atomic_write_json(self.path, state, separators=(",", ":"))
+
+    async def run(self, collect: Callable[[], Dict[str, Any]]):
+        """
+        Collect the state on the event loop so it is consistent, then write it
+        from a worker thread so the disk never stalls BACnet traffic.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await asyncio.to_thread(self.save, collect())
+                _log.debug("State snapshot saved to %s", self.path)
+            except Exception as e:
+                _log.error(f"Failed to save state snapshot: {e}")
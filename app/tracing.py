@@ -0,0 +1,281 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Counter, Deque, Dict, List, Optional
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+# fraction of requests whose trace is kept
+TRACE_SAMPLE_RATE = 0.1
+
+# traces slower than this are always kept, sampled or not
+SLOW_TRACE_THRESHOLD = 1.0
+
+# how many traces the ring buffer holds
+TRACE_BUFFER_SIZE = 200
+
+# how often the event loop lag is measured
+LOOP_LAG_INTERVAL = 0.25
+
+# stack sampling period of the CPU profiler
+PROFILE_INTERVAL = 0.005
+
+# longest CPU or memory profile an admin can ask for
+MAX_PROFILE_SECONDS = 300
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+class Trace:
+    """One traced request, spans are (name, start offset, duration, attributes)."""
+
+    __slots__ = ("name", "attributes", "started", "start", "duration", "spans")
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.spans: List[tuple] = []
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "spans": [
+                {
+                    "name": name,
+                    "offset_ms": round(offset * 1000, 3),
+                    "duration_ms": round(duration * 1000, 3),
+                    **attributes,
+                }
+                # nested spans end first, list them in the order they started
+                for name, offset, duration, attributes in sorted(
+                    self.spans, key=lambda span: span[1]
+                )
+            ],
+        }
+
+
+class Tracer:
+    """
+    Lightweight span tracing through the request path. Every request is
+    timed, a sample of them plus every slow one is kept in a ring buffer for
+    the admin endpoints.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        slow_threshold: float = SLOW_TRACE_THRESHOLD,
+        buffer_size: int = TRACE_BUFFER_SIZE,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traces: Deque[Trace] = collections.deque(maxlen=buffer_size)
+        self.count = 0
+
+        # (perf_counter, seconds late) of recent event loop lag measurements
+        self.loop_lag: Deque[tuple] = collections.deque(maxlen=256)
+
+        self._profiling = False
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attributes):
+        trace = Trace(name, attributes)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            end = time.perf_counter()
+            trace.duration = end - trace.start
+            self.count += 1
+
+            if trace.duration >= self.slow_threshold or random.random() < self.sample_rate:
+                trace.attributes["loop_lag_ms"] = round(
+                    self.max_loop_lag(trace.start, end) * 1000, 3
+                )
+                self.traces.append(trace)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time a step of the current trace, does nothing outside of one."""
+        trace = _current_trace.get()
+        if trace is None:
+            yield attributes
+            return
+
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            trace.spans.append(
+                (name, start - trace.start, time.perf_counter() - start, attributes)
+            )
+
+    def recent(self, limit: int = 50, min_duration: float = 0.0) -> List[Dict[str, Any]]:
+        """Kept traces, newest first."""
+        result = []
+        for trace in reversed(self.traces):
+            if trace.duration >= min_duration:
+                result.append(trace.to_json())
+                if len(result) >= limit:
+                    break
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "traced": self.count,
+            "kept": len(self.traces),
+            "sample_rate": self.sample_rate,
+            "slow_threshold_ms": self.slow_threshold * 1000,
+            "loop_lag_ms": round(self.loop_lag[-1][1] * 1000, 3) if self.loop_lag else None,
+            "max_loop_lag_ms": round(
+                max((lag for _, lag in self.loop_lag), default=0.0) * 1000, 3
+            ),
+        }
+
+    def max_loop_lag(self, start: float, end: float) -> float:
+        # a measurement covers the interval before it was taken
+        return max(
+            (lag for at, lag in self.loop_lag if start <= at <= end + LOOP_LAG_INTERVAL),
+            default=0.0,
+        )
+
+    async def monitor_loop(self, interval: float = LOOP_LAG_INTERVAL) -> None:
+        """
+        Measure how late the event loop wakes a sleeping task, a busy loop
+        delays every BACnet response by as much.
+        """
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            self.loop_lag.append((now, max(0.0, now - before - interval)))
+
+    @contextlib.contextmanager
+    def _profile(self):
+        if self._profiling:
+            raise RuntimeError("a profile is already running")
+        self._profiling = True
+        try:
+            yield
+        finally:
+            self._profiling = False
+
+    async def profile_cpu(
+        self, seconds: float, interval: float = PROFILE_INTERVAL, limit: int = 50
+    ) -> Dict[str, Any]:
+        """
+        Sample the stack of the event loop thread from a worker thread for
+        `seconds`, the loop keeps serving requests meanwhile.
+        """
+        with self._profile():
+            thread_id = threading.get_ident()
+            profile = await asyncio.to_thread(sample_stacks, thread_id, seconds, interval)
+        return profile.summary(limit)
+
+    async def profile_memory(self, seconds: float, limit: int = 25) -> Dict[str, Any]:
+        """Trace allocations for `seconds` and report the lines that grew the most."""
+        with self._profile():
+            if tracemalloc.is_tracing():
+                raise RuntimeError("tracemalloc is already running")
+            tracemalloc.start()
+            try:
+                before = tracemalloc.take_snapshot()
+                await asyncio.sleep(seconds)
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        differences = after.compare_to(before, "lineno")
+        return {
+            "seconds": seconds,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {
+                    "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    "size_diff": stat.size_diff,
+                    "size": stat.size,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in differences[:limit]
+            ],
+        }
+
+
+class StackProfile:
+    """Stack samples of one thread, counted per distinct stack."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter[tuple] = collections.Counter()
+
+    def add(self, frame) -> None:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def summary(self, limit: int) -> Dict[str, Any]:
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+
+        def top(counter):
+            return [
+                {
+                    "function": function,
+                    "samples": count,
+                    "percent": round(100 * count / self.samples, 1),
+                }
+                for function, count in counter.most_common(limit)
+            ]
+
+        return {
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "self": top(own) if self.samples else [],
+            "total": top(total) if self.samples else [],
+            # collapsed stacks, the input format of flamegraph.pl and speedscope
+            "collapsed": [
+                ";".join(stack) + f" {count}"
+                for stack, count in self.stacks.most_common(limit)
+            ],
+        }
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> StackProfile:
+    """Blocking sampler loop, meant to run in a worker thread."""
+    profile = StackProfile(interval)
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            profile.add(frame)
+        time.sleep(interval)
+    return profile
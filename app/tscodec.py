@@ -0,0 +1,219 @@
+"""
+Compressed chunks of one point's samples for the historian, after Gorilla
+(Pelkonen et al., VLDB 2015). Timestamps are kept as delta-of-deltas in a
+few bits each, a poll at a steady interval costs one bit. Values are XORed
+with the value before and only the bits that differ are kept, an unchanged
+value costs one bit and a BACnet REAL (a float32 widened to float64) has at
+least 29 zero bits at the end.
+
+Decoding reads the variable length fields into plain integer lists first
+and then rebuilds both columns with C loops (itertools.accumulate and a
+reinterpreting array copy) instead of per sample Python arithmetic.
+"""
+
+import array
+import itertools
+import operator
+import struct
+import sys
+from typing import List, Sequence, Tuple
+
+
+# format version, count, first timestamp (ms), first value (float64 bits)
+HEADER = struct.Struct(">BIqQ")
+CODEC_VERSION = 1
+
+# timestamps are stored in milliseconds
+TIMESTAMP_SCALE = 1000
+
+# delta-of-delta buckets, (control bits, control length, value bits), a
+# zero delta-of-delta is a single 0 bit
+DOD_BUCKETS = (
+    (0b10, 2, 7),
+    (0b110, 3, 12),
+    (0b1110, 4, 20),
+    (0b11110, 5, 32),
+    (0b11111, 5, 64),
+)
+
+# bits of the leading zero count and of the meaningful bit count of a value
+LEADING_BITS = 5
+MAX_LEADING = (1 << LEADING_BITS) - 1
+LENGTH_BITS = 6
+
+# most bits one sample can take, 5 + 64 for the timestamp, 2 + 5 + 6 + 64
+# for the value
+SAMPLE_MAX_BITS = 146
+
+# flush the bit accumulator to bytes once it holds this many bits
+FLUSH_BITS = 512
+
+
+def encode_chunk(timestamps: Sequence[float], values: Sequence[float]) -> bytes:
+    """
+    Compress samples in time order, timestamps in (float) seconds are
+    rounded to the millisecond.
+    """
+    count = len(timestamps)
+    if count == 0 or count != len(values):
+        raise ValueError("a chunk needs as many values as timestamps, at least one")
+
+    times = [round(timestamp * TIMESTAMP_SCALE) for timestamp in timestamps]
+    bits = array.array("Q")
+    bits.frombytes(array.array("d", values).tobytes())
+
+    out = bytearray(HEADER.pack(CODEC_VERSION, count, times[0], bits[0]))
+    accumulator = 0
+    width = 0
+
+    previous_time = times[0]
+    previous_delta = 0
+    previous_bits = bits[0]
+    previous_leading = -1
+    previous_trailing = 0
+
+    for index in range(1, count):
+        # timestamp
+        time = times[index]
+        delta = time - previous_time
+        dod = delta - previous_delta
+        previous_time = time
+        previous_delta = delta
+        if dod == 0:
+            accumulator <<= 1
+            width += 1
+        else:
+            for control, control_bits, value_bits in DOD_BUCKETS:
+                limit = 1 << (value_bits - 1)
+                if -limit <= dod < limit:
+                    break
+            else:
+                raise ValueError(f"timestamp step out of range: {dod}")
+            accumulator = (
+                ((accumulator << control_bits) | control) << value_bits
+            ) | (dod & ((1 << value_bits) - 1))
+            width += control_bits + value_bits
+
+        # value
+        value_bits = bits[index]
+        xor = value_bits ^ previous_bits
+        previous_bits = value_bits
+        if xor == 0:
+            accumulator <<= 1
+            width += 1
+        else:
+            leading = min(64 - xor.bit_length(), MAX_LEADING)
+            trailing = (xor & -xor).bit_length() - 1
+            if (
+                previous_leading >= 0
+                and leading >= previous_leading
+                and trailing >= previous_trailing
+            ):
+                # fits the window of the previous value
+                meaningful = 64 - previous_leading - previous_trailing
+                accumulator = (
+                    ((accumulator << 2) | 0b10) << meaningful
+                ) | (xor >> previous_trailing)
+                width += 2 + meaningful
+            else:
+                meaningful = 64 - leading - trailing
+                accumulator = (
+                    ((((accumulator << 2) | 0b11) << LEADING_BITS | leading) << LENGTH_BITS
+                    | (meaningful - 1)) << meaningful
+                ) | (xor >> trailing)
+                width += 2 + LEADING_BITS + LENGTH_BITS + meaningful
+                previous_leading = leading
+                previous_trailing = trailing
+
+        if width >= FLUSH_BITS:
+            whole, width = divmod(width, 8)
+            whole_bytes = accumulator >> width
+            out += whole_bytes.to_bytes(whole, "big")
+            accumulator &= (1 << width) - 1
+
+    if width:
+        padding = -width % 8
+        out += (accumulator << padding).to_bytes((width + padding) // 8, "big")
+    return bytes(out)
+
+
+def decode_chunk(data: bytes) -> Tuple[array.array, array.array]:
+    """
+    Timestamps in milliseconds (array of int64) and values (array of
+    float64) of a chunk.
+    """
+    version, count, first_time, first_bits = HEADER.unpack_from(data)
+    if version != CODEC_VERSION:
+        raise ValueError(f"unknown chunk format version {version}")
+
+    dods: List[int] = [0] * (count - 1)
+    xors: List[int] = [0] * (count - 1)
+
+    # the bit stream as big-endian 64-bit words, fed into a small window
+    # before every sample so no field has to check for the end of it
+    body = data[HEADER.size :]
+    words = array.array("Q")
+    words.frombytes(body + bytes(-len(body) % 8))
+    if sys.byteorder == "little":
+        words.byteswap()
+    next_word = 0
+    window = 0
+    remaining = 0  # unread bits in the window
+
+    leading = 0
+    trailing = 0
+    for index in range(count - 1):
+        if remaining < SAMPLE_MAX_BITS:
+            window &= (1 << remaining) - 1
+            while remaining < SAMPLE_MAX_BITS and next_word < len(words):
+                window = (window << 64) | words[next_word]
+                next_word += 1
+                remaining += 64
+
+        # timestamp, count the leading 1 bits of the control (at most 4)
+        remaining -= 1
+        if (window >> remaining) & 1:
+            ones = 1
+            while ones < 4:
+                remaining -= 1
+                if not (window >> remaining) & 1:
+                    break
+                ones += 1
+            else:
+                remaining -= 1
+                ones += (window >> remaining) & 1
+            value_bits = DOD_BUCKETS[ones - 1][2]
+            remaining -= value_bits
+            dod = (window >> remaining) & ((1 << value_bits) - 1)
+            if dod >> (value_bits - 1):
+                dod -= 1 << value_bits
+            dods[index] = dod
+
+        # value
+        remaining -= 1
+        if (window >> remaining) & 1:
+            remaining -= 1
+            if (window >> remaining) & 1:
+                remaining -= LEADING_BITS + LENGTH_BITS
+                header = (window >> remaining) & ((1 << (LEADING_BITS + LENGTH_BITS)) - 1)
+                leading = header >> LENGTH_BITS
+                meaningful = (header & ((1 << LENGTH_BITS) - 1)) + 1
+                trailing = 64 - leading - meaningful
+            else:
+                meaningful = 64 - leading - trailing
+            remaining -= meaningful
+            xors[index] = ((window >> remaining) & ((1 << meaningful) - 1)) << trailing
+
+        if remaining < 0:
+            raise ValueError("truncated chunk")
+
+    times = array.array(
+        "q",
+        itertools.accumulate(
+            itertools.accumulate(dods), operator.add, initial=first_time
+        ),
+    )
+    bits = array.array("Q", itertools.accumulate(xors, operator.xor, initial=first_bits))
+    values = array.array("d")
+    values.frombytes(bits.tobytes())
+    return times, values
@@ -0,0 +1,645 @@
+"""
+HTTP worker of the split deployment, started by the gateway as
+
+$ python -m uvicorn app.worker:create_worker_app --factory --workers N
+
+with the gateway sockets passed in the environment.
+
+With shards (several BACnet stacks) a worker connects to every stack's
+gateway. Calls about one device go to the stack whose registry has the
+device, network wide ones (Who-Is, device list, poller, overrides) go to all
+of them and the answers are merged, so the API doesn't change.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+from fastapi import HTTPException
+
+from bacpypes3.primitivedata import ObjectIdentifier
+
+from app.config_store import ConfigStore
+from app.gateway import (
+    ENV_SESSION_SECRET,
+    ENV_SHARD_SOCKETS,
+    ENV_SOCKET,
+    REMOTE,
+    GatewayClient,
+    PointKey,
+    SharedPointTable,
+)
+from app.fdd import FDD_REPORT_LIMIT
+from app.main import FreeBasWeb
+from app.routes.web_routes import setup_routes
+from app.site_model import SiteModelStore
+
+
+# Create a logger for this module
+_log = logging.getLogger(__name__)
+
+
+class RemoteConfigStore(ConfigStore):
+    """
+    The worker's copy of the configuration, kept current by events from the
+    gateway. Edits apply locally right away and are sent on to the gateway,
+    which writes them to disk and pushes them to every other worker.
+    """
+
+    def __init__(self, gateway: GatewayClient):
+        super().__init__({})
+        self.gateway = gateway
+
+        # edits made here since the gateway last sent the collection, they
+        # count in the version until the gateway's own version replaces it
+        self.local_edits: Dict[str, int] = {}
+
+    def version(self, collection: str) -> Union[int, str]:
+        """
+        The gateway's version, with the edits made here since then, so an
+        ETag handed out before an edit no longer matches. The pid keeps the
+        local versions of two workers apart.
+        """
+        edits = self.local_edits.get(collection)
+        if not edits:
+            return self.versions[collection]
+        return f"{self.versions[collection]}.{os.getpid()}.{edits}"
+
+    def gateway_event(self, event) -> None:
+        if event["event"] == "config":
+            self.load(event["collection"], event["data"], event["version"])
+
+    def load(self, collection: str, data: dict, version: int) -> None:
+        self.data[collection] = data
+        self.versions[collection] = version
+        self.local_edits.pop(collection, None)
+        for listener in self.listeners:
+            listener(collection)
+
+    def _edited(self, collection: str) -> None:
+        self.local_edits[collection] = self.local_edits.get(collection, 0) + 1
+
+    def put(self, collection: str, data: dict) -> None:
+        self.data[collection] = data
+        self._edited(collection)
+        self.gateway.notify("config_put", collection, data)
+
+    def put_item(self, collection: str, key: str, item: Any) -> None:
+        self.data[collection][key] = item
+        self._edited(collection)
+        self.gateway.notify("config_put_item", collection, key, item)
+
+    def delete_item(self, collection: str, key: str) -> None:
+        del self.data[collection][key]
+        self._edited(collection)
+        self.gateway.notify("config_delete_item", collection, key)
+
+    async def flush(self) -> None:
+        pass
+
+
+class RemoteHistorian:
+    """
+    Exports read the databases directly, only the gateways write to them,
+    one database per BACnet stack.
+    """
+
+    def __init__(self, paths: List[str], gateways: List[GatewayClient]):
+        self.paths = paths
+        self.gateways = gateways
+
+    async def flush(self) -> None:
+        await asyncio.gather(*(gateway.call("historian_flush") for gateway in self.gateways))
+
+
+def device_not_found(e: HTTPException) -> bool:
+    return e.status_code == 400 and str(e.detail).startswith("device not found")
+
+
+def i_am_instance(i_am: Dict[str, Any]) -> int:
+    return int(i_am["i-am-device-identifier"].split(",")[1])
+
+
+class ShardRouter:
+    """
+    The gateways of every BACnet stack, the primary first, and which stack
+    each device is on. A device is looked up in the registries of all
+    stacks the first time, then with a Who-Is on every network, and the
+    answer is remembered until the stack no longer finds it.
+    """
+
+    def __init__(self, socket_paths: List[str]):
+        self.gateways = [GatewayClient(socket_path) for socket_path in socket_paths]
+        self.tables: List[SharedPointTable] = []
+        self.device_shards: Dict[int, int] = {}
+
+    @property
+    def primary(self) -> GatewayClient:
+        return self.gateways[0]
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.gateways) > 1
+
+    async def connect(self) -> None:
+        await asyncio.gather(*(gateway.connect() for gateway in self.gateways))
+        self.tables = [SharedPointTable.attach(gateway.point_table) for gateway in self.gateways]
+
+    async def close(self) -> None:
+        for gateway in self.gateways:
+            await gateway.close()
+        for table in self.tables:
+            table.close()
+
+    async def call_all(self, method: str, *args) -> List[Any]:
+        return await asyncio.gather(*(gateway.call(method, *args) for gateway in self.gateways))
+
+    async def stream_all(self, method: str, *args) -> AsyncIterator[tuple]:
+        """(shard, item) as the streams of all stacks yield them."""
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump(shard, gateway):
+            try:
+                async for item in gateway.stream(method, *args):
+                    queue.put_nowait((shard, item, None))
+            except HTTPException as e:
+                queue.put_nowait((shard, None, e))
+            finally:
+                queue.put_nowait((shard, None, None))
+
+        tasks = [
+            asyncio.create_task(pump(shard, gateway))
+            for shard, gateway in enumerate(self.gateways)
+        ]
+        try:
+            running = len(tasks)
+            while running:
+                shard, item, error = await queue.get()
+                if error is not None:
+                    raise error
+                if item is None:
+                    running -= 1
+                    continue
+                yield shard, item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def shard(self, device_instance: int) -> int:
+        """Index of the stack that has the device."""
+        shard = self.device_shards.get(device_instance)
+        if shard is not None or not self.sharded:
+            return shard or 0
+
+        async def record(gateway):
+            try:
+                return await gateway.call("device", device_instance)
+            except HTTPException:
+                return None
+
+        records = await asyncio.gather(*(record(gateway) for gateway in self.gateways))
+        found = [shard for shard, record in enumerate(records) if record]
+        online = [shard for shard in found if records[shard]["status"] != "offline"]
+        if online or found:
+            shard = (online or found)[0]
+        else:
+            i_ams = await self.call_all("who_is", device_instance, None)
+            found = [shard for shard, answers in enumerate(i_ams) if answers]
+            if not found:
+                raise HTTPException(
+                    status_code=400, detail=f"device not found: {device_instance}"
+                )
+            shard = found[0]
+
+        self.device_shards[device_instance] = shard
+        return shard
+
+    async def call(self, device_instance: int, method: str, *args) -> Any:
+        """Call a method about one device on the stack that has it."""
+        shard = await self.shard(device_instance)
+        try:
+            return await self.gateways[shard].call(method, device_instance, *args)
+        except HTTPException as e:
+            if device_not_found(e):
+                self.device_shards.pop(device_instance, None)
+            raise
+
+    def lookup(self, key: PointKey):
+        shard = self.device_shards.get(key[0])
+        if shard is not None:
+            return self.tables[shard].lookup(key)
+
+        remote = False
+        for shard, table in enumerate(self.tables):
+            entry = table.lookup(key)
+            if entry is REMOTE:
+                remote = True
+            elif entry is not None:
+                self.device_shards[key[0]] = shard
+                return entry
+        return REMOTE if remote else None
+
+
+def merge_device_pages(pages: List[Dict[str, Any]], page: int, page_size: int) -> Dict[str, Any]:
+    """One page of the device lists of all stacks, each asked for its first `page` pages."""
+    devices = heapq.merge(
+        *(
+            [dict(record, shard=shard) for record in result["devices"]]
+            for shard, result in enumerate(pages)
+        ),
+        key=lambda record: record["device_instance"],
+    )
+    return {
+        "total": sum(result["total"] for result in pages),
+        "page": page,
+        "page_size": page_size,
+        "devices": list(itertools.islice(devices, (page - 1) * page_size, page * page_size)),
+    }
+
+
+def merge_poller_stats(results: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    point_stats = heapq.merge(
+        *(
+            [dict(point, shard=shard) for point in result["point_stats"]]
+            for shard, result in enumerate(results)
+        ),
+        key=lambda point: (
+            point["device_instance"], point["object_identifier"], point["property_identifier"]
+        ),
+    )
+    return {
+        "points": sum(result["points"] for result in results),
+        "reading": sum(result["reading"] for result in results),
+        "networks": [
+            dict(network, shard=shard)
+            for shard, result in enumerate(results)
+            for network in result["networks"]
+        ],
+        "point_stats": list(itertools.islice(point_stats, limit)),
+    }
+
+
+def merge_poll_plans(plans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # every stack plans the whole point list, a device is planned by the
+    # stack that has it in its registry
+    devices: Dict[int, Dict[str, Any]] = {}
+    for plan in plans:
+        for device in plan["devices"]:
+            if device["device_instance"] not in devices or device["network"] is not None:
+                devices[device["device_instance"]] = device
+    return {
+        "revision": sum(plan["revision"] for plan in plans),
+        "networks": [
+            dict(network, shard=shard)
+            for shard, plan in enumerate(plans)
+            for network in plan["networks"]
+            if network["network"] is not None
+        ],
+        "devices": [devices[device_instance] for device_instance in sorted(devices)],
+    }
+
+
+def merge_health_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # a device is talked to by the stack that has it, the others may have
+    # tried it before it was found
+    devices: Dict[int, Dict[str, Any]] = {}
+    for report in reports:
+        for device in report["devices"]:
+            known = devices.get(device["device_instance"])
+            if known is None or device["answers"] > known["answers"]:
+                devices[device["device_instance"]] = device
+    return {
+        "open": sum(1 for device in devices.values() if device["state"] == "open"),
+        "devices": [devices[device_instance] for device_instance in sorted(devices)],
+    }
+
+
+def merge_read_stats(stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = {
+        field: sum(stack[field] for stack in stats)
+        for field in ("requested", "calls", "merged", "cached", "in_flight")
+    }
+    saved = merged["merged"] + merged["cached"]
+    merged["ttl"] = stats[0]["ttl"]
+    merged["saved"] = round(saved / merged["requested"], 4) if merged["requested"] else 0.0
+    return merged
+
+
+def merge_runs(runs: List[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Stats of scans the stacks ran side by side, their counters add up."""
+    runs = [run for run in runs if run]
+    if not runs:
+        return None
+    merged = {
+        "started": min(run["started"] for run in runs),
+        "duration": max(run["duration"] for run in runs),
+    }
+    for field in runs[0]:
+        if field not in merged:
+            merged[field] = sum(run[field] for run in runs)
+    return merged
+
+
+def merge_backfill_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "run": merge_runs([report["run"] for report in reports]),
+        "logs": sorted(
+            (log for report in reports for log in report["logs"]),
+            key=lambda log: (log["device_instance"], log["object_identifier"]),
+        ),
+    }
+
+
+def merge_fault_reports(reports: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    return {
+        "rules": reports[0]["rules"],
+        "run": merge_runs([report["run"] for report in reports]),
+        "faults": sorted(
+            (fault for report in reports for fault in report["faults"]),
+            key=lambda fault: fault["start"],
+            reverse=True,
+        )[:limit],
+    }
+
+
+def merge_override_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    scan = merge_runs([report["scan"] for report in reports])
+
+    by_priority: Dict[int, Dict[str, Any]] = {}
+    for report in reports:
+        for entry in report["priorities"]:
+            merged = by_priority.setdefault(
+                entry["priority"], dict(entry, count=0, devices=[])
+            )
+            merged["count"] += entry["count"]
+            merged["devices"].extend(entry["devices"])
+    for merged in by_priority.values():
+        merged["devices"].sort(key=lambda device: device["device_instance"])
+
+    return {
+        "scan": scan,
+        "total": sum(report["total"] for report in reports),
+        "priorities": [by_priority[priority] for priority in sorted(by_priority)],
+        "errors": {
+            device_instance: error
+            for report in reports
+            for device_instance, error in report["errors"].items()
+        },
+    }
+
+
+class WorkerApplication(FreeBasWeb):
+    """
+    The same API as FreeBasApplication, point values come from the shared
+    point tables and everything that needs a BACnet stack from its gateway.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        shard_socket_paths: Optional[List[str]] = None,
+        session_secret: Optional[str] = None,
+    ):
+        super().__init__(session_secret=session_secret, lifespan=self.lifespan)
+
+        self.router = ShardRouter([socket_path, *(shard_socket_paths or [])])
+        # the configuration comes from the primary gateway, the shards
+        # follow it too
+        self.gateway = self.router.primary
+        self.config_store = RemoteConfigStore(self.gateway)
+        self.gateway.on_event = self.config_store.gateway_event
+        # the gateways' hellos say whether they keep trends
+        self.historian: Optional[RemoteHistorian] = None
+        self.site_model = SiteModelStore()
+
+        setup_routes(self.web_app, self)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, web_app):
+        await self.router.connect()
+        paths = [gateway.historian for gateway in self.router.gateways if gateway.historian]
+        if paths:
+            self.historian = RemoteHistorian(paths, self.router.gateways)
+        self.site_model.open()
+        tasks = [
+            asyncio.create_task(self.site_model.follow()),
+            asyncio.create_task(self.tracer.monitor_loop()),
+        ]
+        try:
+            yield
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.router.close()
+
+    @property
+    def etag_epoch(self):
+        return "-".join(table.epoch for table in self.router.tables)
+
+    @property
+    def local_objects_version(self):
+        return self.router.tables[0].local_objects_version
+
+    def _point(self, device_instance, object_identifier, property_identifier):
+        return self.router.lookup(
+            (
+                int(device_instance),
+                str(ObjectIdentifier(object_identifier)),
+                property_identifier,
+            )
+        )
+
+    def point_etag(self, device_instance, object_identifier, property_identifier):
+        entry = self._point(device_instance, object_identifier, property_identifier)
+        if entry is None or entry is REMOTE:
+            return None
+        return self.etag("pt", entry["version"], int(entry["stale"]))
+
+    async def cached_property(
+        self, device_instance, object_identifier: str, property_identifier: str
+    ):
+        entry = self._point(device_instance, object_identifier, property_identifier)
+        if entry is REMOTE:
+            return await self.router.call(
+                int(device_instance), "cached_property", object_identifier, property_identifier
+            )
+        if entry is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"no cached value: {device_instance} {object_identifier} {property_identifier}",
+            )
+        return {
+            property_identifier: entry["value"],
+            "timestamp": entry["timestamp"],
+            "stale": entry["stale"],
+        }
+
+    async def config(self):
+        configs = await self.router.call_all("config")
+        if not self.router.sharded:
+            return configs[0]
+        return dict(configs[0], shards=configs[1:])
+
+    async def who_is(self, device_instance, address=None):
+        # a broadcast goes out on every stack's network, a unicast address
+        # may be reachable from several stacks and only the first one that
+        # gets an answer keeps the device in its registry
+        if address:
+            for shard, gateway in enumerate(self.router.gateways):
+                i_ams = await gateway.call("who_is", device_instance, address)
+                if i_ams:
+                    self.router.device_shards[int(device_instance)] = shard
+                    return i_ams
+            return []
+
+        results = await self.router.call_all("who_is", device_instance, address)
+        i_ams = []
+        for shard, answers in enumerate(results):
+            if answers:
+                self.router.device_shards[int(device_instance)] = shard
+            i_ams.extend(answers)
+        return i_ams
+
+    async def who_is_sweep(
+        self, low_limit, high_limit, chunk_size, pace, address=None
+    ):
+        args = (low_limit, high_limit, chunk_size, pace, address)
+        if address:
+            # like who_is(), the first stack that finds devices sweeps alone
+            for shard, gateway in enumerate(self.router.gateways):
+                found = False
+                async for i_am in gateway.stream("who_is_sweep", *args):
+                    found = True
+                    self.router.device_shards[i_am_instance(i_am)] = shard
+                    yield i_am
+                if found:
+                    return
+            return
+
+        # a device reachable from two stacks is reported once
+        seen = set()
+        async for shard, i_am in self.router.stream_all("who_is_sweep", *args):
+            device_instance = i_am_instance(i_am)
+            if device_instance in seen:
+                continue
+            seen.add(device_instance)
+            self.router.device_shards[device_instance] = shard
+            yield i_am
+
+    async def devices(self, network=None, vendor_id=None, status=None, page=1, page_size=100):
+        if not self.router.sharded:
+            return await self.gateway.call("devices", network, vendor_id, status, page, page_size)
+        pages = await self.router.call_all(
+            "devices", network, vendor_id, status, 1, page * page_size
+        )
+        return merge_device_pages(pages, page, page_size)
+
+    async def device(self, device_instance):
+        return await self.router.call(int(device_instance), "device")
+
+    async def poller_stats(self, limit=1000):
+        results = await self.router.call_all("poller_stats", limit)
+        if not self.router.sharded:
+            return results[0]
+        return merge_poller_stats(results, limit)
+
+    async def poll_plan(self):
+        plans = await self.router.call_all("poll_plan")
+        if not self.router.sharded:
+            return plans[0]
+        return merge_poll_plans(plans)
+
+    async def read_stats(self):
+        stats = await self.router.call_all("read_stats")
+        if not self.router.sharded:
+            return stats[0]
+        return merge_read_stats(stats)
+
+    async def device_health(self, state=None):
+        reports = await self.router.call_all("device_health", state)
+        if not self.router.sharded:
+            return reports[0]
+        return merge_health_reports(reports)
+
+    async def scan_overrides(self, force=False, priorities=None):
+        reports = await self.router.call_all("scan_overrides", force, priorities)
+        if not self.router.sharded:
+            return reports[0]
+        return merge_override_reports(reports)
+
+    async def override_report(self, priorities=None):
+        reports = await self.router.call_all("override_report", priorities)
+        if not self.router.sharded:
+            return reports[0]
+        return merge_override_reports(reports)
+
+    async def backfill_trend_logs(self, force=False):
+        reports = await self.router.call_all("backfill_trend_logs", force)
+        if not self.router.sharded:
+            return reports[0]
+        return merge_backfill_reports(reports)
+
+    async def trend_log_report(self):
+        reports = await self.router.call_all("trend_log_report")
+        if not self.router.sharded:
+            return reports[0]
+        return merge_backfill_reports(reports)
+
+    async def run_fault_rules(self):
+        runs = await self.router.call_all("run_fault_rules")
+        if not self.router.sharded:
+            return runs[0]
+        return merge_runs(runs)
+
+    async def fault_report(
+        self,
+        rule=None,
+        equipment=None,
+        start=None,
+        end=None,
+        active=None,
+        limit=FDD_REPORT_LIMIT,
+    ):
+        reports = await self.router.call_all(
+            "fault_report", rule, equipment, start, end, active, limit
+        )
+        if not self.router.sharded:
+            return reports[0]
+        return merge_fault_reports(reports, limit)
+
+    async def read_present_value(self, device_instance, object_identifier):
+        return await self.read_property(device_instance, object_identifier, "present-value")
+
+    async def read_property(self, device_instance, object_identifier, property_identifier):
+        with self.tracer.span("gateway"):
+            return await self.router.call(
+                int(device_instance), "read_property", object_identifier, property_identifier
+            )
+
+    async def write_property(
+        self, device_instance, object_identifier, property_identifier, value, priority=-1
+    ):
+        with self.tracer.span("gateway"):
+            return await self.router.call(
+                int(device_instance),
+                "write_property",
+                object_identifier,
+                property_identifier,
+                value,
+                priority,
+            )
+
+
+def create_worker_app():
+    """uvicorn app factory, runs once in every worker process."""
+    shard_sockets = os.environ.get(ENV_SHARD_SOCKETS)
+    worker = WorkerApplication(
+        socket_path=os.environ[ENV_SOCKET],
+        shard_socket_paths=shard_sockets.split(os.pathsep) if shard_sockets else None,
+        session_secret=os.environ[ENV_SESSION_SECRET],
+    )
+    return worker.web_app
@@ -2,12 +2,16 @@
 Simple example that sends a Who-Is request and for each device that responds,
 reads the object list and reads the object name, description, and present-value
 and units if applicable.
+
+With --stream the triples of each object are written as soon as the object has
+been read, as N-Triples (--format nt) or as one turtle chunk per object, so the
+graph never holds more than one object and a run that dies keeps what it read.
 """
 
 import sys
 import asyncio
 import os
-from typing import List, Optional
+from typing import BinaryIO, List, Optional
 
 from bacpypes3.debugging import bacpypes_debugging, ModuleLogger
 from bacpypes3.argparse import SimpleArgumentParser
@@ -30,6 +34,21 @@ _log = ModuleLogger(globals())
 # globals
 show_warnings: bool = False
 
+# formats the triples can be streamed in
+STREAM_FORMATS = ("nt", "ntriples", "turtle")
+
+
+def write_chunk(g: Graph, output: BinaryIO, output_format: str) -> None:
+    """
+    Write the triples in the graph and empty it. N-Triples chunks add up to
+    one N-Triples document, every turtle chunk starts with its own prefixes.
+    """
+    if not len(g):
+        return
+    output.write(g.serialize(format=output_format, encoding="utf-8"))
+    output.flush()
+    g.remove((None, None, None))
+
 
 @bacpypes_debugging
 async def object_identifiers(
@@ -133,6 +152,11 @@ async def main() -> None:
             help="output format",
             default="turtle",
         )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="write the triples of each object as soon as it is read",
+        )
 
         # add an option to show warnings (argparse.BooleanOptionalAction is 3.9+)
         warnings_parser = parser.add_mutually_exclusive_group(required=False)
@@ -149,6 +173,10 @@ async def main() -> None:
         # percolate up to the global
         show_warnings = args.warnings
 
+        if args.stream and args.format not in STREAM_FORMATS:
+            sys.stderr.write(f"--stream needs one of {', '.join(STREAM_FORMATS)}\n")
+            sys.exit(1)
+
         # build an application
         app = Application.from_args(args)
         if _debug:
@@ -175,11 +203,20 @@ async def main() -> None:
         if _debug:
             _log.debug("    - device_graph: %r", device_graph)
 
+        # streamed output is written object by object
+        output: Optional[BinaryIO] = None
+        if args.stream:
+            output = open(args.output, "wb") if args.output else sys.stdout.buffer
+
         object_list = await object_identifiers(app, device_address, device_identifier)
         for object_identifier in object_list:
             if _debug:
                 _log.debug("    - object_identifier: %r", object_identifier)
 
+            # the device, or the object read before
+            if output:
+                write_chunk(g, output, args.format)
+
             # create an object relative to the device and return it like a context
             object_proxy = device_graph.create_object(object_identifier)
             if _debug:
@@ -255,7 +292,11 @@ async def main() -> None:
                         )
 
         # dump the graph
-        if args.output:
+        if output:
+            write_chunk(g, output, args.format)
+            if args.output:
+                output.close()
+        elif args.output:
             with open(args.output, "wb") as ttl_file:
                 g.serialize(ttl_file, format=args.format)
         else:
@@ -0,0 +1,438 @@
+"""
+Rule based Brick classification of BACnet point names.
+
+A rule set is compiled once into an indexed matcher: exact names in a dict,
+prefixes and suffixes in two tries (the suffix trie is built on the reversed
+names), every regex rule in one combined regex with a named group per rule,
+and units and object types in dicts for points whose name says nothing. Names
+are normalized first (upper case, runs of spaces, dots, underscores and dashes
+become one dash) so `zn_t`, `ZN T` and `ZN-T` are one name.
+
+A name is looked up from the most to the least specific kind of rule and the
+first kind that matches wins, a rule's units or object types rule it out for
+points that have others and make it surer for points that have them.
+
+$ python point_tagger.py names.txt
+$ python point_tagger.py --benchmark 500000
+"""
+
+import argparse
+import csv
+import functools
+import re
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from rdflib import Namespace
+
+
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+
+# kinds of rules, most specific first, with how sure a match of each is
+RULE_KINDS = {
+    "exact": 1.0,
+    "suffix": 0.85,
+    "prefix": 0.8,
+    "regex": 0.7,
+    "units": 0.4,
+    "object-type": 0.2,
+}
+
+# a rule's units or object types agreeing with the point's, or not being
+# known for the point, move the confidence by this much
+CONSTRAINT_BONUS = 0.1
+UNKNOWN_PENALTY = 0.1
+
+# classifications kept for names seen before, vendors reuse the same
+# names on every controller, it starts over once it is full
+CACHE_SIZE = 100000
+
+# controllers whose names the repeated-name benchmark cycles through
+BENCHMARK_CONTROLLERS = 1000
+
+SEPARATORS = re.compile(r"[\s._\-]+")
+
+# names that are already upper case and dash separated skip the substitution
+NORMALIZED = re.compile(r"[A-Z0-9]+(?:-[A-Z0-9]+)*")
+
+
+class Rule(NamedTuple):
+    kind: str  # one of RULE_KINDS
+    pattern: str
+    brick_class: str
+    units: Tuple[str, ...] = ()
+    object_types: Tuple[str, ...] = ()
+
+
+class Match(NamedTuple):
+    brick_class: str
+    confidence: float
+    rule: Rule
+
+
+def normalize(name: str) -> str:
+    name = name.upper()
+    if NORMALIZED.fullmatch(name):
+        return name
+    return SEPARATORS.sub("-", name).strip("-")
+
+
+@functools.lru_cache(maxsize=1024)
+def enum_name(value: Optional[str]) -> Optional[str]:
+    """`degrees-fahrenheit` of a unit or object type however it was written,
+    e.g. `http://data.ashrae.org/bacnet/EngineeringUnits.degrees-fahrenheit`."""
+    if not value:
+        return None
+    return value.rsplit("/", 1)[-1].rsplit("#", 1)[-1].split(".")[-1].lower()
+
+
+def exact_rules(mappings: Dict[str, list]) -> List[Rule]:
+    """Exact rules of a `{description: [name, brick class]}` mapping."""
+    return [Rule("exact", name, brick_class) for name, brick_class in mappings.values()]
+
+
+# other vendors' names for the points of point_type_mappings in
+# process_graph_models.py, with the same classes as the exact names there, so
+# app/fdd.py gives them the same roles (it tells zone from discharge
+# temperature by name). Points neither uses get the more specific class.
+NAMING_VARIANTS = [
+    # zone temperature
+    Rule("exact", "ZNT", BRICK.Temperature_Sensor),
+    Rule("exact", "SPACE-TEMP", BRICK.Temperature_Sensor),
+    Rule("exact", "ROOM-TEMP", BRICK.Temperature_Sensor),
+    Rule("suffix", "-ZN-T", BRICK.Temperature_Sensor),
+    Rule("suffix", "-ZNT", BRICK.Temperature_Sensor),
+    Rule("suffix", "-SPACE-TEMP", BRICK.Temperature_Sensor),
+    Rule(
+        "regex",
+        r"(.*-)?(ZN|ZONE|RM|ROOM|SPC|SPACE)-?(T|TMP|TEMP)",
+        BRICK.Temperature_Sensor,
+        units=("degrees-fahrenheit", "degrees-celsius"),
+    ),
+    # zone temperature setpoints
+    Rule("exact", "ZNT-SP", BRICK.Temperature_Setpoint),
+    Rule("suffix", "-ZN-SP", BRICK.Temperature_Setpoint),
+    Rule(
+        "regex",
+        r"(.*-)?(ZN|ZONE|RM|ROOM|SPACE)-?(T|TEMP)?-?(SP|STPT|SETPT|SETPOINT)",
+        BRICK.Temperature_Setpoint,
+        units=("degrees-fahrenheit", "degrees-celsius"),
+    ),
+    Rule("prefix", "EFF-SP", BRICK.Effective_Air_Temperature_Setpoint),
+    Rule("prefix", "OCC-CLG-SP", BRICK.Occupied_Cooling_Temperature_Setpoint),
+    Rule("prefix", "OCC-HTG-SP", BRICK.Occupied_Heating_Temperature_Setpoint),
+    # discharge and supply air
+    Rule("exact", "DAT", BRICK.Temperature_Sensor),
+    Rule("exact", "SAT", BRICK.Temperature_Sensor),
+    Rule("suffix", "-DA-T", BRICK.Temperature_Sensor),
+    Rule("suffix", "-SA-T", BRICK.Temperature_Sensor),
+    Rule(
+        "regex",
+        r"(.*-)?(DA|DISCH|DISCHARGE)-?(T|TMP|TEMP)",
+        BRICK.Temperature_Sensor,
+        units=("degrees-fahrenheit", "degrees-celsius"),
+    ),
+    Rule(
+        "regex",
+        r"(.*-)?(SA|SUPPLY)-?(AIR-?)?(T|TMP|TEMP)",
+        BRICK.Temperature_Sensor,
+        units=("degrees-fahrenheit", "degrees-celsius"),
+    ),
+    Rule("exact", "MAT", BRICK.Mixed_Air_Temperature_Sensor),
+    Rule("exact", "RAT", BRICK.Return_Air_Temperature_Sensor),
+    Rule("exact", "OAT", BRICK.Outside_Air_Temperature_Sensor),
+    Rule("exact", "OA-T", BRICK.Outside_Air_Temperature_Sensor),
+    # airflow
+    Rule("exact", "SA-FLOW", BRICK.Air_Flow_Sensor),
+    Rule("exact", "AIRFLOW", BRICK.Air_Flow_Sensor),
+    Rule("exact", "CFM", BRICK.Air_Flow_Sensor),
+    Rule("suffix", "-SA-F", BRICK.Air_Flow_Sensor),
+    Rule(
+        "regex",
+        r"(.*-)?(SA|DA|BOX)?-?(F|FLOW|FLW|CFM|AIRFLOW)",
+        BRICK.Air_Flow_Sensor,
+        units=("cubic-feet-per-minute", "liters-per-second", "cubic-meters-per-hour"),
+    ),
+    Rule(
+        "regex",
+        r"(.*-)?(SA|DA)?-?(FLOW|FLW|CFM|AIRFLOW)-?(SP|STPT|SETPT|SETPOINT)",
+        BRICK.Air_Flow_Setpoint,
+        units=("cubic-feet-per-minute", "liters-per-second", "cubic-meters-per-hour"),
+    ),
+    # commands
+    Rule("exact", "DPR-POS", BRICK.Damper_Command),
+    Rule("exact", "DMPR-CMD", BRICK.Damper_Command),
+    Rule("prefix", "DPR-", BRICK.Damper_Command, units=("percent",)),
+    Rule("prefix", "DMPR-", BRICK.Damper_Command, units=("percent",)),
+    Rule(
+        "regex",
+        r"(.*-)?(DPR|DMPR|DAMPER)(-?(O|CMD|POS|OUT))?",
+        BRICK.Damper_Command,
+        units=("percent",),
+    ),
+    Rule("exact", "HW-VLV", BRICK.Valve_Command),
+    Rule("prefix", "HTG-", BRICK.Valve_Command, units=("percent",)),
+    Rule(
+        "regex",
+        r"(.*-)?(HTG|HEAT|RHT|REHEAT|HW)-?(VLV|VALVE)?(-?(O|CMD|POS|OUT))?",
+        BRICK.Valve_Command,
+        units=("percent",),
+    ),
+    Rule("exact", "OCC", BRICK.Occupancy_Sensor),
+    Rule("exact", "OCC-STATUS", BRICK.Occupancy_Sensor),
+    Rule("prefix", "OCC-", BRICK.Occupancy_Sensor, object_types=("binary-input", "binary-value")),
+    # fans
+    Rule("suffix", "-FAN-S", BRICK.Fan_Status, object_types=("binary-input", "binary-value")),
+    Rule("suffix", "-FAN-C", BRICK.Fan_Command, object_types=("binary-output", "binary-value")),
+    Rule(
+        "regex",
+        r"(.*-)?(SF|RF|EF|FAN)-?(SS|STS|STATUS)",
+        BRICK.Fan_Status,
+        object_types=("binary-input", "binary-value"),
+    ),
+    Rule(
+        "regex",
+        r"(.*-)?(SF|RF|EF|FAN)-?(SPD|SPEED|VFD)",
+        BRICK.Speed_Command,
+        units=("percent", "hertz"),
+    ),
+    # last resort, what the units or the object type alone say
+    Rule("units", "degrees-fahrenheit", BRICK.Temperature_Sensor),
+    Rule("units", "degrees-celsius", BRICK.Temperature_Sensor),
+    Rule("units", "cubic-feet-per-minute", BRICK.Air_Flow_Sensor),
+    Rule("units", "liters-per-second", BRICK.Air_Flow_Sensor),
+    Rule("units", "percent-relative-humidity", BRICK.Relative_Humidity_Sensor),
+    Rule("units", "parts-per-million", BRICK.CO2_Sensor),
+    Rule("units", "inches-of-water", BRICK.Static_Pressure_Sensor),
+    Rule("units", "pascals", BRICK.Static_Pressure_Sensor),
+    Rule("object-type", "binary-input", BRICK.Status),
+    Rule("object-type", "binary-output", BRICK.Command),
+]
+
+
+class _Trie:
+    """Longest match of the keys at the start of a string."""
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def add(self, key: str, rule: Rule) -> None:
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(rule)
+
+    def longest(self, text: str) -> List[Rule]:
+        node = self.root
+        found: List[Rule] = []
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+
+class PointTagger:
+    """
+    A rule set compiled into an indexed matcher, see the module docstring.
+    Compile once, then classify as many points as there are.
+    """
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules: List[Rule] = []
+        self._exact: Dict[str, List[Rule]] = {}
+        self._prefixes = _Trie()
+        self._suffixes = _Trie()
+        self._units: Dict[str, List[Rule]] = {}
+        self._object_types: Dict[str, List[Rule]] = {}
+        self._regex_patterns: List[Tuple[int, re.Pattern]] = []
+        regexes = []
+
+        for rule in rules:
+            if rule.kind not in RULE_KINDS:
+                raise ValueError(f"unknown rule kind: {rule.kind}")
+            rule = rule._replace(
+                units=tuple(enum_name(unit) for unit in rule.units),
+                object_types=tuple(enum_name(object_type) for object_type in rule.object_types),
+            )
+            self.rules.append(rule)
+            if rule.kind == "exact":
+                self._exact.setdefault(normalize(rule.pattern), []).append(rule)
+            elif rule.kind == "prefix":
+                self._prefixes.add(normalize(rule.pattern), rule)
+            elif rule.kind == "suffix":
+                # keep the leading separator of "-ZN-T", it is what makes it a suffix
+                pattern = ("-" if rule.pattern[:1] in "-_ ." else "") + normalize(rule.pattern)
+                self._suffixes.add(pattern[::-1], rule)
+            elif rule.kind == "regex":
+                # each one by itself reports a bad pattern, and tries the
+                # rules after one that matched but was ruled out
+                self._regex_patterns.append((len(self.rules) - 1, re.compile(rule.pattern)))
+                regexes.append((f"r{len(self.rules) - 1}", rule.pattern))
+            elif rule.kind == "units":
+                self._units.setdefault(enum_name(rule.pattern), []).append(rule)
+            else:
+                self._object_types.setdefault(enum_name(rule.pattern), []).append(rule)
+
+        # one pass over the name finds the first regex rule in the list that
+        # matches the whole name, usually the only one
+        self._regex = (
+            re.compile("|".join(f"(?P<{group}>(?:{pattern})$)" for group, pattern in regexes))
+            if regexes
+            else None
+        )
+        self._cache: Dict[tuple, Optional[Match]] = {}
+
+    def classify(
+        self,
+        name: str,
+        units: Optional[str] = None,
+        object_type: Optional[str] = None,
+    ) -> Optional[Match]:
+        """The best match for a point, None when no rule fits it."""
+        key = (name, units, object_type)
+        cache = self._cache
+        if key in cache:
+            return cache[key]
+
+        match = self._classify(normalize(name), enum_name(units), enum_name(object_type))
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        cache[key] = match
+        return match
+
+    def _classify(
+        self, name: str, units: Optional[str], object_type: Optional[str]
+    ) -> Optional[Match]:
+        # most specific kind first, the other lookups only run on a miss
+        rules = self._exact.get(name)
+        best = rules and self._best(rules, units, object_type)
+        if best:
+            return best
+        rules = self._suffixes.longest(name[::-1])
+        best = rules and self._best(rules, units, object_type)
+        if best:
+            return best
+        rules = self._prefixes.longest(name)
+        best = rules and self._best(rules, units, object_type)
+        if best:
+            return best
+        for rule in self._regex_rules(name):
+            best = self._best((rule,), units, object_type)
+            if best:
+                return best
+        rules = self._units.get(units) or self._object_types.get(object_type)
+        return (rules and self._best(rules, units, object_type)) or None
+
+    def _best(
+        self, rules: Iterable[Rule], units: Optional[str], object_type: Optional[str]
+    ) -> Optional[Match]:
+        best = None
+        for rule in rules:
+            confidence = self._confidence(rule, units, object_type)
+            if confidence is not None and (best is None or confidence > best.confidence):
+                best = Match(rule.brick_class, confidence, rule)
+        return best
+
+    def _regex_rules(self, name: str) -> Iterator[Rule]:
+        """The regex rules that match the whole name, in the order of the list."""
+        match = self._regex.match(name) if self._regex else None
+        if match is None:
+            return
+        first = int(match.lastgroup[1:])
+        yield self.rules[first]
+        for index, pattern in self._regex_patterns:
+            if index > first and pattern.fullmatch(name):
+                yield self.rules[index]
+
+    @staticmethod
+    def _confidence(
+        rule: Rule, units: Optional[str], object_type: Optional[str]
+    ) -> Optional[float]:
+        """How sure a match of the rule is for the point, None if it's ruled out."""
+        confidence = RULE_KINDS[rule.kind]
+        for allowed, value in ((rule.units, units), (rule.object_types, object_type)):
+            if not allowed:
+                continue
+            if value is None:
+                confidence -= UNKNOWN_PENALTY
+            elif value in allowed:
+                confidence += CONSTRAINT_BONUS
+            else:
+                return None
+        return round(min(confidence, 1.0), 3)
+
+    def classify_all(
+        self, points: Iterable[Tuple[str, Optional[str], Optional[str]]]
+    ) -> Tuple[List[Tuple[str, Match]], List[str]]:
+        """
+        Matches of (name, units, object type) points and the names of the
+        points no rule fits.
+        """
+        matched = []
+        unmatched = []
+        for name, units, object_type in points:
+            match = self.classify(name, units, object_type)
+            if match is None:
+                unmatched.append(name)
+            else:
+                matched.append((name, match))
+        return matched, unmatched
+
+
+def benchmark(tagger: PointTagger, count: int, controllers: Optional[int] = None) -> float:
+    """
+    Points classified per second, made up names that are all new, or with
+    `controllers` the names of that many controllers over and over, the way
+    a site repeats them (those are answered from the cache).
+    """
+    stems = ["ZN-T", "zn_temp", "DA-T", "SA-F", "DPR-O", "HTG-O", "SF-STS", "XYZ"]
+    controllers = controllers or count
+    names = [
+        f"VAV{index % controllers}-{stems[index % len(stems)]}" for index in range(count)
+    ]
+    started = time.perf_counter()
+    for name in names:
+        tagger.classify(name, "percent", "analog-value")
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify point names as Brick classes")
+    parser.add_argument(
+        "names",
+        nargs="?",
+        help="file of point names, one per line, optionally name,units,object-type",
+    )
+    parser.add_argument("--benchmark", type=int, help="time classifying this many names")
+    args = parser.parse_args()
+
+    tagger = PointTagger(NAMING_VARIANTS)
+    if args.benchmark:
+        # the rate that counts for a first discovery run is the one for new
+        # names, the cache only helps where names repeat
+        new = benchmark(PointTagger(NAMING_VARIANTS), args.benchmark)
+        repeated = benchmark(tagger, args.benchmark, BENCHMARK_CONTROLLERS)
+        print(f"{new:,.0f} new names per second")
+        print(f"{repeated:,.0f} names per second repeated over {BENCHMARK_CONTROLLERS} controllers")
+        return
+
+    names_file = open(args.names) if args.names else sys.stdin
+    rows = ((row + [None, None])[:3] for row in csv.reader(names_file) if row)
+    matched, unmatched = tagger.classify_all(rows)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(("name", "brick_class", "confidence", "rule"))
+    for name, match in matched:
+        writer.writerow(
+            (name, match.brick_class, match.confidence, f"{match.rule.kind}:{match.rule.pattern}")
+        )
+    for name in unmatched:
+        writer.writerow((name, "", "", ""))
+    sys.stderr.write(f"{len(matched)} matched, {len(unmatched)} unmatched\n")
+
+
+if __name__ == "__main__":
+    main()
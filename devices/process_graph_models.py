@@ -1,5 +1,12 @@
+import argparse
+import io
+import os
+
 import rdflib
 from rdflib import RDF, Namespace, Graph, URIRef, Literal
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+
+from point_tagger import NAMING_VARIANTS, PointTagger, exact_rules
 
 
 # Define namespaces
@@ -22,6 +29,9 @@ ROOM_NUMBERS = ["410", "411", "412"]
 # Raw file name
 VAV_BOX = "vav_10"
 
+# bytes of N-Triples lines parsed at a time
+NT_READ_SIZE = 1 << 16
+
 # Define point type mappings to Brick classes
 point_type_mappings = {
     "Zone Air Temperature Sensor": ["ZN-T", BRICK.Temperature_Sensor],
@@ -34,6 +44,9 @@ point_type_mappings = {
     "Occupancy Sensor": ["OCC-C", BRICK.Occupancy_Sensor],
 }
 
+# the exact names above first, then the naming variants of other vendors
+point_tagger = PointTagger(exact_rules(point_type_mappings) + NAMING_VARIANTS)
+
 
 def read_rdf_file(file_path):
     g = rdflib.Graph()
@@ -51,61 +64,186 @@ def extract_device_configurations(graph):
     return devices
 
 
-def get_brick_class_uri_by_key(key):
-    for entity, details in point_type_mappings.items():
-        if details[0] == key:
-            return details[1]  # Return the BRICK class URI directly
-    return None  # Return None if not found
-    
-    
-def process_and_save_rdf(devices, output_file_path):
-
+class DeviceConfigurationSink:
+    """
+    Takes the triples of a streamed discovery run in the order they were
+    written, the triples of one object at a time, and keeps only the object
+    being read. Once the triples of the next object start, a point (an
+    object a device contains) goes to `points` for the reader to take, as
+    (device id, point URI, details) with the same details as
+    extract_device_configurations, and is forgotten.
+    """
+
+    def __init__(self):
+        self.points = []
+        self.subject = None
+        self.device_id = None
+        self.details = {}
+
+    def triple(self, s, p, o):
+        # the device's contains triple is written with the object it contains
+        subject = str(o) if p == BACNET.contains else str(s)
+        if subject != self.subject:
+            self.flush()
+            self.subject = subject
+        if p == BACNET.contains:
+            self.device_id = str(s).split("//")[1]
+        else:
+            self.details[str(p)] = str(o)
+
+    def flush(self):
+        """The object being read is complete."""
+        if self.device_id is not None:
+            self.points.append((self.device_id, self.subject, self.details))
+        self.subject = None
+        self.device_id = None
+        self.details = {}
+
+    def take(self):
+        points, self.points = self.points, []
+        return points
+
+
+def turtle_chunks(file_path):
+    """
+    The turtle documents of a streamed discovery run one at a time, each
+    starts with its prefixes. A file of one document is one chunk.
+    """
+    chunk = []
+    in_prefixes = True
+    with open(file_path, encoding="utf-8") as turtle_file:
+        for line in turtle_file:
+            is_prefix = line.startswith("@prefix")
+            if is_prefix and not in_prefixes:
+                yield "".join(chunk)
+                chunk = []
+            in_prefixes = is_prefix or (in_prefixes and not line.strip())
+            chunk.append(line)
+    if chunk:
+        yield "".join(chunk)
+
+
+def stream_points(file_path):
+    """
+    The points of the output of discover-objects-rdf.py as they are read,
+    N-Triples (.nt) a few lines at a time and turtle a chunk at a time, so
+    memory stays flat however large the discovery run was.
+    """
+    sink = DeviceConfigurationSink()
+    if file_path.endswith(".nt"):
+        parser = W3CNTriplesParser(sink)
+        with open(file_path, "rb") as nt_file:
+            while True:
+                lines = nt_file.readlines(NT_READ_SIZE)
+                if not lines:
+                    break
+                parser.parse(io.BytesIO(b"".join(lines)))
+                yield from sink.take()
+    else:
+        for chunk in turtle_chunks(file_path):
+            for triple in rdflib.Graph().parse(data=chunk, format="turtle"):
+                sink.triple(*triple)
+            # a streamed chunk is one object
+            sink.flush()
+            yield from sink.take()
+    sink.flush()
+    yield from sink.take()
+
+
+def processed_chunk():
     g = Graph()
     g.bind("brick", BRICK)
     g.bind("bldg", BLDG)
     g.bind("bacnet", BACNET)
+    return g
+
+
+def write_chunk(g, output):
+    """Append the triples of the graph as a turtle chunk with its own prefixes."""
+    output.write(g.serialize(format="turtle", encoding="utf-8"))
+
 
+def process_and_save_rdf(points, output_file_path):
+    """
+    Tag (device id, point URI, details) points with Brick classes, each one
+    written to the output as soon as it is tagged, so the processed model
+    isn't held in memory either.
+    """
+    output = open(output_file_path, "wb")
+
+    g = processed_chunk()
     ahu_uri = BLDG[AHU_NAME]
     g.add((ahu_uri, RDF.type, BRICK.Air_Handler_Unit))
+    for room_number in ROOM_NUMBERS:
+        g.add((BLDG[f"Room-{room_number}"], RDF.type, BRICK.Room))
+    write_chunk(g, output)
 
     # Adjust the flat_point_mappings to replace underscores with hyphens in keys
     flat_point_mappings = {name.replace("_", "-"): brick_class for brick_class, names in point_type_mappings.items() for name in names}
     
     print("flat_point_mappings: ",flat_point_mappings)
 
-    for device_id, points in devices.items():
+    unmatched = []
+    devices = set()
+    for device_id, point_uri, details in points:
+        g = processed_chunk()
         device_uri = BLDG[f"VAV_{device_id}"]
-        g.add((device_uri, RDF.type, DEVICE_TYPE))
-        g.add((ahu_uri, BRICK.feeds, device_uri))
-
-        for room_number in ROOM_NUMBERS:
-            room_uri = BLDG[f"Room-{room_number}"]
-            g.add((room_uri, RDF.type, BRICK.Room))
-            g.add((device_uri, BRICK.serves, room_uri))
-
-        for point_uri, details in points.items():
-            point_name = details.get(f"{BACNET}object-name", "")
-            brick_class_uri = get_brick_class_uri_by_key(point_name)
-            if brick_class_uri:
-                # Generate a unique new_point_uri for each point
-                new_point_uri = BLDG[f"{point_name}_{device_id}"]  # Example of generating a unique URI
-                g.add((new_point_uri, RDF.type, brick_class_uri))
-                # Optionally add BACnet properties to the new entity
-                for prop, value in details.items():
-                    g.add((new_point_uri, URIRef(prop), Literal(value)))
-            else:
-                print(f"Skipping unmapped point: {point_name}")
-
-            g.serialize(destination=output_file_path, format="turtle")
+        if device_id not in devices:
+            devices.add(device_id)
+            g.add((device_uri, RDF.type, DEVICE_TYPE))
+            g.add((ahu_uri, BRICK.feeds, device_uri))
+            for room_number in ROOM_NUMBERS:
+                g.add((device_uri, BRICK.serves, BLDG[f"Room-{room_number}"]))
+
+        point_name = details.get(f"{BACNET}object-name", "")
+        match = point_tagger.classify(
+            point_name,
+            details.get(f"{BACNET}units"),
+            details.get(f"{BACNET}object-type"),
+        )
+        brick_class_uri = match.brick_class if match else None
+        if brick_class_uri:
+            print(f"{point_name}: {brick_class_uri} ({match.confidence}, {match.rule.kind})")
+            # Generate a unique new_point_uri for each point
+            new_point_uri = BLDG[f"{point_name}_{device_id}"]  # Example of generating a unique URI
+            g.add((new_point_uri, RDF.type, brick_class_uri))
+            g.add((new_point_uri, BRICK.isPointOf, device_uri))
+            # Keep the BACnet address of the point, the raw URI is bacnet://<device>/<object>
+            g.add((new_point_uri, BACNET["device-instance"], Literal(int(device_id))))
+            g.add((new_point_uri, BACNET["object-identifier"], Literal(point_uri.rsplit("/", 1)[1])))
+            # Optionally add BACnet properties to the new entity
+            for prop, value in details.items():
+                g.add((new_point_uri, URIRef(prop), Literal(value)))
+        else:
+            unmatched.append(point_name)
+            print(f"Skipping unmapped point: {point_name}")
+        write_chunk(g, output)
+
+    output.close()
+    print(f"{len(unmatched)} points unmatched: {', '.join(unmatched)}")
 
 
 
 def main():
-    rdf_file_path = f"./raw_graph_models/{VAV_BOX}"
-    graph = read_rdf_file(rdf_file_path)
-    device_configurations = extract_device_configurations(graph)
-    output_file_path = f"./processed_graph_models/processed_{VAV_BOX}"
-    process_and_save_rdf(device_configurations, output_file_path)
+    parser = argparse.ArgumentParser(description="Tag discovered BACnet points with Brick classes")
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default=f"./raw_graph_models/{VAV_BOX}",
+        help="output of discover-objects-rdf.py, N-Triples if it ends in .nt, else turtle",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="turtle file to write, by default processed_<input name> in ./processed_graph_models",
+    )
+    args = parser.parse_args()
+
+    output_file_path = args.output or os.path.join(
+        "./processed_graph_models",
+        f"processed_{os.path.splitext(os.path.basename(args.input))[0]}",
+    )
+    process_and_save_rdf(stream_points(args.input), output_file_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,660 @@
+"""
+Offline analyzer for BACnet/IP captures made with capture_bacnet.sh.
+
+Streams through the pcap one packet at a time, decodes the BVLL, NPDU and
+APDU headers and reports requests per device, confirmed request response
+times, segmentation, retries and timeouts, Who-Is/I-Am storms and the top
+talkers. The captured requests can also be replayed against a test device
+farm for load testing.
+
+$ python scripts/analyze_pcap.py bacnet_capture.pcap
+$ python scripts/analyze_pcap.py bacnet_capture.pcap --json
+$ python scripts/analyze_pcap.py bacnet_capture.pcap --replay 127.0.0.1:47808 --speed 10
+"""
+
+import argparse
+import json
+import math
+import socket
+import struct
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, Optional, Tuple
+
+
+# how long a confirmed request may go unanswered before it counts as timed out
+APDU_TIMEOUT = 3.0
+
+# Who-Is or I-Am messages per second that count as a storm
+STORM_THRESHOLD = 50
+
+# how many entries the top-N tables show
+TOP_N = 10
+
+BVLL_TYPE_BACNET_IP = 0x81
+
+# BVLL functions that carry an NPDU, and the offset of the NPDU
+BVLL_NPDU_OFFSETS = {
+    0x04: 10,  # Forwarded-NPDU, carries the original source address
+    0x09: 4,  # Distribute-Broadcast-To-Network
+    0x0A: 4,  # Original-Unicast-NPDU
+    0x0B: 4,  # Original-Broadcast-NPDU
+}
+
+# APDU types
+CONFIRMED_REQUEST = 0
+UNCONFIRMED_REQUEST = 1
+SIMPLE_ACK = 2
+COMPLEX_ACK = 3
+SEGMENT_ACK = 4
+ERROR = 5
+REJECT = 6
+ABORT = 7
+
+APDU_TYPE_NAMES = {
+    CONFIRMED_REQUEST: "confirmed-request",
+    UNCONFIRMED_REQUEST: "unconfirmed-request",
+    SIMPLE_ACK: "simple-ack",
+    COMPLEX_ACK: "complex-ack",
+    SEGMENT_ACK: "segment-ack",
+    ERROR: "error",
+    REJECT: "reject",
+    ABORT: "abort",
+}
+
+CONFIRMED_SERVICES = {
+    0: "acknowledgeAlarm",
+    1: "confirmedCOVNotification",
+    2: "confirmedEventNotification",
+    3: "getAlarmSummary",
+    4: "getEnrollmentSummary",
+    5: "subscribeCOV",
+    6: "atomicReadFile",
+    7: "atomicWriteFile",
+    8: "addListElement",
+    9: "removeListElement",
+    10: "createObject",
+    11: "deleteObject",
+    12: "readProperty",
+    14: "readPropertyMultiple",
+    15: "writeProperty",
+    16: "writePropertyMultiple",
+    17: "deviceCommunicationControl",
+    18: "confirmedPrivateTransfer",
+    19: "confirmedTextMessage",
+    20: "reinitializeDevice",
+    26: "readRange",
+    28: "subscribeCOVProperty",
+    29: "getEventInformation",
+}
+
+UNCONFIRMED_SERVICES = {
+    0: "iAm",
+    1: "iHave",
+    2: "unconfirmedCOVNotification",
+    3: "unconfirmedEventNotification",
+    4: "unconfirmedPrivateTransfer",
+    5: "unconfirmedTextMessage",
+    6: "timeSynchronization",
+    7: "whoHas",
+    8: "whoIs",
+    9: "utcTimeSynchronization",
+}
+
+WHO_IS = 8
+I_AM = 0
+
+# pcap link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+
+def read_pcap(file) -> Iterator[Tuple[float, bytes]]:
+    """
+    Yield (timestamp, IPv4 packet) for every packet of a classic pcap file,
+    reading one record at a time so the size of the capture doesn't matter.
+    """
+    header = file.read(24)
+    if len(header) < 24:
+        return
+
+    magic = header[:4]
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    else:
+        raise ValueError("not a pcap file (pcapng is not supported, use tcpdump -w)")
+    fraction = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+
+    record_header = struct.Struct(endian + "IIII")
+    while True:
+        data = file.read(16)
+        if len(data) < 16:
+            return
+        seconds, fractions, captured_length, _ = record_header.unpack(data)
+        frame = file.read(captured_length)
+        if len(frame) < captured_length:
+            return
+
+        packet = ip_packet(linktype, frame)
+        if packet is not None:
+            yield seconds + fractions * fraction, packet
+
+
+def ip_packet(linktype: int, frame: bytes) -> Optional[bytes]:
+    """Strip the link layer header, None for anything that isn't IPv4."""
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, frame[12:14]
+        # skip a VLAN tag
+        if ethertype == b"\x81\x00":
+            offset, ethertype = 18, frame[16:18]
+        return frame[offset:] if ethertype == b"\x08\x00" else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return frame[16:] if frame[14:16] == b"\x08\x00" else None
+    if linktype == LINKTYPE_NULL:
+        return frame[4:] if frame[4:5] and frame[4] >> 4 == 4 else None
+    if linktype == LINKTYPE_RAW:
+        return frame if frame[:1] and frame[0] >> 4 == 4 else None
+    return None
+
+
+def udp_payload(packet: bytes) -> Optional[Tuple[str, str, bytes]]:
+    """Source, destination ("ip:port") and payload of a UDP datagram."""
+    if len(packet) < 20 or packet[9] != 17:
+        return None
+    # ignore fragments after the first one
+    if struct.unpack("!H", packet[6:8])[0] & 0x1FFF:
+        return None
+    header_length = (packet[0] & 0x0F) * 4
+    udp = packet[header_length:]
+    if len(udp) < 8:
+        return None
+    source_port, destination_port, length = struct.unpack("!HHH", udp[:6])
+    source = f"{socket.inet_ntoa(packet[12:16])}:{source_port}"
+    destination = f"{socket.inet_ntoa(packet[16:20])}:{destination_port}"
+    return source, destination, udp[8:length]
+
+
+def decode_bacnet(payload: bytes) -> Optional[dict]:
+    """
+    Decode the BVLL, NPDU and APDU headers of a BACnet/IP message, None when
+    the payload isn't BACnet or carries a network layer message.
+    """
+    if len(payload) < 4 or payload[0] != BVLL_TYPE_BACNET_IP:
+        return None
+    function = payload[1]
+    offset = BVLL_NPDU_OFFSETS.get(function)
+    if offset is None:
+        return None
+
+    message = {"bvll": function}
+    if function == 0x04:
+        message["forwarded_from"] = "{}:{}".format(
+            socket.inet_ntoa(payload[4:8]), struct.unpack("!H", payload[8:10])[0]
+        )
+
+    # NPDU
+    npdu = payload[offset:]
+    if len(npdu) < 2 or npdu[0] != 0x01:
+        return None
+    control = npdu[1]
+    i = 2
+    if control & 0x20:
+        dnet, dlen = struct.unpack("!HB", npdu[i : i + 3])
+        message["dnet"] = dnet
+        message["dadr"] = npdu[i + 3 : i + 3 + dlen].hex()
+        i += 3 + dlen
+    if control & 0x08:
+        snet, slen = struct.unpack("!HB", npdu[i : i + 3])
+        message["snet"] = snet
+        message["sadr"] = npdu[i + 3 : i + 3 + slen].hex()
+        i += 3 + slen
+    if control & 0x20:
+        i += 1  # hop count
+    if control & 0x80:
+        return None  # network layer message
+
+    # APDU
+    apdu = npdu[i:]
+    if not apdu:
+        return None
+    apdu_type = apdu[0] >> 4
+    message["apdu_type"] = apdu_type
+    message["apdu"] = apdu
+
+    try:
+        if apdu_type == CONFIRMED_REQUEST:
+            segmented = bool(apdu[0] & 0x08)
+            message["segmented"] = segmented
+            message["more_follows"] = bool(apdu[0] & 0x04)
+            message["invoke_id"] = apdu[2]
+            if segmented:
+                message["sequence_number"] = apdu[3]
+                message["service"] = apdu[5]
+            else:
+                message["service"] = apdu[3]
+        elif apdu_type == UNCONFIRMED_REQUEST:
+            message["service"] = apdu[1]
+        elif apdu_type in (SIMPLE_ACK, ERROR):
+            message["invoke_id"] = apdu[1]
+            message["service"] = apdu[2]
+        elif apdu_type == COMPLEX_ACK:
+            segmented = bool(apdu[0] & 0x08)
+            message["segmented"] = segmented
+            message["more_follows"] = bool(apdu[0] & 0x04)
+            message["invoke_id"] = apdu[1]
+            if segmented:
+                message["sequence_number"] = apdu[2]
+                message["service"] = apdu[4]
+            else:
+                message["service"] = apdu[2]
+        elif apdu_type in (SEGMENT_ACK, REJECT, ABORT):
+            message["invoke_id"] = apdu[1]
+        else:
+            return None
+    except IndexError:
+        return None
+
+    return message
+
+
+def bacnet_address(ip_address: str, message: dict, prefix: str) -> str:
+    """Name a device by its IP address, or its routed network address."""
+    if prefix + "net" in message:
+        return f"{message[prefix + 'net']}:{message[prefix + 'adr']}"
+    return ip_address
+
+
+class LatencyHistogram:
+    """
+    Response time distribution in logarithmic buckets, constant memory no
+    matter how many samples are added.
+    """
+
+    # 10 buckets per decade from 10 microseconds up
+    BASE = 1e-5
+    PER_DECADE = 10
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds: float) -> None:
+        bucket = max(0, int(math.log10(max(seconds, self.BASE) / self.BASE) * self.PER_DECADE))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                # upper edge of the bucket
+                return min(self.BASE * 10 ** ((bucket + 1) / self.PER_DECADE), self.maximum)
+        return self.maximum
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 2),
+            "p50_ms": round(self.percentile(0.50) * 1000, 2),
+            "p95_ms": round(self.percentile(0.95) * 1000, 2),
+            "p99_ms": round(self.percentile(0.99) * 1000, 2),
+            "max_ms": round(self.maximum * 1000, 2),
+        }
+
+
+class CaptureAnalyzer:
+    def __init__(self, apdu_timeout: float = APDU_TIMEOUT, storm_threshold: int = STORM_THRESHOLD):
+        self.apdu_timeout = apdu_timeout
+        self.storm_threshold = storm_threshold
+
+        self.packets = 0
+        self.bacnet_messages = 0
+        self.first_time: Optional[float] = None
+        self.last_time: Optional[float] = None
+
+        self.apdu_types = Counter()
+        self.requests_to_device = Counter()
+        self.requests_from_client = Counter()
+        self.services = Counter()
+        self.latency: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+
+        # (client, server, invoke id) -> (first request time, service)
+        self.outstanding: Dict[tuple, Tuple[float, int]] = {}
+        self.last_expire = 0.0
+        self.retries = Counter()
+        self.timeouts = Counter()
+        self.errors = Counter()
+        self.rejects = Counter()
+        self.aborts = Counter()
+
+        self.segmented_requests = 0
+        self.segmented_responses = 0
+        self.segments = 0
+        self.segment_acks = 0
+
+        # per second counts of Who-Is and I-Am
+        self.storm_second: Optional[int] = None
+        self.storm_counts = Counter()
+        self.storms = []
+        self.peak_who_is = 0
+        self.peak_i_am = 0
+
+        self.talker_packets = Counter()
+        self.talker_bytes = Counter()
+
+    def add(self, timestamp: float, source: str, destination: str, payload: bytes) -> None:
+        self.packets += 1
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+
+        message = decode_bacnet(payload)
+        if message is None:
+            return
+        self.bacnet_messages += 1
+
+        source = bacnet_address(message.get("forwarded_from", source), message, "s")
+        destination = bacnet_address(destination, message, "d")
+        self.talker_packets[source] += 1
+        self.talker_bytes[source] += len(payload)
+
+        self.expire(timestamp)
+
+        apdu_type = message["apdu_type"]
+        self.apdu_types[APDU_TYPE_NAMES[apdu_type]] += 1
+
+        if apdu_type == CONFIRMED_REQUEST:
+            self.confirmed_request(timestamp, source, destination, message)
+        elif apdu_type == UNCONFIRMED_REQUEST:
+            self.unconfirmed_request(timestamp, message)
+        elif apdu_type == SEGMENT_ACK:
+            self.segment_acks += 1
+        else:
+            self.response(timestamp, source, destination, message)
+
+    def confirmed_request(self, timestamp, client, server, message) -> None:
+        service = message["service"]
+        if message["segmented"]:
+            self.segments += 1
+            if message["sequence_number"] != 0:
+                return
+            self.segmented_requests += 1
+
+        key = (client, server, message["invoke_id"])
+        if key in self.outstanding:
+            # same invoke id before an answer, the client gave up waiting
+            self.retries[server] += 1
+            return
+
+        service_name = CONFIRMED_SERVICES.get(service, f"service-{service}")
+        self.requests_to_device[server] += 1
+        self.requests_from_client[client] += 1
+        self.services[service_name] += 1
+        self.outstanding[key] = (timestamp, service)
+
+    def response(self, timestamp, server, client, message) -> None:
+        apdu_type = message["apdu_type"]
+        if apdu_type == COMPLEX_ACK and message["segmented"]:
+            self.segments += 1
+            if message["sequence_number"] != 0:
+                return
+            self.segmented_responses += 1
+
+        key = (client, server, message["invoke_id"])
+        if apdu_type == ERROR:
+            self.errors[server] += 1
+        elif apdu_type == REJECT:
+            self.rejects[server] += 1
+        elif apdu_type == ABORT:
+            self.aborts[server] += 1
+            # aborts can come from either side
+            self.outstanding.pop((server, client, message["invoke_id"]), None)
+
+        request = self.outstanding.pop(key, None)
+        if request is None:
+            return
+        request_time, service = request
+        service_name = CONFIRMED_SERVICES.get(service, f"service-{service}")
+        self.latency[service_name].add(timestamp - request_time)
+
+    def unconfirmed_request(self, timestamp, message) -> None:
+        service = message["service"]
+        self.services[UNCONFIRMED_SERVICES.get(service, f"unconfirmed-{service}")] += 1
+        if service not in (WHO_IS, I_AM):
+            return
+
+        second = int(timestamp)
+        if second != self.storm_second:
+            self.close_storm_window()
+            self.storm_second = second
+        self.storm_counts[service] += 1
+
+    def close_storm_window(self) -> None:
+        if self.storm_second is None:
+            return
+        who_is = self.storm_counts[WHO_IS]
+        i_am = self.storm_counts[I_AM]
+        self.peak_who_is = max(self.peak_who_is, who_is)
+        self.peak_i_am = max(self.peak_i_am, i_am)
+        if who_is >= self.storm_threshold or i_am >= self.storm_threshold:
+            self.storms.append(
+                {
+                    "time": time.strftime(
+                        "%Y-%m-%d %H:%M:%S", time.localtime(self.storm_second)
+                    ),
+                    "who_is": who_is,
+                    "i_am": i_am,
+                }
+            )
+        self.storm_counts = Counter()
+
+    def expire(self, now: float) -> None:
+        """Count requests that went unanswered as timeouts, keeps memory bounded."""
+        if len(self.outstanding) < 1024 and now - self.last_expire < 1.0:
+            return
+        self.last_expire = now
+        for key, (request_time, _) in list(self.outstanding.items()):
+            if now - request_time > self.apdu_timeout:
+                self.timeouts[key[1]] += 1
+                del self.outstanding[key]
+
+    def finish(self) -> None:
+        self.close_storm_window()
+        for (_, server, _), (request_time, _) in self.outstanding.items():
+            if self.last_time - request_time > self.apdu_timeout:
+                self.timeouts[server] += 1
+        self.outstanding.clear()
+
+    def report(self) -> dict:
+        duration = (self.last_time - self.first_time) if self.packets else 0.0
+        return {
+            "packets": self.packets,
+            "bacnet_messages": self.bacnet_messages,
+            "duration_s": round(duration, 3),
+            "apdu_types": dict(self.apdu_types),
+            "services": dict(self.services.most_common()),
+            "requests_per_device": dict(self.requests_to_device.most_common(TOP_N)),
+            "requests_per_client": dict(self.requests_from_client.most_common(TOP_N)),
+            "response_times": {
+                service: histogram.summary()
+                for service, histogram in sorted(self.latency.items())
+            },
+            "segmentation": {
+                "segmented_requests": self.segmented_requests,
+                "segmented_responses": self.segmented_responses,
+                "segments": self.segments,
+                "segment_acks": self.segment_acks,
+            },
+            "retries": dict(self.retries.most_common(TOP_N)),
+            "timeouts": dict(self.timeouts.most_common(TOP_N)),
+            "errors": dict(self.errors.most_common(TOP_N)),
+            "rejects": dict(self.rejects.most_common(TOP_N)),
+            "aborts": dict(self.aborts.most_common(TOP_N)),
+            "who_is_i_am": {
+                "peak_who_is_per_s": self.peak_who_is,
+                "peak_i_am_per_s": self.peak_i_am,
+                "storm_threshold_per_s": self.storm_threshold,
+                "storms": self.storms,
+            },
+            "top_talkers": [
+                {
+                    "address": address,
+                    "packets": self.talker_packets[address],
+                    "bytes": self.talker_bytes[address],
+                }
+                for address, _ in self.talker_bytes.most_common(TOP_N)
+            ],
+        }
+
+
+def print_report(report: dict) -> None:
+    print(
+        f"{report['packets']} packets, {report['bacnet_messages']} BACnet messages "
+        f"over {report['duration_s']} s"
+    )
+
+    def table(title, rows):
+        print(f"\n{title}")
+        if not rows:
+            print("    (none)")
+        for name, value in rows.items():
+            print(f"    {name:<32} {value}")
+
+    table("APDU types", report["apdu_types"])
+    table("Services", report["services"])
+    table("Requests per device", report["requests_per_device"])
+    table("Requests per client", report["requests_per_client"])
+
+    print("\nResponse times (ms)")
+    print(f"    {'service':<28} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for service, summary in report["response_times"].items():
+        print(
+            f"    {service:<28} {summary['count']:>7} {summary['mean_ms']:>9} "
+            f"{summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9} "
+            f"{summary['max_ms']:>9}"
+        )
+
+    table("Segmentation", report["segmentation"])
+    table("Retries per device", report["retries"])
+    table("Timeouts per device", report["timeouts"])
+    table("Errors per device", report["errors"])
+    table("Rejects per device", report["rejects"])
+    table("Aborts per device", report["aborts"])
+
+    storms = report["who_is_i_am"]
+    print(
+        f"\nWho-Is/I-Am: peak {storms['peak_who_is_per_s']} Who-Is/s, "
+        f"{storms['peak_i_am_per_s']} I-Am/s"
+    )
+    for storm in storms["storms"]:
+        print(f"    storm at {storm['time']}: {storm['who_is']} Who-Is, {storm['i_am']} I-Am")
+
+    print("\nTop talkers")
+    for talker in report["top_talkers"]:
+        print(f"    {talker['address']:<32} {talker['packets']:>8} pkts {talker['bytes']:>10} bytes")
+
+
+def replay(path: str, target: str, speed: float) -> None:
+    """
+    Send the captured requests to `target` with their original spacing
+    divided by `speed`. Every request goes out as an Original-Unicast-NPDU,
+    answers from the target are read and dropped.
+    """
+    host, port = target.rsplit(":", 1)
+    address = (host, int(port))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+
+    sent = 0
+    start_wall = time.monotonic()
+    start_capture = None
+    with open(path, "rb") as file:
+        for timestamp, packet in read_pcap(file):
+            datagram = udp_payload(packet)
+            if datagram is None:
+                continue
+            payload = datagram[2]
+            message = decode_bacnet(payload)
+            if message is None or message["apdu_type"] not in (
+                CONFIRMED_REQUEST,
+                UNCONFIRMED_REQUEST,
+            ):
+                continue
+
+            if start_capture is None:
+                start_capture = timestamp
+            delay = (timestamp - start_capture) / speed - (time.monotonic() - start_wall)
+            if delay > 0:
+                time.sleep(delay)
+
+            npdu = payload[BVLL_NPDU_OFFSETS[message["bvll"]] :]
+            sock.sendto(struct.pack("!BBH", BVLL_TYPE_BACNET_IP, 0x0A, len(npdu) + 4) + npdu, address)
+            sent += 1
+
+            try:
+                while True:
+                    sock.recv(2048)
+            except BlockingIOError:
+                pass
+
+    sock.close()
+    elapsed = time.monotonic() - start_wall
+    print(f"replayed {sent} requests to {target} in {elapsed:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a BACnet/IP pcap capture")
+    parser.add_argument("pcap", help="capture file from capture_bacnet.sh")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument(
+        "--apdu-timeout",
+        type=float,
+        default=APDU_TIMEOUT,
+        help="seconds before an unanswered request counts as timed out",
+    )
+    parser.add_argument(
+        "--storm-threshold",
+        type=int,
+        default=STORM_THRESHOLD,
+        help="Who-Is or I-Am per second that count as a storm",
+    )
+    parser.add_argument("--replay", metavar="HOST:PORT", help="replay the requests to a device farm")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up factor")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.pcap, args.replay, args.speed)
+        return
+
+    analyzer = CaptureAnalyzer(args.apdu_timeout, args.storm_threshold)
+    with open(args.pcap, "rb") as file:
+        for timestamp, packet in read_pcap(file):
+            datagram = udp_payload(packet)
+            if datagram is not None:
+                analyzer.add(timestamp, *datagram)
+    analyzer.finish()
+
+    report = analyzer.report()
+    if args.json:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
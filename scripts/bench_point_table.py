@@ -0,0 +1,124 @@
+"""
+Memory and speed of the columnar point cache against the dict per point
+layout it replaced, for a site of N points.
+
+$ python scripts/bench_point_table.py --points 100000
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.points import PointCache  # noqa: E402
+
+
+class DictPointCache:
+    """The previous layout, one dict of Python objects per point."""
+
+    def __init__(self):
+        self.points = {}
+        self.version = 0
+
+    def update(self, device_instance, object_identifier, property_identifier, value, timestamp=None):
+        key = (device_instance, object_identifier, property_identifier)
+        timestamp = timestamp or time.time()
+
+        entry = self.points.get(key)
+        if entry is not None and entry["value"] == value:
+            entry["timestamp"] = timestamp
+            entry["stale"] = False
+            return
+
+        self.version += 1
+        self.points[key] = {
+            "value": value,
+            "timestamp": timestamp,
+            "stale": False,
+            "version": self.version,
+        }
+
+
+def site_points(count: int):
+    """A mix like a real site, mostly analog values and some binary ones."""
+    rng = random.Random(1)
+    points = []
+    for n in range(count):
+        device_instance = 100000 + n // 200
+        if n % 4 == 3:
+            points.append(
+                (device_instance, f"binary-value,{n % 200}", "present-value", rng.choice(["active", "inactive"]))
+            )
+        else:
+            points.append(
+                (device_instance, f"analog-input,{n % 200}", "present-value", rng.uniform(50.0, 90.0))
+            )
+    return points
+
+
+def measure(cache_class, points):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    cache = cache_class()
+    for device_instance, object_identifier, property_identifier, value in points:
+        cache.update(device_instance, object_identifier, property_identifier, value, 1.0)
+    fill = time.perf_counter() - started
+
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # a poll cycle, every analog value changes
+    started = time.perf_counter()
+    for device_instance, object_identifier, property_identifier, value in points:
+        if isinstance(value, float):
+            value += 0.5
+        cache.update(device_instance, object_identifier, property_identifier, value, 2.0)
+    cycle = time.perf_counter() - started
+
+    started = time.perf_counter()
+    gc.collect()
+    collect = time.perf_counter() - started
+
+    return {
+        "bytes_per_point": used / len(points),
+        "fill_s": fill,
+        "update_cycle_s": cycle,
+        "full_gc_ms": collect * 1000,
+        "gc_tracked": len(gc.get_objects()),
+        "cache": cache,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the point cache layouts")
+    parser.add_argument("--points", type=int, default=100000)
+    args = parser.parse_args()
+
+    points = site_points(args.points)
+    print(f"{args.points} points")
+    print(f"{'layout':<10} {'bytes/pt':>10} {'fill s':>8} {'cycle s':>8} {'full gc ms':>11} {'gc objects':>11}")
+
+    results = {}
+    for name, cache_class in (("dict", DictPointCache), ("columnar", PointCache)):
+        result = results[name] = measure(cache_class, points)
+        print(
+            f"{name:<10} {result['bytes_per_point']:>10.1f} {result['fill_s']:>8.3f} "
+            f"{result['update_cycle_s']:>8.3f} {result['full_gc_ms']:>11.1f} {result['gc_tracked']:>11}"
+        )
+        # only one cache alive at a time so the gc numbers are comparable
+        del result["cache"]
+
+    ratio = results["dict"]["bytes_per_point"] / results["columnar"]["bytes_per_point"]
+    print(f"columnar uses {ratio:.1f}x less memory per point")
+
+
+if __name__ == "__main__":
+    main()
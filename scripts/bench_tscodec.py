@@ -0,0 +1,140 @@
+"""
+Compression ratio and encode/decode throughput of the historian's chunk
+codec on synthetic HVAC trends, against 16 bytes per sample (a double for
+the timestamp and one for the value) and zlib over those bytes.
+
+$ python scripts/bench_tscodec.py --days 7
+"""
+
+import argparse
+import math
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.historian import CHUNK_SAMPLES  # noqa: E402
+from app.tscodec import decode_chunk, encode_chunk  # noqa: E402
+
+RAW_SAMPLE_BYTES = 16
+
+
+def real(value: float) -> float:
+    """Round trip through a BACnet REAL, float32 on the wire."""
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+def timestamps(rng, count, interval, jitter=0.02, start=1.7e9):
+    """Polls at a fixed interval with some scheduling jitter."""
+    return [start + n * interval + rng.uniform(-jitter, jitter) for n in range(count)]
+
+
+def signals(rng, count, interval):
+    """name -> (timestamps, values), the kind of points a site trends."""
+    day = 86400 / interval
+    result = {}
+
+    times = timestamps(rng, count, interval)
+    result["zone temp, float32 noise"] = (
+        times,
+        [real(72 + 1.5 * math.sin(2 * math.pi * n / day) + rng.gauss(0, 0.05)) for n in range(count)],
+    )
+
+    times = timestamps(rng, count, interval)
+    result["zone temp, 0.1 resolution"] = (
+        times,
+        [real(round(72 + 1.5 * math.sin(2 * math.pi * n / day) + rng.gauss(0, 0.05), 1)) for n in range(count)],
+    )
+
+    times = timestamps(rng, count, interval)
+    values = []
+    supply = 55.0
+    for n in range(count):
+        supply += 0.1 * (55 - supply) + rng.gauss(0, 0.3)
+        values.append(real(supply))
+    result["supply air temp"] = (times, values)
+
+    times = timestamps(rng, count, interval)
+    values = []
+    damper = 30.0
+    for n in range(count):
+        if rng.random() < 0.05:
+            damper = float(rng.randrange(0, 101, 5))
+        values.append(damper)
+    result["damper command %"] = (times, values)
+
+    times = timestamps(rng, count, interval)
+    values = []
+    fan = 1.0
+    for n in range(count):
+        if rng.random() < 0.002:
+            fan = 1.0 - fan
+        values.append(fan)
+    result["fan status"] = (times, values)
+
+    # the adaptive poller reads quiet points less often
+    times = []
+    now = 1.7e9
+    for n in range(count):
+        now += rng.choice((5.0, 7.5, 11.25, 16.875, 300.0)) + rng.uniform(-0.02, 0.02)
+        times.append(now)
+    result["adaptive poll, static value"] = (times, [real(68.5)] * count)
+
+    return result
+
+
+def chunks(times, values, size):
+    for start in range(0, len(times), size):
+        yield times[start : start + size], values[start : start + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the historian chunk codec")
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--interval", type=float, default=60.0, help="poll interval, seconds")
+    parser.add_argument("--chunk-samples", type=int, default=CHUNK_SAMPLES)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    count = int(args.days * 86400 / args.interval)
+    print(f"{count} samples per signal, {args.chunk_samples} per chunk")
+    print(
+        f"{'signal':<28} {'bytes/sample':>12} {'ratio':>7} {'zlib ratio':>10} "
+        f"{'encode/s':>10} {'decode/s':>10}"
+    )
+
+    total_raw = total_encoded = 0
+    for name, (times, values) in signals(rng, count, args.interval).items():
+        parts = list(chunks(times, values, args.chunk_samples))
+
+        started = time.perf_counter()
+        encoded = [encode_chunk(chunk_times, chunk_values) for chunk_times, chunk_values in parts]
+        encode_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for data in encoded:
+            decode_chunk(data)
+        decode_seconds = time.perf_counter() - started
+
+        raw = count * RAW_SAMPLE_BYTES
+        size = sum(len(data) for data in encoded)
+        zlib_size = sum(
+            len(zlib.compress(b"".join(struct.pack("<dd", t, v) for t, v in zip(*part))))
+            for part in parts
+        )
+        total_raw += raw
+        total_encoded += size
+        print(
+            f"{name:<28} {size / count:>12.2f} {raw / size:>7.1f} {raw / zlib_size:>10.1f} "
+            f"{count / encode_seconds:>10.0f} {count / decode_seconds:>10.0f}"
+        )
+
+    print(f"overall {total_raw / total_encoded:.1f}x smaller than {RAW_SAMPLE_BYTES} bytes per sample")
+
+
+if __name__ == "__main__":
+    main()